@@ -17,8 +17,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from pkg_resources import get_distribution as _get_distribution
-__version__ = _get_distribution('brozzler').version
+import re
 
 class ShutdownRequested(Exception):
     pass
@@ -29,6 +28,22 @@ class NothingToClaim(Exception):
 class CrawlStopped(Exception):
     pass
 
+class ReachedTimeLimit(Exception):
+    pass
+
+class HostBusy(Exception):
+    '''
+    Raised when a host can't be leased because it's being brozzled by another
+    browser, or its crawl delay hasn't elapsed yet.
+    '''
+    def __init__(self, host, available_at):
+        self.host = host
+        self.available_at = available_at
+
+    def __str__(self):
+        return "HostBusy(host=%r, available_at=%s)" % (
+                self.host, self.available_at)
+
 class ProxyError(Exception):
     pass
 
@@ -98,6 +113,17 @@ def behavior_script(url, template_parameters=None):
             return script
     return None
 
+def behavior_request_idle_timeout(url):
+    '''
+    Returns the `request_idle_timeout_sec` of the behavior for `url`: seconds
+    without network activity after which the behavior is over, even if it
+    hasn't said it has finished. None if not configured.
+    '''
+    for behavior in behaviors():
+        if re.match(behavior['url_regex'], url):
+            return behavior.get('request_idle_timeout_sec')
+    return None
+
 import threading
 _thread_exception_gates = {}
 _thread_exception_gates_lock = threading.Lock()
@@ -253,20 +279,70 @@ def _remove_query(url):
 site_surt_canon = urlcanon.Canonicalizer(
         urlcanon.semantic.steps + [_remove_query])
 
-import doublethink
-import datetime
-EPOCH_UTC = datetime.datetime.utcfromtimestamp(0.0).replace(
-        tzinfo=doublethink.UTC)
-
-from brozzler.worker import BrozzlerWorker
-from brozzler.robots import is_permitted_by_robots
-from brozzler.frontier import RethinkDbFrontier
-from brozzler.browser import Browser, BrowserPool, BrowsingException
-from brozzler.model import (
-        new_job, new_job_file, new_site, Job, Page, Site, InvalidJobConf)
-from brozzler.cli import suggest_default_chrome_exe
+# the rest of the public api is imported on first use, so that commands that
+# don't need the browser or the worker (and youtube-dl, etc) start up quickly
+_LAZY_ATTRS = {
+    'BrozzlerWorker': 'brozzler.worker',
+    'is_permitted_by_robots': 'brozzler.robots',
+    'Frontier': 'brozzler.frontier',
+    'RethinkDbFrontier': 'brozzler.frontier',
+    'SqliteFrontier': 'brozzler.sqlite',
+    'Browser': 'brozzler.browser',
+    'BrowserPool': 'brozzler.browser',
+    'BrowsingException': 'brozzler.browser',
+    'new_job': 'brozzler.model',
+    'new_job_file': 'brozzler.model',
+    'new_job_bulk': 'brozzler.model',
+    'new_site': 'brozzler.model',
+    'new_sites': 'brozzler.model',
+    'Job': 'brozzler.model',
+    'Page': 'brozzler.model',
+    'Site': 'brozzler.model',
+    'InvalidJobConf': 'brozzler.model',
+    'suggest_default_chrome_exe': 'brozzler.cli',
+}
+
+def _load_lazy_attr(name):
+    import importlib
+    if name == '__version__':
+        from pkg_resources import get_distribution
+        value = get_distribution('brozzler').version
+    elif name == 'EPOCH_UTC':
+        # doublethink imports the rethinkdb driver
+        import datetime, doublethink
+        value = datetime.datetime.utcfromtimestamp(0.0).replace(
+                tzinfo=doublethink.UTC)
+    elif name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name]), name)
+    else:
+        # submodule, e.g. brozzler.frontier after only `import brozzler`
+        try:
+            value = importlib.import_module('brozzler.' + name)
+        except ImportError as e:
+            if e.name != 'brozzler.' + name:
+                raise
+            raise AttributeError(
+                    "module 'brozzler' has no attribute %r" % name)
+    globals()[name] = value
+    return value
+
+import sys
+import types
+if sys.version_info >= (3, 5):
+    class _LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            if name.startswith('__') and name != '__version__':
+                raise AttributeError(name)
+            return _load_lazy_attr(name)
+    sys.modules[__name__].__class__ = _LazyModule
+else:
+    # module __class__ can't be assigned, import everything now
+    for _name in ['__version__', 'EPOCH_UTC'] + list(_LAZY_ATTRS):
+        _load_lazy_attr(_name)
 
 __all__ = ['Page', 'Site', 'BrozzlerWorker', 'is_permitted_by_robots',
-           'RethinkDbFrontier', 'Browser', 'BrowserPool', 'BrowsingException',
+           'Frontier', 'RethinkDbFrontier', 'SqliteFrontier', 'Browser',
+           'BrowserPool', 'BrowsingException',
            'new_job', 'new_site', 'Job', 'new_job_file', 'InvalidJobConf',
+           'new_job_bulk', 'new_sites',
            'sleep', 'thread_accept_exceptions', 'thread_raise']
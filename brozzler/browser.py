@@ -20,11 +20,13 @@ import logging
 import time
 import brozzler
 import itertools
+import collections
 import json
 import websocket
 import time
 import threading
 import brozzler
+import brozzler.canon
 from requests.structures import CaseInsensitiveDict
 import datetime
 import base64
@@ -41,6 +43,9 @@ class NoBrowsersAvailable(Exception):
 class BrowsingTimeout(BrowsingException):
     pass
 
+class ChromeError(BrowsingException):
+    pass
+
 class BrowserPool:
     '''
     Manages pool of browsers. Automatically chooses available port for the
@@ -71,19 +76,34 @@ class BrowserPool:
         Raises:
             NoBrowsersAvailable if none available
         '''
+        return self.acquire_multi(1)[0]
+
+    def acquire_multi(self, n=1):
+        '''
+        Returns up to `n` available instances.
+
+        Returns:
+            list of browsers from pool, if any available
+
+        Raises:
+            NoBrowsersAvailable if none available
+        '''
+        browsers = []
         with self._lock:
             if len(self._in_use) >= self.size:
                 raise NoBrowsersAvailable
 
-            # choose available port
-            sock = socket.socket()
-            sock.bind(('0.0.0.0', 0))
-            port = sock.getsockname()[1]
-            sock.close()
+            while len(self._in_use) < self.size and len(browsers) < n:
+                # choose available port
+                sock = socket.socket()
+                sock.bind(('0.0.0.0', 0))
+                port = sock.getsockname()[1]
+                sock.close()
 
-            browser = Browser(port=port, **self.kwargs)
-            self._in_use.add(browser)
-            return browser
+                browser = Browser(port=port, **self.kwargs)
+                self._in_use.add(browser)
+                browsers.append(browser)
+        return browsers
 
     def release(self, browser):
         browser.stop()  # make sure
@@ -104,9 +124,19 @@ class BrowserPool:
     def num_in_use(self):
         return len(self._in_use)
 
+# behaviors signal that they have finished by calling this binding (see
+# Runtime.addBinding), or by logging this console message on browsers without
+# bindings, see js-templates/notify-behavior-finished.js
+BEHAVIOR_FINISHED_BINDING = '__brzlBehaviorFinished'
+BEHAVIOR_FINISHED_CONSOLE_MESSAGE = '__brzl_behavior_finished__'
+
 class WebsockReceiverThread(threading.Thread):
     logger = logging.getLogger(__module__ + '.' + __qualname__)
 
+    # max number of command results being waited for, beyond which the oldest
+    # are forgotten, since whoever was waiting for them must have timed out
+    MAX_PENDING_RESULTS = 1000
+
     def __init__(self, websock, name=None, daemon=True):
         super().__init__(name=name, daemon=daemon)
 
@@ -121,21 +151,48 @@ class WebsockReceiverThread(threading.Thread):
 
         self.is_open = False
         self.got_page_load_event = None
+        self.got_behavior_finished = None
         self.reached_limit = None
 
+        # network activity, see Browser.run_behavior()
+        self.request_count = 0
+        self.reset_network_activity()
+
         self.on_request = None
         self.on_response = None
 
-        self._result_messages = {}
+        self._result_messages = collections.OrderedDict()
+        # counts events a Browser might be waiting for, see wait_for_event()
+        self._events = threading.Condition()
+        self.event_count = 0
 
     def expect_result(self, msg_id):
-        self._result_messages[msg_id] = None
+        with self._events:
+            self._result_messages[msg_id] = None
+            while len(self._result_messages) > self.MAX_PENDING_RESULTS:
+                self._result_messages.popitem(last=False)
 
     def received_result(self, msg_id):
         return bool(self._result_messages.get(msg_id))
 
     def pop_result(self, msg_id):
-        return self._result_messages.pop(msg_id)
+        with self._events:
+            return self._result_messages.pop(msg_id)
+
+    def _notify(self):
+        with self._events:
+            self.event_count += 1
+            self._events.notify_all()
+
+    def wait_for_event(self, since, timeout):
+        '''
+        Waits up to `timeout` seconds for an event a Browser might be waiting
+        for (websocket opened, page loaded, command result received), unless
+        there have been any since `event_count` was `since`.
+        '''
+        with self._events:
+            self._events.wait_for(
+                    lambda: self.event_count != since, timeout=timeout)
 
     def _on_close(self, websock):
         pass
@@ -143,6 +200,7 @@ class WebsockReceiverThread(threading.Thread):
 
     def _on_open(self, websock):
         self.is_open = True
+        self._notify()
 
     def _on_error(self, websock, e):
         '''
@@ -206,6 +264,32 @@ class WebsockReceiverThread(threading.Thread):
         if self.on_response:
             self.on_response(message)
 
+    def reset_network_activity(self):
+        '''
+        Forgets the requests in flight. Called before browsing a page, since
+        chrome doesn't always report the end of the requests of the previous
+        page, and they would otherwise never be forgotten.
+        '''
+        self.inflight_requests = set()
+        self.max_inflight = 0
+        self.last_network_activity = time.time()
+
+    def _network_activity(self, message):
+        if message['method'] == 'Network.requestWillBeSent':
+            # also sent again with the same id for each redirect
+            self.inflight_requests.add(message['params']['requestId'])
+            self.request_count += 1
+            self.max_inflight = max(
+                    self.max_inflight, len(self.inflight_requests))
+        elif message['method'] in (
+                'Network.loadingFinished', 'Network.loadingFailed'):
+            self.inflight_requests.discard(message['params']['requestId'])
+        self.last_network_activity = time.time()
+
+    def _behavior_finished(self):
+        self.got_behavior_finished = datetime.datetime.utcnow()
+        self._notify()
+
     def _javascript_dialog_opening(self, message):
         self.logger.info('javascript dialog opened: %s', message)
         if message['params']['type'] == 'alert':
@@ -220,8 +304,13 @@ class WebsockReceiverThread(threading.Thread):
     def _handle_message(self, websock, json_message):
         message = json.loads(json_message)
         if 'method' in message:
+            if message['method'] in (
+                    'Network.requestWillBeSent', 'Network.dataReceived',
+                    'Network.loadingFinished', 'Network.loadingFailed'):
+                self._network_activity(message)
             if message['method'] == 'Page.loadEventFired':
                 self.got_page_load_event = datetime.datetime.utcnow()
+                self._notify()
             elif message['method'] == 'Network.responseReceived':
                 self._network_response_received(message)
             elif message['method'] == 'Network.requestWillBeSent':
@@ -233,10 +322,16 @@ class WebsockReceiverThread(threading.Thread):
                 self.logger.error(
                         '''chrome tab went "aw snap" or "he's dead jim"!''')
                 brozzler.thread_raise(self.calling_thread, BrowsingException)
+            elif message['method'] == 'Runtime.bindingCalled':
+                if message['params']['name'] == BEHAVIOR_FINISHED_BINDING:
+                    self._behavior_finished()
             elif message['method'] == 'Console.messageAdded':
                 self.logger.debug(
                         'console.%s %s', message['params']['message']['level'],
                         message['params']['message']['text'])
+                if (message['params']['message']['text']
+                        == BEHAVIOR_FINISHED_CONSOLE_MESSAGE):
+                    self._behavior_finished()
             elif message['method'] == 'Page.javascriptDialogOpening':
                 self._javascript_dialog_opening(message)
             elif (message['method'] == 'Network.loadingFailed'
@@ -245,9 +340,11 @@ class WebsockReceiverThread(threading.Thread):
                 brozzler.thread_raise(self.calling_thread, brozzler.ProxyError)
             # else:
             #     self.logger.debug("%s %s", message["method"], json_message)
-        elif 'result' in message:
-            if message['id'] in self._result_messages:
-                self._result_messages[message['id']] = message
+        elif 'result' in message or 'error' in message:
+            with self._events:
+                if message['id'] in self._result_messages:
+                    self._result_messages[message['id']] = message
+                    self._notify()
        #      else:
        #          self.logger.debug("%s", json_message)
        #  else:
@@ -259,6 +356,10 @@ class Browser:
     '''
     logger = logging.getLogger(__module__ + '.' + __qualname__)
 
+    # jpeg quality of screenshots and thumbnails, encoded by chrome
+    SCREENSHOT_QUALITY = 95
+    THUMBNAIL_WIDTH = 300
+
     def __init__(self, **kwargs):
         '''
         Initializes the Browser.
@@ -271,6 +372,7 @@ class Browser:
         self.websock = None
         self.websock_thread = None
         self.is_browsing = False
+        self.behavior_stats = None
         self._command_id = Counter()
 
     def __enter__(self):
@@ -282,10 +384,14 @@ class Browser:
 
     def _wait_for(self, callback, timeout=None):
         '''
-        Spins until callback() returns truthy.
+        Waits until callback() returns truthy, checking again whenever the
+        websocket thread receives something of interest. Wakes up at least
+        every 0.5 seconds, so that the wait can be interrupted by
+        `brozzler.thread_raise()`.
         '''
         start = time.time()
         while True:
+            since = self.websock_thread.event_count
             if callback():
                 return
             elapsed = time.time() - start
@@ -293,7 +399,10 @@ class Browser:
                 raise BrowsingTimeout(
                         'timed out after %.1fs waiting for: %s' % (
                             elapsed, callback))
-            brozzler.sleep(0.5)
+            wait = 0.5
+            if timeout:
+                wait = max(min(wait, timeout - elapsed), 0.01)
+            self.websock_thread.wait_for_event(since, wait)
 
     def send_to_chrome(self, suppress_logging=False, **kwargs):
         msg_id = next(self._command_id)
@@ -327,6 +436,10 @@ class Browser:
             self.send_to_chrome(method='Console.enable')
             self.send_to_chrome(method='Debugger.enable')
             self.send_to_chrome(method='Runtime.enable')
+            # fails harmlessly on chrome from before bindings
+            self.send_to_chrome(
+                    method='Runtime.addBinding',
+                    params={'name': BEHAVIOR_FINISHED_BINDING})
 
             # disable google analytics, see _handle_message() where breakpoint
             # is caught Debugger.paused
@@ -379,7 +492,7 @@ class Browser:
             self, page_url, ignore_cert_errors=False, extra_headers=None,
             user_agent=None, behavior_parameters=None,
             on_request=None, on_response=None, on_screenshot=None,
-            username=None, password=None, hashtags=None):
+            username=None, password=None, hashtags=None, on_thumbnail=None):
         '''
         Browses page in browser.
 
@@ -405,6 +518,9 @@ class Browser:
                 takes one argument, the the raw jpeg bytes (default None)
                 # XXX takes two arguments, the url of the page at the time the
                 # screenshot was taken, and the raw jpeg bytes (default None)
+            on_thumbnail: callback to invoke with a `THUMBNAIL_WIDTH` wide
+                jpeg thumbnail of the screenshot, scaled down by chrome, if
+                `on_screenshot` is also supplied (default None)
 
         Returns:
             A tuple (final_page_url, outlinks).
@@ -414,6 +530,9 @@ class Browser:
                 in the location bar, etc
             outlinks: a list of navigational links extracted from the page
 
+        Afterwards, `self.behavior_stats` holds the statistics returned by
+        `run_behavior()`.
+
         Raises:
             brozzler.ProxyError: in case of proxy connection error
             BrowsingException: if browsing the page fails in some other way
@@ -423,6 +542,8 @@ class Browser:
         if self.is_browsing:
             raise BrowsingException('browser is already busy browsing a page')
         self.is_browsing = True
+        self.behavior_stats = None
+        self.websock_thread.reset_network_activity()
         if on_request:
             self.websock_thread.on_request = on_request
         if on_response:
@@ -437,9 +558,15 @@ class Browser:
                 if on_screenshot:
                     jpeg_bytes = self.screenshot()
                     on_screenshot(jpeg_bytes)
+                    if on_thumbnail:
+                        on_thumbnail(self.thumbnail())
                 behavior_script = brozzler.behavior_script(
                         page_url, behavior_parameters)
-                self.run_behavior(behavior_script, timeout=900)
+                self.behavior_stats = self.run_behavior(
+                        behavior_script, timeout=900,
+                        request_idle_timeout=(
+                            brozzler.behavior_request_idle_timeout(
+                                page_url)))
                 outlinks = self.extract_outlinks()
                 self.visit_hashtags(page_url, hashtags, outlinks)
                 final_page_url = self.url()
@@ -459,11 +586,9 @@ class Browser:
     def visit_hashtags(self, page_url, hashtags, outlinks):
         _hashtags = set(hashtags or [])
         for outlink in outlinks:
-            url = urlcanon.whatwg(outlink)
-            hashtag = (url.hash_sign + url.fragment).decode('utf-8')
-            urlcanon.canon.remove_fragment(url)
-            if hashtag and str(url) == page_url:
-                _hashtags.add(hashtag)
+            canon = brozzler.canon.canonicalize(outlink)
+            if canon.hashtag and str(canon.whatwg) == page_url:
+                _hashtags.add(canon.hashtag)
         # could inject a script that listens for HashChangeEvent to figure
         # out which hashtags were visited already and skip those
         for hashtag in _hashtags:
@@ -524,17 +649,67 @@ class Browser:
                     'problem extracting outlinks, result message: %s', message)
             return frozenset()
 
-    def screenshot(self, timeout=30):
-        self.logger.info('taking screenshot')
+    def _call(self, method, params=None, timeout=30):
+        '''
+        Sends a command to chrome and waits for the result.
+
+        Returns:
+            the result message
+        Raises:
+            ChromeError: if chrome returns an error
+        '''
         self.websock_thread.expect_result(self._command_id.peek())
-        msg_id = self.send_to_chrome(method='Page.captureScreenshot')
+        kwargs = {'method': method}
+        if params:
+            kwargs['params'] = params
+        msg_id = self.send_to_chrome(**kwargs)
         self._wait_for(
                 lambda: self.websock_thread.received_result(msg_id),
                 timeout=timeout)
         message = self.websock_thread.pop_result(msg_id)
+        if 'error' in message:
+            raise ChromeError(
+                    '%s returned error %s' % (method, message['error']))
+        return message
+
+    def screenshot(self, clip=None, timeout=30):
+        '''
+        Returns a jpeg screenshot (bytes) of the viewport, encoded by chrome
+        with quality `SCREENSHOT_QUALITY`.
+
+        Args:
+            clip: region to capture and scale, a dict with keys "x", "y",
+                "width", "height" and "scale" (default None)
+        '''
+        self.logger.info('taking screenshot')
+        params = {'format': 'jpeg', 'quality': self.SCREENSHOT_QUALITY}
+        if clip:
+            params['clip'] = clip
+        message = self._call(
+                'Page.captureScreenshot', params, timeout=timeout)
         jpeg_bytes = base64.b64decode(message['result']['data'])
         return jpeg_bytes
 
+    def thumbnail(self, timeout=30):
+        '''
+        Returns a `THUMBNAIL_WIDTH` wide jpeg screenshot (bytes) of the
+        viewport, scaled down by chrome, or None if chrome can't do that.
+        Versions of chrome from before screenshot clipping ignore the scale
+        and return a full size screenshot, see
+        `brozzler.worker.BrozzlerWorker._write_screenshot`.
+        '''
+        try:
+            message = self._call('Page.getLayoutMetrics', timeout=timeout)
+            viewport = message['result']['layoutViewport']
+            return self.screenshot(clip={
+                'x': 0, 'y': 0, 'width': viewport['clientWidth'],
+                'height': viewport['clientHeight'],
+                'scale': self.THUMBNAIL_WIDTH / viewport['clientWidth']},
+                timeout=timeout)
+        except (ChromeError, KeyError) as e:
+            self.logger.info('chrome could not make a thumbnail: %s', e)
+            return None
+
     def url(self, timeout=30):
         '''
         Returns value of document.URL from the browser.
@@ -549,20 +724,74 @@ class Browser:
         message = self.websock_thread.pop_result(msg_id)
         return message['result']['result']['value']
 
-    def run_behavior(self, behavior_script, timeout=900):
+    def run_behavior(
+            self, behavior_script, timeout=900, request_idle_timeout=None):
+        '''
+        Runs `behavior_script` and returns when the behavior says it has
+        finished, after `request_idle_timeout` seconds without network
+        activity (no requests starting, receiving data or finishing), or
+        after `timeout` seconds. The page tells us right away when the
+        behavior finishes (see notify-behavior-finished.js). Just in case
+        that doesn't work, we also ask the page every 7 seconds.
+
+        Returns:
+            dict of statistics: "outcome" ("finished", "network_idle" or
+            "timeout"), "seconds" the behavior ran, "requests" made meanwhile,
+            "max_inflight" and "inflight" (at the end) numbers of requests in
+            flight, and "idle_seconds" since the last network activity
+        '''
+        thread = self.websock_thread
+        thread.got_behavior_finished = None
+        thread.max_inflight = len(thread.inflight_requests)
+        requests_before = thread.request_count
         self.send_to_chrome(
                 method='Runtime.evaluate', suppress_logging=True,
                 params={'expression': behavior_script})
+        notify_js = brozzler.jinja2_environment().get_template(
+                'notify-behavior-finished.js').render()
+        self.send_to_chrome(
+                method='Runtime.evaluate', suppress_logging=True,
+                params={'expression': notify_js})
 
         start = time.time()
+        def network_idle_seconds():
+            return time.time() - max(start, thread.last_network_activity)
+        def stats(outcome):
+            return {
+                'outcome': outcome,
+                'seconds': round(time.time() - start, 1),
+                'requests': thread.request_count - requests_before,
+                'max_inflight': thread.max_inflight,
+                'inflight': len(thread.inflight_requests),
+                'idle_seconds': round(network_idle_seconds(), 1),
+            }
+        def network_idle():
+            return (request_idle_timeout
+                    and network_idle_seconds() >= request_idle_timeout)
+
         while True:
             elapsed = time.time() - start
             if elapsed > timeout:
                 logging.info(
                         'behavior reached hard timeout after %.1fs', elapsed)
-                return
+                return stats('timeout')
 
-            brozzler.sleep(7)
+            try:
+                self._wait_for(
+                        lambda: thread.got_behavior_finished
+                                or network_idle(),
+                        timeout=min(7, max(timeout - elapsed, 0.1)))
+                if thread.got_behavior_finished:
+                    self.logger.info(
+                            'behavior says it has finished after %.1fs',
+                            time.time() - start)
+                    return stats('finished')
+                self.logger.info(
+                        'ending behavior after %.1fs, no network activity '
+                        'for %ss', time.time() - start, request_idle_timeout)
+                return stats('network_idle')
+            except BrowsingTimeout:
+                pass
 
             self.websock_thread.expect_result(self._command_id.peek())
             msg_id = self.send_to_chrome(
@@ -581,7 +810,7 @@ class Browser:
                         and type(msg['result']['result']['value']) == bool
                         and msg['result']['result']['value']):
                     self.logger.info('behavior decided it has finished')
-                    return
+                    return stats('finished')
             except BrowsingTimeout:
                 pass
 
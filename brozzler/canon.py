@@ -0,0 +1,118 @@
+'''
+brozzler/canon.py - memoized url canonicalization
+
+The same urls get canonicalized over and over, by the frontier when scoping
+and scheduling outlinks, by the scope rules, by the browser when looking for
+hashtags, and so on. `canonicalize()` does all of the parsing for a url in one
+pass and remembers the results for the most recently seen urls.
+
+Copyright (C) 2017 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import brozzler
+import collections
+import functools
+import urlcanon
+
+__all__ = ["CanonUrl", "FrozenUrl", "canonicalize", "site_surt"]
+
+# number of urls whose canonicalized forms are remembered
+CACHE_SIZE = 10000
+
+class FrozenUrl(urlcanon.ParsedUrl):
+    '''
+    A `urlcanon.ParsedUrl` that can't be modified, so that it can be safely
+    shared by everyone who asks to canonicalize the same url. Its string form,
+    surt and ssurt are computed once, the first time they are asked for. Use
+    `thaw()` to get a modifiable copy.
+    '''
+    def __init__(self, parsed_url):
+        self.__dict__.update(parsed_url.__dict__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def _memoize(self, key, fn):
+        if key not in self.__dict__:
+            self.__dict__[key] = fn()
+        return self.__dict__[key]
+
+    def __bytes__(self):
+        return self._memoize("_bytes", super().__bytes__)
+
+    def __str__(self):
+        return self._memoize("_str", lambda: self.__bytes__().decode("utf-8"))
+
+    def surt(self, trailing_comma=True, with_scheme=True):
+        if trailing_comma and with_scheme:
+            return self._memoize("_surt", super().surt)
+        return super().surt(trailing_comma, with_scheme)
+
+    def ssurt(self):
+        return self._memoize("_ssurt", super().ssurt)
+
+    def thaw(self):
+        '''Returns a modifiable `urlcanon.ParsedUrl` copy of this url.'''
+        url = urlcanon.ParsedUrl()
+        for k, v in self.__dict__.items():
+            if not k.startswith("_"):
+                setattr(url, k, v)
+        return url
+
+class CanonUrl(collections.namedtuple(
+        "CanonUrl", ["semantic", "whatwg", "hashtag"])):
+    '''
+    The canonicalized forms of a url, see `canonicalize()`.
+
+    Attributes:
+        semantic (FrozenUrl): semantically canonicalized url, used for
+            scoping; has no fragment
+        whatwg (FrozenUrl): whatwg canonicalized url without the fragment,
+            the url to crawl
+        hashtag (str): the fragment, with leading '#', or '' if none
+    '''
+    __slots__ = ()
+
+    @property
+    def surt(self):
+        '''Surt of the semantically canonicalized url, as bytes.'''
+        return self.semantic.surt()
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def canonicalize(url):
+    '''
+    Canonicalizes `url` (str) for scoping and for crawling. Results for the
+    `CACHE_SIZE` most recently used urls are remembered, and the same
+    immutable `CanonUrl` is returned to every caller.
+
+    Returns:
+        CanonUrl
+    '''
+    whatwg = urlcanon.whatwg(url)
+    hashtag = (whatwg.hash_sign + whatwg.fragment).decode("utf-8")
+    urlcanon.canon.remove_fragment(whatwg)
+    return CanonUrl(
+            FrozenUrl(urlcanon.semantic(url)), FrozenUrl(whatwg), hashtag)
+
+@functools.lru_cache(maxsize=1000)
+def site_surt(url):
+    '''
+    Returns the surt (str) that defines the default scope of a site with
+    seed `url`, see `brozzler.site_surt_canon`.
+    '''
+    return brozzler.site_surt_canon(url).surt().decode("ascii")
@@ -19,7 +19,8 @@ limitations under the License.
 
 import argparse
 import brozzler
-import brozzler.worker
+import brozzler.snapshot
+import brozzler.sqlite
 import datetime
 import json
 import logging
@@ -82,6 +83,40 @@ def rethinker(args):
             'BROZZLER_RETHINKDB_DB') or 'brozzler'
     return doublethink.Rethinker(servers.split(','), db)
 
+def add_sqlite_options(arg_parser):
+    arg_parser.add_argument(
+            '--sqlite-db', dest='sqlite_db',
+            default=os.environ.get('BROZZLER_SQLITE_DB'),
+            help=(
+                'keep the crawl frontier in this embedded sqlite database '
+                'file instead of rethinkdb, for single-node crawls (default '
+                'is the value of environment variable BROZZLER_SQLITE_DB)'))
+
+def open_frontier(args):
+    '''
+    Returns a `brozzler.SqliteFrontier` if --sqlite-db was specified,
+    otherwise a `brozzler.RethinkDbFrontier`.
+    '''
+    separate_outlinks = getattr(args, 'separate_outlinks', False)
+    if getattr(args, 'sqlite_db', None):
+        return brozzler.SqliteFrontier(
+                args.sqlite_db, separate_outlinks=separate_outlinks)
+    else:
+        return brozzler.RethinkDbFrontier(
+                rethinker(args), separate_outlinks=separate_outlinks)
+
+def open_store(args):
+    '''
+    Returns the document store (the `rr` of brozzler.Job, brozzler.Site and
+    brozzler.Page) for --sqlite-db if it was specified, otherwise for the
+    rethinkdb options. Cheaper than `open_frontier`, which also makes sure
+    the database is set up.
+    '''
+    if getattr(args, 'sqlite_db', None):
+        return brozzler.sqlite.SqliteStore(args.sqlite_db)
+    else:
+        return rethinker(args)
+
 def configure_logging(args):
     logging.basicConfig(
             stream=sys.stderr, level=args.log_level, format=(
@@ -168,14 +203,14 @@ def brozzle_page(argv=None):
     page = brozzler.Page(None, {'url': args.url, 'site_id': site.id})
     worker = brozzler.BrozzlerWorker(frontier=None, proxy=args.proxy)
 
-    def on_screenshot(screenshot_png):
+    def on_screenshot(screenshot_jpeg):
         OK_CHARS = (string.ascii_letters + string.digits)
-        filename = '/tmp/{}-{:%Y%m%d%H%M%S}.png'.format(
+        filename = '/tmp/{}-{:%Y%m%d%H%M%S}.jpg'.format(
                 ''.join(ch if ch in OK_CHARS else '_' for ch in args.url),
                 datetime.datetime.now())
-        # logging.info('len(screenshot_png)=%s', len(screenshot_png))
+        # logging.info('len(screenshot_jpeg)=%s', len(screenshot_jpeg))
         with open(filename, 'wb') as f:
-            f.write(screenshot_png)
+            f.write(screenshot_jpeg)
         logging.info('wrote screenshot to %s', filename)
 
     browser = brozzler.Browser(chrome_exe=args.chrome_exe)
@@ -203,16 +238,29 @@ def brozzler_new_job(argv=None):
     arg_parser.add_argument(
             'job_conf_file', metavar='JOB_CONF_FILE',
             help='brozzler job configuration file in yaml')
+    arg_parser.add_argument(
+            '--bulk', dest='bulk', action='store_true', help=(
+                'for jobs with lots of seeds: validate seeds one by one and '
+                'add sites in bulk, reporting progress'))
+    arg_parser.add_argument(
+            '--seeds-file', dest='seeds_file', metavar='SEEDS_FILE', help=(
+                'read more seeds from this file, one url or json object per '
+                'line, or yaml if named *.yaml or *.yml (implies --bulk)'))
     add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
     add_common_options(arg_parser, argv)
 
     args = arg_parser.parse_args(args=argv[1:])
     configure_logging(args)
 
-    rr = rethinker(args)
-    frontier = brozzler.RethinkDbFrontier(rr)
+    frontier = open_frontier(args)
     try:
-        brozzler.new_job_file(frontier, args.job_conf_file)
+        if args.bulk or args.seeds_file:
+            with open(args.job_conf_file) as f:
+                job_conf = yaml.load(f)
+            brozzler.new_job_bulk(frontier, job_conf, args.seeds_file)
+        else:
+            brozzler.new_job_file(frontier, args.job_conf_file)
     except brozzler.InvalidJobConf as e:
         print('brozzler-new-job: invalid job file:', args.job_conf_file, file=sys.stderr)
         print('  ' + yaml.dump(e.errors).rstrip().replace('\n', '\n  '), file=sys.stderr)
@@ -229,8 +277,15 @@ def brozzler_new_site(argv=None):
             prog=os.path.basename(argv[0]),
             description='brozzler-new-site - register site to brozzle',
             formatter_class=BetterArgumentDefaultsHelpFormatter)
-    arg_parser.add_argument('seed', metavar='SEED', help='seed url')
+    arg_parser.add_argument(
+            'seed', metavar='SEED', nargs='?', help='seed url')
+    arg_parser.add_argument(
+            '--from-file', dest='from_file', metavar='SEEDS_FILE', help=(
+                'add a site for each seed in this file, one url or json '
+                'object per line, or yaml if named *.yaml or *.yml; the other '
+                'options apply to every seed, unless overridden in the file'))
     add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
     arg_parser.add_argument(
             '--time-limit', dest='time_limit', default=None,
             help='time limit in seconds for this site')
@@ -258,11 +313,12 @@ def brozzler_new_site(argv=None):
     add_common_options(arg_parser, argv)
 
     args = arg_parser.parse_args(args=argv[1:])
+    if bool(args.seed) == bool(args.from_file):
+        arg_parser.error('specify either SEED or --from-file')
     configure_logging(args)
 
-    rr = rethinker(args)
-    site = brozzler.Site(rr, {
-        'seed': args.seed,
+    frontier = open_frontier(args)
+    site_conf = {
         'time_limit': int(args.time_limit) if args.time_limit else None,
         'ignore_robots': args.ignore_robots,
         'warcprox_meta': json.loads(
@@ -270,10 +326,29 @@ def brozzler_new_site(argv=None):
         'behavior_parameters': json.loads(
             args.behavior_parameters) if args.behavior_parameters else None,
         'username': args.username,
-        'password': args.password})
+        'password': args.password}
 
-    frontier = brozzler.RethinkDbFrontier(rr)
-    brozzler.new_site(frontier, site)
+    if args.from_file:
+        count = brozzler.new_sites(
+                frontier, _sites_from_file(frontier, args.from_file, site_conf))
+        logging.info('added %s sites from %s', count, args.from_file)
+    else:
+        site_conf['seed'] = args.seed
+        brozzler.new_site(frontier, brozzler.Site(frontier.rr, site_conf))
+
+def _sites_from_file(frontier, path, site_conf):
+    schema = brozzler.model.load_schema()
+    for i, seed_conf in enumerate(brozzler.model.read_seeds(path)):
+        try:
+            brozzler.model.validate_seed(seed_conf, schema)
+        except brozzler.InvalidJobConf as e:
+            logging.error(
+                    'skipping invalid seed #%s in %s: %s', i, path, e.errors)
+            continue
+        conf = dict(site_conf)
+        conf.update(seed_conf)
+        conf['seed'] = conf.pop('url')
+        yield brozzler.Site(frontier.rr, conf)
 
 def brozzler_worker(argv=None):
     '''
@@ -285,6 +360,7 @@ def brozzler_worker(argv=None):
             prog=os.path.basename(argv[0]),
             formatter_class=BetterArgumentDefaultsHelpFormatter)
     add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
     arg_parser.add_argument(
             '-e', '--chrome-exe', dest='chrome_exe',
             default=suggest_default_chrome_exe(),
@@ -299,10 +375,40 @@ def brozzler_worker(argv=None):
             help=(
                 'when needed, choose an available instance of warcprox from '
                 'the rethinkdb service registry'))
+    arg_parser.add_argument(
+            '--housekeeping', dest='housekeeping', action='store_true',
+            help=(
+                'also do frontier housekeeping in this process, see '
+                'brozzler-housekeeper (only one process per crawl cluster '
+                'needs to)'))
+    arg_parser.add_argument(
+            '--separate-outlinks', dest='separate_outlinks',
+            action='store_true', help=(
+                'store the lists of accepted, blocked and rejected outlinks '
+                'of each page in the "outlinks" table, keeping only counts '
+                'on the page, to keep page documents small'))
+    arg_parser.add_argument(
+            '--pipeline-threads', dest='pipeline_threads', type=int,
+            default=0, help=(
+                'number of threads per browser that prepare the next page '
+                '(robots check, youtube-dl) and finish browsed pages '
+                '(screenshots, outlinks) while chrome browses the current '
+                'page; 0 brozzles each page from start to finish before '
+                'moving on to the next'))
+    arg_parser.add_argument(
+            '--max-browsers-per-host', dest='max_browsers_per_host',
+            type=int, default=2, help=(
+                'max number of browsers across the crawl cluster brozzling '
+                'pages from the same host at the same time, for sites '
+                'without a crawl delay (with a crawl delay, only one)'))
     add_common_options(arg_parser, argv)
 
     args = arg_parser.parse_args(args=argv[1:])
     configure_logging(args)
+    if args.sqlite_db and args.warcprox_auto:
+        arg_parser.error(
+                '--warcprox-auto needs the rethinkdb service registry, it '
+                'cannot be used with --sqlite-db')
 
     def dump_state(signum, frame):
         signal.signal(signal.SIGQUIT, signal.SIG_IGN)
@@ -325,23 +431,64 @@ def brozzler_worker(argv=None):
         finally:
             signal.signal(signal.SIGQUIT, dump_state)
 
-    rr = rethinker(args)
-    frontier = brozzler.RethinkDbFrontier(rr)
-    service_registry = doublethink.ServiceRegistry(rr)
+    frontier = open_frontier(args)
+    if args.sqlite_db:
+        service_registry = None
+    else:
+        service_registry = doublethink.ServiceRegistry(frontier.rr)
     worker = brozzler.worker.BrozzlerWorker(
             frontier, service_registry, max_browsers=int(args.max_browsers),
             chrome_exe=args.chrome_exe, proxy=args.proxy,
-            warcprox_auto=args.warcprox_auto)
+            warcprox_auto=args.warcprox_auto,
+            pipeline_threads=args.pipeline_threads,
+            max_browsers_per_host=args.max_browsers_per_host)
 
     signal.signal(signal.SIGQUIT, dump_state)
     signal.signal(signal.SIGTERM, lambda s,f: worker.stop())
     signal.signal(signal.SIGINT, lambda s,f: worker.stop())
 
+    housekeeper = None
+    if args.housekeeping:
+        housekeeper = brozzler.frontier.Housekeeper(frontier)
+        housekeeper.start()
+
     th = threading.Thread(target=worker.run, name='BrozzlerWorkerThread')
     th.start()
     th.join()
+    if housekeeper:
+        housekeeper.stop()
+        housekeeper.join()
     logging.info('brozzler-worker is all done, exiting')
 
+def brozzler_housekeeper(argv=None):
+    '''
+    Command line utility entry point for frontier housekeeping. Periodically
+    finishes sites that are over their time limit or have nothing left to
+    brozzle, finishes jobs whose sites are all finished, and releases stale
+    site claims.
+    '''
+    argv = argv or sys.argv
+    arg_parser = argparse.ArgumentParser(
+            prog=os.path.basename(argv[0]),
+            description='brozzler-housekeeper - frontier housekeeping',
+            formatter_class=BetterArgumentDefaultsHelpFormatter)
+    add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
+    arg_parser.add_argument(
+            '--interval', dest='interval', type=float, default=60.0,
+            help='seconds between housekeeping passes')
+    add_common_options(arg_parser, argv)
+
+    args = arg_parser.parse_args(args=argv[1:])
+    configure_logging(args)
+
+    frontier = open_frontier(args)
+    housekeeper = brozzler.frontier.Housekeeper(frontier, args.interval)
+    signal.signal(signal.SIGTERM, lambda s,f: housekeeper.stop())
+    signal.signal(signal.SIGINT, lambda s,f: housekeeper.stop())
+    housekeeper.run()
+    logging.info('brozzler-housekeeper is all done, exiting')
+
 def brozzler_ensure_tables(argv=None):
     '''
     Creates rethinkdb tables if they don't already exist. Brozzler
@@ -368,6 +515,87 @@ def brozzler_ensure_tables(argv=None):
     # sites, pages, jobs tables
     brozzler.frontier.RethinkDbFrontier(rr)
 
+def brozzler_export_frontier(argv=None):
+    '''
+    Command line utility entry point for exporting the full frontier state of
+    a job (the job, its sites and pages) to a snapshot directory of gzipped
+    newline-delimited json files, for brozzler-import-frontier.
+    '''
+    argv = argv or sys.argv
+    arg_parser = argparse.ArgumentParser(
+            prog=os.path.basename(argv[0]),
+            description=(
+                'brozzler-export-frontier - export the frontier state of a '
+                'job to a snapshot directory'),
+            formatter_class=BetterArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument(
+            '--job', dest='job_id', metavar='JOB_ID', required=True, help=(
+                'job to export'))
+    arg_parser.add_argument(
+            '--chunk-size', dest='chunk_size', type=int,
+            default=brozzler.snapshot.CHUNK_SIZE, help=(
+                'number of documents per snapshot file'))
+    arg_parser.add_argument(
+            'dir', metavar='DIR', help='snapshot directory to create')
+    add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
+    add_common_options(arg_parser, argv)
+
+    args = arg_parser.parse_args(args=argv[1:])
+    configure_logging(args)
+
+    frontier = open_frontier(args)
+    try:
+        job_id = int(args.job_id)
+    except ValueError:
+        job_id = args.job_id
+    if not brozzler.Job.load(frontier.rr, job_id):
+        logging.fatal('job not found with id=%s', repr(job_id))
+        sys.exit(1)
+    try:
+        brozzler.snapshot.export_frontier(
+                frontier, job_id, args.dir, args.chunk_size)
+    except FileExistsError as e:
+        logging.fatal('%s', e)
+        sys.exit(1)
+
+def brozzler_import_frontier(argv=None):
+    '''
+    Command line utility entry point for restoring a snapshot made by
+    brozzler-export-frontier. Documents are written in bulk, in parallel
+    batches. An interrupted import picks up where it left off when run again.
+    '''
+    argv = argv or sys.argv
+    arg_parser = argparse.ArgumentParser(
+            prog=os.path.basename(argv[0]),
+            description=(
+                'brozzler-import-frontier - restore a frontier snapshot'),
+            formatter_class=BetterArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=1000,
+            help='number of documents per bulk write')
+    arg_parser.add_argument(
+            '--threads', dest='threads', type=int, default=4,
+            help='number of bulk writes to run in parallel')
+    arg_parser.add_argument(
+            '--checkpoint', dest='checkpoint', default=None, help=(
+                'file listing the snapshot files already imported (default '
+                'is DIR/imported)'))
+    arg_parser.add_argument(
+            'dir', metavar='DIR', help='snapshot directory to import')
+    add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
+    add_common_options(arg_parser, argv)
+
+    args = arg_parser.parse_args(args=argv[1:])
+    configure_logging(args)
+
+    frontier = open_frontier(args)
+    count = brozzler.snapshot.import_frontier(
+            frontier, args.dir, batch_size=args.batch_size,
+            threads=args.threads, checkpoint=args.checkpoint)
+    logging.info('imported %s documents from %s', count, args.dir)
+
 class Jsonner(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime.datetime):
@@ -511,6 +739,10 @@ def brozzler_list_pages(argv=None):
             '--claimed', dest='claimed', action='store_true', help=(
                 'limit to pages that are currently claimed by a brozzler '
                 'worker'))
+    arg_parser.add_argument(
+            '--outlinks', dest='outlinks', action='store_true', help=(
+                'include outlinks of pages that have them stored separately '
+                '(see brozzler-worker --separate-outlinks)'))
     add_rethinkdb_options(arg_parser)
     add_common_options(arg_parser, argv)
 
@@ -518,6 +750,8 @@ def brozzler_list_pages(argv=None):
     configure_logging(args)
 
     rr = rethinker(args)
+    if args.outlinks:
+        frontier = brozzler.RethinkDbFrontier(rr)
     if args.job:
         try:
             job_id = int(args.job)
@@ -551,6 +785,10 @@ def brozzler_list_pages(argv=None):
             reql = reql.filter({'claimed': True})
         logging.debug('querying rethinkb: %s', reql)
         results = reql.run()
+        if args.outlinks:
+            results = (
+                    _with_outlinks(frontier, brozzler.Page(rr, result))
+                    for result in results)
         if args.yaml:
             yaml.dump_all(
                     results, stream=sys.stdout, explicit_start=True,
@@ -559,6 +797,12 @@ def brozzler_list_pages(argv=None):
             for result in results:
                 print(json.dumps(result, cls=Jsonner, indent=2))
 
+def _with_outlinks(frontier, page):
+    result = dict(page)
+    if 'outlink_counts' in result:
+        result['outlinks'] = frontier.page_outlinks(page)
+    return result
+
 def brozzler_list_captures(argv=None):
     '''
     Handy utility for looking up entries in the rethinkdb "captures" table by
@@ -638,6 +882,7 @@ def brozzler_stop_crawl(argv=None):
             formatter_class=BetterArgumentDefaultsHelpFormatter)
     group = arg_parser.add_mutually_exclusive_group(required=True)
     add_rethinkdb_options(arg_parser)
+    add_sqlite_options(arg_parser)
     group.add_argument(
             '--job', dest='job_id', metavar='JOB_ID', help=(
                 'request crawl stop for the specified job'))
@@ -649,7 +894,7 @@ def brozzler_stop_crawl(argv=None):
     args = arg_parser.parse_args(args=argv[1:])
     configure_logging(args)
 
-    rr = rethinker(args)
+    rr = open_store(args)
     if args.job_id:
         try:
             job_id = int(args.job_id)
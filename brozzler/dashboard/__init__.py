@@ -54,14 +54,26 @@ def service_registry():
         _svc_reg = doublethink.ServiceRegistry(rr)
     return _svc_reg
 
+def site_page_count(site_id, counter):
+    """
+    Returns the value of the counter in site.page_counts, maintained by the
+    frontier, or None if the site doesn't have it.
+    """
+    reql = rr.table("sites").get(site_id)["page_counts"][counter].default(None)
+    logging.debug("querying rethinkdb: %s", reql)
+    return reql.run()
+
 @app.route("/api/sites/<site_id>/queued_count")
 @app.route("/api/site/<site_id>/queued_count")
 def queued_count(site_id):
-    reql = rr.table("pages").between(
-            [site_id, 0, False, r.minval], [site_id, 0, False, r.maxval],
-            index="priority_by_site").count()
-    logging.debug("querying rethinkdb: %s", reql)
-    count = reql.run()
+    count = site_page_count(site_id, "queued")
+    if count is None:
+        # site from before page_counts were tracked
+        reql = rr.table("pages").between(
+                [site_id, 0, False, r.minval], [site_id, 0, False, r.maxval],
+                index="priority_by_site").count()
+        logging.debug("querying rethinkdb: %s", reql)
+        count = reql.run()
     return flask.jsonify(count=count)
 
 @app.route("/api/sites/<site_id>/queue")
@@ -82,12 +94,15 @@ def queue(site_id):
 @app.route("/api/sites/<site_id>/page_count")
 @app.route("/api/site/<site_id>/page_count")
 def page_count(site_id):
-    reql = rr.table("pages").between(
-            [site_id, 1, False, r.minval],
-            [site_id, r.maxval, False, r.maxval],
-            index="priority_by_site").count()
-    logging.debug("querying rethinkdb: %s", reql)
-    count = reql.run()
+    count = site_page_count(site_id, "brozzled")
+    if count is None:
+        # site from before page_counts were tracked
+        reql = rr.table("pages").between(
+                [site_id, 1, False, r.minval],
+                [site_id, r.maxval, False, r.maxval],
+                index="priority_by_site").count()
+        logging.debug("querying rethinkdb: %s", reql)
+        count = reql.run()
     return flask.jsonify(count=count)
 
 @app.route("/api/sites/<site_id>/pages")
@@ -111,6 +126,26 @@ def page(page_id):
     page_ = reql.run()
     return flask.jsonify(page_)
 
+@app.route("/api/pages/<page_id>/outlinks")
+@app.route("/api/page/<page_id>/outlinks")
+def page_outlinks(page_id):
+    """
+    Outlinks of the page, which may be stored on the page or in the
+    "outlinks" table (brozzler-worker --separate-outlinks).
+    """
+    reql = rr.table("pages").get(page_id)
+    logging.debug("querying rethinkdb: %s", reql)
+    page_ = reql.run()
+    if not page_:
+        flask.abort(404)
+    outlinks_ = page_.get("outlinks")
+    if outlinks_ is None and "outlink_counts" in page_:
+        reql = rr.table("outlinks").get(page_id).without(
+                "id", "site_id", "job_id")
+        logging.debug("querying rethinkdb: %s", reql)
+        outlinks_ = reql.run()
+    return flask.jsonify(outlinks=outlinks_)
+
 @app.route("/api/pages/<page_id>/yaml")
 @app.route("/api/page/<page_id>/yaml")
 def page_yaml(page_id):
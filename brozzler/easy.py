@@ -57,6 +57,8 @@ def _build_arg_parser(argv=None):
 
     # common args
     brozzler.cli.add_rethinkdb_options(arg_parser)
+    # warcprox, pywb and brozzler-dashboard still use rethinkdb
+    brozzler.cli.add_sqlite_options(arg_parser)
     arg_parser.add_argument(
             '-d', '--warcs-dir', dest='warcs_dir', default='./warcs',
             help='where to write warcs')
@@ -134,10 +136,12 @@ class BrozzlerEasyController:
                 brozzler.dashboard.app, ThreadingWSGIServer)
 
     def _init_brozzler_worker(self, args):
-        rr = doublethink.Rethinker(
-                args.rethinkdb_servers.split(","), args.rethinkdb_db)
-        frontier = brozzler.RethinkDbFrontier(rr)
-        service_registry = doublethink.ServiceRegistry(rr)
+        frontier = brozzler.cli.open_frontier(args)
+        if args.sqlite_db:
+            service_registry = None
+        else:
+            service_registry = doublethink.ServiceRegistry(frontier.rr)
+        self.housekeeper = brozzler.frontier.Housekeeper(frontier)
         worker = brozzler.worker.BrozzlerWorker(
                 frontier, service_registry, chrome_exe=args.chrome_exe,
                 proxy='%s:%s' % self.warcprox_controller.proxy.server_address,
@@ -190,6 +194,7 @@ class BrozzlerEasyController:
         # XXX wait til fully started?
         self.logger.info('starting brozzler-worker')
         self.brozzler_worker.start()
+        self.housekeeper.start()
 
         self.logger.info(
                 'starting pywb at %s:%s', *self.pywb_httpd.server_address)
@@ -205,6 +210,7 @@ class BrozzlerEasyController:
         self.dashboard_httpd.shutdown()
 
         self.logger.info('shutting down brozzler-worker')
+        self.housekeeper.stop()
         self.brozzler_worker.shutdown_now()
         # brozzler-worker is fully shut down at this point
 
@@ -1,5 +1,7 @@
 '''
-brozzler/frontier.py - RethinkDbFrontier manages crawl jobs, sites and pages
+brozzler/frontier.py - the frontier manages crawl jobs, sites and pages;
+Frontier is the backend-independent part, RethinkDbFrontier stores them in
+rethinkdb
 
 Copyright (C) 2014-2017 Internet Archive
 
@@ -16,124 +18,335 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
+import collections
+import hashlib
 import logging
 import brozzler
+import brozzler.canon
+import math
 import random
+import threading
 import time
 import datetime
 import rethinkdb as r
 import doublethink
-import urlcanon
+import uuid
+import zlib
 
 class UnexpectedDbResult(Exception):
     pass
 
-class RethinkDbFrontier:
+def _merge_page(page_id, old_page, new_page):
+    '''
+    Insert conflict resolution function used when scheduling outlinks. Runs on
+    the rethinkdb server when a page being scheduled already exists: bumps the
+    priority of the existing page and adds any new hashtags, leaving everything
+    else alone.
+    '''
+    return r.branch(
+            new_page.has_fields("hashtags"),
+            old_page.merge({
+                "priority": old_page["priority"] + new_page["priority"],
+                "hashtags": old_page["hashtags"].default([]).set_union(
+                    new_page["hashtags"])}),
+            old_page.merge({
+                "priority": old_page["priority"] + new_page["priority"]}))
+
+def _add_counters(counters, deltas):
+    '''
+    Returns a copy of the dict `counters` with `deltas` added. Values of
+    `deltas` are numbers, or dicts of deltas for nested counters.
+    '''
+    result = dict(counters or {})
+    for k, delta in deltas.items():
+        if isinstance(delta, dict):
+            result[k] = _add_counters(result.get(k), delta)
+        else:
+            result[k] = (result.get(k) or 0) + delta
+    return result
+
+def _lease_host(host_id, old_host, new_host):
+    '''
+    Insert conflict resolution function used when leasing a host. Runs on the
+    rethinkdb server: takes the lease if the host is available, otherwise
+    leaves the host alone.
+    '''
+    now = new_host["leased_at"]
+    return r.branch(
+            ((old_host["lease"].default(None) == None)
+                | (old_host["lease_expires"].default(r.epoch_time(0))
+                    <= now))
+            & (old_host["available_at"].default(r.epoch_time(0)) <= now),
+            new_host, old_host)
+
+def _reql_claim_expired(row, stale_claim_seconds):
+    '''
+    Builds a rethinkdb expression that is true if site `row` is not claimed,
+    or if its claim has expired.
+    '''
+    return (row["claimed"] != True) | (
+            row["claim_expires"].default(
+                row["last_claimed"] + stale_claim_seconds) < r.now())
+
+def _reql_add_counters(row, deltas):
+    '''Like `_add_counters` but builds a rethinkdb update expression.'''
+    return {
+        k: _reql_add_counters(row[k], delta) if isinstance(delta, dict)
+            else row[k].default(0) + delta
+        for k, delta in deltas.items()}
+
+class SeenPages:
+    '''
+    Record of the pages of a site that have been scheduled, kept by the worker
+    while it has the site claimed, so that scheduling outlinks doesn't have to
+    look up or write pages that can be known not to need it. Consists of:
+
+    - a scalable Bloom filter of the ids of all pages scheduled, which can
+      tell for sure that a page has never been scheduled, but only if it has
+      seen every page scheduled for the site (`complete`)
+    - an exact LRU set of ids of pages recently brozzled, whose priority is
+      no longer of any interest
+
+    The Bloom filter is persisted in the "seen_pages" table, keyed by site id
+    (`Frontier.save_seen_pages`, `Frontier.load_seen_pages`), so that the next
+    worker to claim the site can pick up where this one left off. It's kept
+    off the site document, which is read and written much more often.
+    '''
+    LRU_SIZE = 10000
+    INITIAL_CAPACITY = 1000
+    ERROR_RATE = 0.01
+    # a filter that won't compress smaller than this is not persisted
+    MAX_PERSISTED_BYTES = 1024 * 1024
+
+    def __init__(self, complete=False):
+        self.complete = complete
+        self._layers = []  # [{"capacity", "count", "k", "bits"}, ...]
+        self._brozzled = collections.OrderedDict()
+
+    @classmethod
+    def from_dict(cls, d):
+        '''
+        Returns `SeenPages` restored from `d`, as returned by `to_dict`, or an
+        incomplete one if `d` is None.
+        '''
+        seen = cls()
+        if d:
+            seen.complete = d.get("complete", False)
+            for layer in d.get("layers", []):
+                seen._layers.append({
+                    "capacity": layer["capacity"], "count": layer["count"],
+                    "k": layer["k"],
+                    "bits": bytearray(zlib.decompress(layer["bits"]))})
+        return seen
+
+    def to_dict(self):
+        '''
+        Returns compact representation of the Bloom filter, suitable for
+        storing in the "seen_pages" table, or None if it's too big to
+        persist.
+        '''
+        layers = [{
+                "capacity": layer["capacity"], "count": layer["count"],
+                "k": layer["k"], "bits": zlib.compress(bytes(layer["bits"]))}
+            for layer in self._layers]
+        if sum(len(layer["bits"]) for layer in layers) > (
+                self.MAX_PERSISTED_BYTES):
+            return None
+        return {"complete": self.complete, "layers": layers}
+
+    def _positions(self, page_id, layer):
+        digest = hashlib.sha1(page_id.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        m = len(layer["bits"]) * 8
+        return [(h1 + i * h2) % m for i in range(layer["k"])]
+
+    def _add_layer(self):
+        # each layer is 4x bigger than the last, with a lower error rate, so
+        # that the overall false positive rate stays below ERROR_RATE
+        n = len(self._layers)
+        capacity = self.INITIAL_CAPACITY * 4 ** n
+        error_rate = self.ERROR_RATE * 0.5 ** (n + 1)
+        m = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        k = max(1, int(round(m / capacity * math.log(2))))
+        self._layers.append({
+            "capacity": capacity, "count": 0, "k": k,
+            "bits": bytearray((m + 7) // 8)})
+
+    def __contains__(self, page_id):
+        '''
+        Returns True if the page has probably been scheduled, False if it
+        definitely has not (as far as this filter has seen).
+        '''
+        for layer in self._layers:
+            if all(layer["bits"][i >> 3] & (1 << (i & 7))
+                   for i in self._positions(page_id, layer)):
+                return True
+        return False
+
+    def add(self, page_id):
+        if page_id in self:
+            return
+        if not self._layers or (
+                self._layers[-1]["count"] >= self._layers[-1]["capacity"]):
+            self._add_layer()
+        layer = self._layers[-1]
+        for i in self._positions(page_id, layer):
+            layer["bits"][i >> 3] |= 1 << (i & 7)
+        layer["count"] += 1
+
+    def add_brozzled(self, page_id):
+        self.add(page_id)
+        self._brozzled[page_id] = True
+        self._brozzled.move_to_end(page_id)
+        if len(self._brozzled) > self.LRU_SIZE:
+            self._brozzled.popitem(last=False)
+
+    def is_brozzled(self, page_id):
+        '''Returns True if the page is known to have been brozzled.'''
+        return page_id in self._brozzled
+
+class Frontier:
+    '''
+    Manages crawl jobs, sites and pages. This class implements the crawl logic
+    that doesn't depend on how the frontier is stored. Subclasses implement the
+    storage-specific methods, which raise `NotImplementedError` here. See
+    `RethinkDbFrontier` and `brozzler.sqlite.SqliteFrontier`.
+
+    Subclasses set `self.rr` to the object that `brozzler.Job`,
+    `brozzler.Site` and `brozzler.Page` are constructed with and persisted
+    through: a `doublethink.Rethinker`, or a document store as described in
+    `brozzler.model.Document`.
+    '''
     logger = logging.getLogger(__module__ + "." + __qualname__)
 
-    def __init__(self, rr, shards=None, replicas=None):
-        self.rr = rr
-        self.shards = shards or len(rr.servers)
-        self.replicas = replicas or min(len(rr.servers), 3)
-        self._ensure_db()
+    # max number of pages to insert/update at once when scheduling outlinks
+    SCHEDULE_CHUNK_SIZE = 500
 
-    def _ensure_db(self):
-        dbs = self.rr.db_list().run()
-        if not self.rr.dbname in dbs:
-            self.logger.info(
-                    "creating rethinkdb database %s", repr(self.rr.dbname))
-            self.rr.db_create(self.rr.dbname).run()
-        tables = self.rr.table_list().run()
-        if not "sites" in tables:
-            self.logger.info(
-                    "creating rethinkdb table 'sites' in database %s",
-                    repr(self.rr.dbname))
-            self.rr.table_create(
-                    "sites", shards=self.shards, replicas=self.replicas).run()
-            self.rr.table("sites").index_create("sites_last_disclaimed", [
-                r.row["status"], r.row["last_disclaimed"]]).run()
-            self.rr.table("sites").index_create("job_id").run()
-        if not "pages" in tables:
-            self.logger.info(
-                    "creating rethinkdb table 'pages' in database %s",
-                    repr(self.rr.dbname))
-            self.rr.table_create(
-                    "pages", shards=self.shards, replicas=self.replicas).run()
-            self.rr.table("pages").index_create("priority_by_site", [
-                r.row["site_id"], r.row["brozzle_count"],
-                r.row["claimed"], r.row["priority"]]).run()
-            # this index is for displaying pages in a sensible order in the web
-            # console
-            self.rr.table("pages").index_create("least_hops", [
-                r.row["site_id"], r.row["brozzle_count"],
-                r.row["hops_from_seed"]]).run()
-        if not "jobs" in tables:
-            self.logger.info(
-                    "creating rethinkdb table 'jobs' in database %s",
-                    repr(self.rr.dbname))
-            self.rr.table_create(
-                    "jobs", shards=self.shards, replicas=self.replicas).run()
+    # site claims are leases, renewed by the worker brozzling the site every
+    # heartbeat (see `renew_claims`), and presumed to have been abandoned,
+    # because the worker died, if not renewed for this long
+    CLAIM_LEASE_SECONDS = 60
 
-    def _vet_result(self, result, **kwargs):
-        # self.logger.debug("vetting expected=%s result=%s", kwargs, result)
-        # {'replaced': 0, 'errors': 0, 'skipped': 0, 'inserted': 1, 'deleted': 0, 'generated_keys': ['292859c1-4926-4b27-9d87-b2c367667058'], 'unchanged': 0}
-        for k in [
-                "replaced", "errors", "skipped", "inserted", "deleted",
-                "unchanged"]:
-            if k in kwargs:
-                expected = kwargs[k]
-            else:
-                expected = 0
-            if isinstance(expected, list):
-                if result.get(k) not in kwargs[k]:
-                    raise UnexpectedDbResult("expected {} to be one of {} in {}".format(repr(k), expected, result))
-            else:
-                if result.get(k) != expected:
-                    raise UnexpectedDbResult("expected {} to be {} in {}".format(repr(k), expected, result))
+    # claims made without a lease, by older versions of brozzler, are presumed
+    # to have been abandoned after this long
+    STALE_CLAIM_SECONDS = 60 * 60
+
+    # number of pages read at a time by `job_snapshot`
+    EXPORT_BATCH_SIZE = 1000
+
+    # a host lease that isn't released is presumed to have been abandoned
+    # after this long, which should be longer than brozzling a page can take
+    HOST_LEASE_SECONDS = 30 * 60
+
+    # a site whose host is being brozzled by another browser is set aside for
+    # this long (or until the crawl delay has elapsed, if that's later)
+    HOST_BUSY_RETRY_SECONDS = 10
+
+    # if True, outlink decisions are kept in the "outlinks" table instead of
+    # on the page (see `scope_and_schedule_outlinks`)
+    separate_outlinks = False
+
+    # fields of sites and jobs that may be changed while a site is being
+    # brozzled, and are pushed to the brozzling thread by `control_changes`
+    CONTROL_FIELDS = (
+            "stop_requested", "time_limit", "ignore_robots", "user_agent",
+            "warcprox_meta", "behavior_parameters", "username", "password")
 
     def claim_site(self, worker_id):
-        # XXX keep track of aggregate priority and prioritize sites accordingly?
         while True:
-            result = (
-                    self.rr.table("sites", read_mode="majority")
-                    .between(
-                        ["ACTIVE", r.minval], ["ACTIVE", r.maxval],
-                        index="sites_last_disclaimed")
-                    .order_by(index="sites_last_disclaimed")
-                    .filter((r.row["claimed"] != True) | (
-                        r.row["last_claimed"] < r.now() - 60*60))
-                    .limit(1)
-                    .update(
-                        # try to avoid a race condition resulting in multiple
-                        # brozzler-workers claiming the same site
-                        # see https://github.com/rethinkdb/rethinkdb/issues/3235#issuecomment-60283038
-                        r.branch((r.row["claimed"] != True) | (
-                            r.row["last_claimed"] < r.now() - 60*60), {
-                                "claimed": True, "last_claimed_by": worker_id,
-                                "last_claimed": doublethink.utcnow()}, {}),
-                            return_changes=True)).run()
-            self._vet_result(result, replaced=[0,1], unchanged=[0,1])
-            if result["replaced"] == 1:
-                if result["changes"][0]["old_val"]["claimed"]:
-                    self.logger.warn(
-                            "re-claimed site that was still marked 'claimed' "
-                            "because it was last claimed a long time ago "
-                            "at %s, and presumably some error stopped it from "
-                            "being disclaimed",
-                            result["changes"][0]["old_val"]["last_claimed"])
-                site = brozzler.Site(self.rr, result["changes"][0]["new_val"])
-            else:
+            sites = self._claim_sites(worker_id, 1)
+            if not sites:
                 raise brozzler.NothingToClaim
-            # XXX This is the only place we enforce time limit for now. Worker
-            # loop should probably check time limit. Maybe frontier needs a
-            # housekeeping thread to ensure that time limits get enforced in a
-            # timely fashion.
-            if not self._enforce_time_limit(site):
-                return site
+            # time limits are also enforced by the worker brozzling the site,
+            # and for unclaimed sites by housekeep()
+            if not self._enforce_time_limit(sites[0]):
+                return sites[0]
+
+    def claim_sites(self, worker_id, n):
+        '''
+        Claims up to `n` active sites for `worker_id` in one query. Claimed
+        sites that are over their time limit are finished instead of being
+        returned.
+
+        Returns:
+            list of brozzler.Site, possibly empty
+        '''
+        sites = self._claim_sites(worker_id, n)
+        return [site for site in sites if not self._enforce_time_limit(site)]
+
+    def _claim_sites(self, worker_id, n):
+        '''
+        Claims up to `n` active sites for `worker_id`, without checking their
+        time limits. Sites whose claim has expired (see `CLAIM_LEASE_SECONDS`)
+        can be claimed. The claim expires at `claim_expires` unless renewed.
+
+        Returns:
+            list of brozzler.Site, empty if there is no site to claim
+        '''
+        raise NotImplementedError
+
+    def renew_claims(self, worker_id, site_ids):
+        '''
+        Extends the claims of `worker_id` on the sites with ids `site_ids` by
+        `CLAIM_LEASE_SECONDS`. Sites no longer claimed by `worker_id` are left
+        alone.
+
+        Returns:
+            int: number of claims renewed
+        '''
+        raise NotImplementedError
+
+    def virtual_time(self):
+        '''
+        Returns the current virtual time of the site scheduler, which is the
+        lowest `virtual_time` of any active site, or 0 if there are none.
+        '''
+        raise NotImplementedError
+
+    def _increment_site_counters(self, site, deltas):
+        '''
+        Atomically adds `deltas` to counter fields of `site` in the frontier,
+        and to `site` itself (see `_mirror_site_counters`). Numeric deltas
+        apply to top-level numeric fields like `queued_priority`, missing
+        fields counting as 0. Dict deltas apply to dicts of counters like
+        `page_counts`, but only if the site already has the field, since
+        sites from before the counters were introduced would get
+        meaningless partial counts.
+        '''
+        raise NotImplementedError
+
+    def _mirror_site_counters(self, site, deltas):
+        '''
+        Applies `deltas` to `site` without marking anything as changed, so
+        that saving `site` does not overwrite the counters in the frontier.
+        '''
+        for field, delta in deltas.items():
+            if isinstance(delta, dict):
+                if field not in site:
+                    continue
+                value = doublethink.orm.watch(
+                        _add_counters(site[field], delta),
+                        callback=site._updated, field=field)
+            else:
+                value = (site.get(field) or 0) + delta
+            dict.__setitem__(site, field, value)
+
+    def _charge_site(self, site):
+        '''
+        Advances the virtual time of `site` according to how long it has been
+        claimed. Sites are claimed in order of virtual time (stride
+        scheduling), so a site with a bigger share, and a deeper queue of
+        pages, gets claimed more often.
+        '''
+        elapsed = (doublethink.utcnow() - site.last_claimed).total_seconds()
+        share = site.share if site.share is not None else 1.0
+        backlog = 1 + math.log10(1 + max(0, site.queued_priority or 0))
+        site.virtual_time = (site.virtual_time or 0) + (
+                max(elapsed, 1.0) / (max(share, 1e-9) * backlog))
 
     def _enforce_time_limit(self, site):
-        if (site.time_limit and site.time_limit > 0
-                and site.elapsed() > site.time_limit):
+        if site.over_time_limit():
             self.logger.debug(
                     "site FINISHED_TIME_LIMIT! time_limit=%s elapsed=%s %s",
                     site.time_limit, site.elapsed(), site)
@@ -143,33 +356,97 @@ class RethinkDbFrontier:
             return False
 
     def claim_page(self, site, worker_id):
-        # ignores the "claimed" field of the page, because only one
-        # brozzler-worker can be working on a site at a time, and that would
-        # have to be the worker calling this method, so if something is claimed
-        # already, it must have been left that way because of some error
-        result = self.rr.table("pages").between(
-                [site.id, 0, r.minval, r.minval],
-                [site.id, 0, r.maxval, r.maxval],
-                index="priority_by_site").order_by(
-                        index=r.desc("priority_by_site")).limit(
-                                1).update({
-                                    "claimed":True,
-                                    "last_claimed_by":worker_id},
-                                    return_changes="always").run()
-        self._vet_result(result, unchanged=[0,1], replaced=[0,1])
-        if result["unchanged"] == 0 and result["replaced"] == 0:
+        '''
+        Claims the highest priority page of `site` that has not been brozzled.
+
+        Returns:
+            brozzler.Page
+        Raises:
+            brozzler.NothingToClaim: if there are no pages left to brozzle
+        '''
+        pages = self.claim_pages(site, worker_id, 1)
+        if not pages:
             raise brozzler.NothingToClaim
-        else:
-            return brozzler.Page(self.rr, result["changes"][0]["new_val"])
+        return pages[0]
+
+    def claim_pages(self, site, worker_id, n):
+        '''
+        Claims up to `n` of the highest priority pages of `site` that have not
+        been brozzled, in one query.
+
+        Returns:
+            list of brozzler.Page, highest priority first, empty if there are
+            no pages left to brozzle
+        '''
+        raise NotImplementedError
+
+    def unclaim_pages(self, pages):
+        '''Hands back claimed pages that were not brozzled.'''
+        raise NotImplementedError
+
+    def lease_host(self, host):
+        '''
+        Leases `host`, so that no other browser in the cluster brozzles a page
+        from it until the lease is released with `release_host`, or expires
+        after `HOST_LEASE_SECONDS`.
+
+        The host document keeps the expiry of the lease in `lease_expires`,
+        and the time the next page may be fetched from the host, according to
+        the crawl delay, in `available_at`.
+
+        Returns:
+            str: id of the lease, to pass to `release_host`
+        Raises:
+            brozzler.HostBusy: if the host is leased by someone else, or
+                its crawl delay hasn't elapsed since the last lease was
+                released
+        '''
+        raise NotImplementedError
+
+    def _host_busy(self, host_doc, now):
+        '''
+        Returns a `brozzler.HostBusy` for host `host_doc`, which could not be
+        leased at `now`. The host is worth trying again once its crawl delay
+        has elapsed, but not before `HOST_BUSY_RETRY_SECONDS` from now. The
+        lease expiry doesn't count, the lease is normally released long
+        before it expires.
+        '''
+        available_at = now + datetime.timedelta(
+                seconds=self.HOST_BUSY_RETRY_SECONDS)
+        if host_doc.get("available_at"):
+            available_at = max(available_at, host_doc["available_at"])
+        return brozzler.HostBusy(host_doc["id"], available_at)
+
+    def release_host(self, host, lease, delay=0):
+        '''
+        Releases lease `lease` on `host`, making the host available again
+        after `delay` seconds (the crawl delay). Does nothing if the lease has
+        expired and the host has been leased again since.
+        '''
+        raise NotImplementedError
 
     def has_outstanding_pages(self, site):
-        results_iter = self.rr.table("pages").between(
-                [site.id, 0, r.minval, r.minval],
-                [site.id, 0, r.maxval, r.maxval],
-                index="priority_by_site").limit(1).run()
-        return len(list(results_iter)) > 0
+        '''Returns True if `site` has any pages left to brozzle.'''
+        # the counter can only be an undercount, so only trust it if positive
+        if site.page_counts and site.page_counts.get("queued", 0) > 0:
+            return True
+        return self._has_unbrozzled_pages(site)
+
+    def _has_unbrozzled_pages(self, site):
+        '''
+        Returns True if `site` has any pages left to brozzle, according to
+        the pages themselves.
+        '''
+        raise NotImplementedError
 
     def completed_page(self, site, page):
+        if not page.brozzle_count:
+            page_counts = {"queued": -1, "brozzled": 1}
+            if page.blocked_by_robots:
+                page_counts["blocked"] = 1
+            self._increment_site_counters(site, {
+                "queued_priority": -page.priority,
+                "page_counts": page_counts})
         page.brozzle_count += 1
         page.claimed = False
         # XXX set priority?
@@ -179,9 +456,8 @@ class RethinkDbFrontier:
             site.save()
 
     def active_jobs(self):
-        results = self.rr.table("jobs").filter({"status":"ACTIVE"}).run()
-        for result in results:
-            yield brozzler.Job(self.rr, result)
+        '''Returns iterator of active brozzler.Job.'''
+        raise NotImplementedError
 
     def honor_stop_request(self, site):
         """Raises brozzler.CrawlStopped if stop has been requested."""
@@ -198,6 +474,42 @@ class RethinkDbFrontier:
                 self.logger.info("stop requested for job %s", site.job_id)
                 raise brozzler.CrawlStopped
 
+    def control_changes(self, site_ids, job_ids, wait=1.0):
+        '''
+        Generator of changes to `CONTROL_FIELDS` of the sites and jobs with
+        the given ids. Their current values are generated first. This
+        implementation polls the frontier every `wait` seconds; subclasses
+        can do better.
+
+        Args:
+            site_ids: ids of sites to watch
+            job_ids: ids of jobs to watch
+            wait: max number of seconds to block without generating anything
+
+        Yields:
+            `(table, doc)`, where `table` is "sites" or "jobs" and `doc` is a
+            dict with "id" and the `CONTROL_FIELDS` that are set, or None if
+            nothing has changed for `wait` seconds, to give the caller a
+            chance to stop iterating
+        '''
+        last = {}
+        while True:
+            changed = False
+            for cls, ids in ((brozzler.Site, site_ids), (brozzler.Job, job_ids)):
+                for id in ids:
+                    doc = cls.load(self.rr, id)
+                    if not doc:
+                        continue
+                    doc = {k: doc[k] for k in ("id",) + self.CONTROL_FIELDS
+                           if k in doc}
+                    if last.get((cls.table, id)) != doc:
+                        last[(cls.table, id)] = doc
+                        changed = True
+                        yield cls.table, doc
+            if not changed:
+                yield None
+            time.sleep(wait)
+
     def _maybe_finish_job(self, job_id):
         """Returns True if job is finished."""
         job = brozzler.Job.load(self.rr, job_id)
@@ -207,14 +519,22 @@ class RethinkDbFrontier:
             self.logger.warn("%s is already %s", job, job.status)
             return True
 
-        results = self.rr.table("sites").get_all(job_id, index="job_id").run()
-        n = 0
-        for result in results:
-            site = brozzler.Site(self.rr, result)
-            if not site.status.startswith("FINISH"):
-                results.close()
+        if job.site_counts is not None:
+            n = sum(job.site_counts.values())
+            if any(count > 0 for status, count in job.site_counts.items()
+                   if not status.startswith("FINISH")):
                 return False
-            n += 1
+        else:
+            # job from before site_counts were tracked
+            n = 0
+            for site in self.job_sites(job_id):
+                if not site.status.startswith("FINISH"):
+                    return False
+                n += 1
+
+        if n == 0:
+            # sites not saved yet?
+            return False
 
         self.logger.info(
                 "all %s sites finished, job %s is FINISHED!", n, job.id)
@@ -222,21 +542,89 @@ class RethinkDbFrontier:
         job.save()
         return True
 
+    def _adjust_job_site_counts(self, job_id, deltas):
+        '''
+        Atomically adds `deltas` to the job's `site_counts`, the number of
+        sites of the job by status. Jobs created before `site_counts` were
+        tracked are left alone.
+
+        Args:
+            job_id: id of the job
+            deltas (dict): maps site status to change in count
+        '''
+        raise NotImplementedError
+
+    def _site_status_changed(self, site, old_status):
+        if site.job_id and site.status != old_status:
+            deltas = {site.status: 1}
+            if old_status:
+                deltas[old_status] = -1
+            self._adjust_job_site_counts(site.job_id, deltas)
+
     def finished(self, site, status):
         self.logger.info("%s %s", status, site)
+        old_status = site.status
         site.status = status
         site.claimed = False
         site.last_disclaimed = doublethink.utcnow()
         site.starts_and_stops[-1]["stop"] = doublethink.utcnow()
         site.save()
+        self._site_finished(site, old_status)
+
+    def _site_finished(self, site, old_status):
+        # of no more use
+        self._delete_seen_pages(site.id)
+        self._site_status_changed(site, old_status)
         if site.job_id:
             self._maybe_finish_job(site.job_id)
 
-    def disclaim_site(self, site, page=None):
+    def _finish_if_unclaimed(self, site, status):
+        '''
+        Like `finished`, for a site read earlier as active and unclaimed. Does
+        nothing if a worker has claimed the site in the meantime (or its
+        status has changed), which is checked in the same atomic update that
+        finishes the site.
+
+        Returns:
+            bool: True if the site was finished
+        '''
+        doc = self._update_if_unclaimed(site.id, status)
+        if not doc:
+            self.logger.info(
+                    "not finishing %s, claimed in the meantime", site)
+            return False
+        self.logger.info("%s %s", status, site)
+        self._site_finished(brozzler.Site(self.rr, doc), "ACTIVE")
+        return True
+
+    def _update_if_unclaimed(self, site_id, status):
+        '''
+        If site `site_id` is active and not claimed, sets its status to
+        `status` and ends its current start/stop period, atomically.
+
+        Returns:
+            dict: the updated site document, or None if the site was left
+            alone
+        '''
+        raise NotImplementedError
+
+    def disclaim_site(self, site, page=None, held_pages=None):
+        '''
+        Args:
+            site (brozzler.Site): the site to disclaim
+            page (brozzler.Page): the page being brozzled when brozzling of
+                the site stopped, if any
+            held_pages (list): pages claimed along with others by
+                `claim_pages` that were not brozzled
+        '''
         self.logger.info("disclaiming %s", site)
+        if held_pages:
+            self.unclaim_pages(held_pages)
+        self._charge_site(site)
         site.claimed = False
         site.last_disclaimed = doublethink.utcnow()
-        if not page and not self.has_outstanding_pages(site):
+        if (not page and site.status == "ACTIVE"
+                and not self.has_outstanding_pages(site)):
             self.finished(site, "FINISHED")
         else:
             site.save()
@@ -244,16 +632,110 @@ class RethinkDbFrontier:
             page.claimed = False
             page.save()
 
+    def housekeep(self):
+        '''
+        Does frontier maintenance that otherwise only happens when a site
+        happens to get claimed: releases stale site claims, finishes unclaimed
+        sites that are over their time limit or have no pages left to brozzle,
+        and finishes jobs whose sites are all finished. Claimed sites are left
+        to the worker brozzling them.
+
+        Returns:
+            dict of counts of sites and jobs acted on
+        '''
+        counts = {
+            "stale_claims": self._release_stale_claims(),
+            "time_limit": 0, "no_pages": 0, "site_counts": 0, "jobs": 0}
+        # a worker may claim any of these sites while we look at them, so
+        # they are only finished if they are still unclaimed
+        for site in list(self._unclaimed_active_sites()):
+            if site.over_time_limit():
+                if self._finish_if_unclaimed(site, "FINISHED_TIME_LIMIT"):
+                    counts["time_limit"] += 1
+            elif not self.has_outstanding_pages(site):
+                if self._finish_if_unclaimed(site, "FINISHED"):
+                    counts["no_pages"] += 1
+        for job in list(self.active_jobs()):
+            if self._reconcile_site_counts(job):
+                counts["site_counts"] += 1
+            if self._maybe_finish_job(job.id):
+                counts["jobs"] += 1
+        return counts
+
+    def _reconcile_site_counts(self, job):
+        '''
+        Recomputes the `site_counts` of `job` from its sites. The counts are
+        written separately from the site statuses, so a crash in between
+        leaves them wrong, and the job would never finish. The sites still
+        being added by `brozzler.new_job_bulk` ("INGESTING") can't be
+        counted, their count is kept. The counts are only replaced if they
+        haven't changed since `job` was read; if they have, the next
+        housekeeping pass takes care of it. Jobs from before `site_counts`
+        were tracked are left alone, `_maybe_finish_job` counts their sites.
+
+        Returns:
+            bool: True if the counts were corrected
+        '''
+        if job.site_counts is None:
+            return False
+        counts = self._count_job_sites(job.id)
+        if job.site_counts.get("INGESTING"):
+            counts["INGESTING"] = job.site_counts["INGESTING"]
+        stored = {
+            status: n for status, n in job.site_counts.items() if n}
+        if counts == stored:
+            return False
+        self.logger.warn(
+                "correcting site_counts of %s from %s to %s", job, stored,
+                counts)
+        return self._replace_job_site_counts(
+                job.id, job.site_counts, counts)
+
+    def _count_job_sites(self, job_id):
+        '''Returns dict of the number of sites of job `job_id` by status.'''
+        raise NotImplementedError
+
+    def _replace_job_site_counts(self, job_id, old_counts, new_counts):
+        '''
+        Sets the `site_counts` of job `job_id` to `new_counts`, atomically,
+        if they are still `old_counts`.
+
+        Returns:
+            bool: True if the counts were replaced
+        '''
+        raise NotImplementedError
+
+    def _release_stale_claims(self):
+        '''
+        Marks active sites whose claim has expired as not claimed.
+
+        Returns:
+            number of claims released
+        '''
+        raise NotImplementedError
+
+    def _unclaimed_active_sites(self):
+        '''Returns iterator of active brozzler.Site that are not claimed.'''
+        raise NotImplementedError
+
     def resume_job(self, job):
         job.status = "ACTIVE"
         job.starts_and_stops.append(
                 {"start":doublethink.utcnow(), "stop":None})
         job.save()
+        virtual_time = self.virtual_time()
+        deltas = collections.Counter()
         for site in self.job_sites(job.id):
+            deltas[site.status] -= 1
+            deltas["ACTIVE"] += 1
             site.status = "ACTIVE"
+            site.virtual_time = virtual_time
             site.starts_and_stops.append(
                     {"start":doublethink.utcnow(), "stop":None})
             site.save()
+        deltas = {status: n for status, n in deltas.items() if n}
+        if deltas:
+            self._adjust_job_site_counts(job.id, deltas)
 
     def resume_site(self, site):
         if site.job_id:
@@ -263,24 +745,41 @@ class RethinkDbFrontier:
             job.starts_and_stops.append(
                     {"start":doublethink.utcnow(), "stop":None})
             job.save()
+        old_status = site.status
         site.status = "ACTIVE"
+        site.virtual_time = self.virtual_time()
         site.starts_and_stops.append(
                 {"start":doublethink.utcnow(), "stop":None})
         site.save()
+        self._site_status_changed(site, old_status)
+
+    def scope_and_schedule_outlinks(
+            self, site, parent_page, outlinks, seen=None):
+        '''
+        Schedules the in-scope, robots-permitted `outlinks` of `parent_page`.
 
-    def scope_and_schedule_outlinks(self, site, parent_page, outlinks):
+        Args:
+            site (brozzler.Site): the site
+            parent_page (brozzler.Page): the page the outlinks are from
+            outlinks (list): urls
+            seen (SeenPages): pages of the site seen so far by the caller,
+                if any, used to skip pages known to have been brozzled and to
+                insert pages known to be new without looking them up; updated
+                with the pages scheduled
+        Returns:
+            list of brozzler.Page scheduled, as stored after scheduling
+        '''
         decisions = {"accepted":set(),"blocked":set(),"rejected":set()}
         counts = {"added":0,"updated":0,"rejected":0,"blocked":0}
+        pages = {}  # {page_id: Page, ...}
         for url in outlinks or []:
-            url_for_scoping = urlcanon.semantic(url)
-            url_for_crawling = urlcanon.whatwg(url)
-            hashtag = (url_for_crawling.hash_sign
-                       + url_for_crawling.fragment).decode('utf-8')
-            urlcanon.canon.remove_fragment(url_for_crawling)
+            canon = brozzler.canon.canonicalize(url)
+            url_for_scoping = canon.semantic
+            url_for_crawling = canon.whatwg
+            hashtag = canon.hashtag
             if site.is_in_scope(url_for_scoping, parent_page=parent_page):
                 if brozzler.is_permitted_by_robots(site, str(url_for_crawling)):
-                    if not url_for_scoping.surt().startswith(
-                            site.scope["surt"].encode("utf-8")):
+                    if not canon.surt.startswith(site.compiled_scope().surt):
                         hops_off_surt = parent_page.hops_off_surt + 1
                     else:
                         hops_off_surt = 0
@@ -290,23 +789,19 @@ class RethinkDbFrontier:
                         'hops_from_seed': parent_page.hops_from_seed+1,
                         'via_page_id': parent_page.id,
                         'hops_off_surt': hops_off_surt})
-                    existing_child_page = brozzler.Page.load(
-                            self.rr, new_child_page.id)
-                    if existing_child_page:
-                        existing_child_page.priority += new_child_page.priority
-                        if hashtag and existing_child_page.hashtags:
-                            hashtags = set(existing_child_page.hashtags)
+                    if new_child_page.id in pages:
+                        # same url (modulo fragment) seen earlier in this batch
+                        page = pages[new_child_page.id]
+                        page.priority += new_child_page.priority
+                        if hashtag:
+                            hashtags = set(page.hashtags or [])
                             hashtags.add(hashtag)
-                            existing_child_page.hashtags = list(hashtags)
-                        elif hashtag:
-                            existing_child_page.hashtags = [hashtag]
-                        existing_child_page.save()
+                            page.hashtags = list(hashtags)
                         counts["updated"] += 1
                     else:
                         if hashtag:
                             new_child_page.hashtags = [hashtag,]
-                        new_child_page.save()
-                        counts["added"] += 1
+                        pages[new_child_page.id] = new_child_page
                     decisions["accepted"].add(str(url_for_crawling))
                 else:
                     counts["blocked"] += 1
@@ -315,9 +810,57 @@ class RethinkDbFrontier:
                 counts["rejected"] += 1
                 decisions["rejected"].add(str(url_for_crawling))
 
-        parent_page.outlinks = {}
-        for k in decisions:
-            parent_page.outlinks[k] = list(decisions[k])
+        maybe_new = []
+        new = []
+        for page in pages.values():
+            if seen is None:
+                maybe_new.append(page)
+            elif seen.is_brozzled(page.id):
+                # nothing to gain from bumping its priority
+                counts["updated"] += 1
+            elif seen.complete and page.id not in seen:
+                new.append(page)
+            else:
+                maybe_new.append(page)
+        added, updated = self._schedule_pages(maybe_new)
+        if new:
+            really_added, not_new = self._insert_new_pages(new)
+            if not_new:
+                self.logger.warn(
+                        "%s pages unexpectedly already existed, will no "
+                        "longer trust seen pages filter of %s", len(not_new),
+                        site)
+                seen.complete = False
+            added += really_added
+            updated += not_new
+        if seen is not None:
+            for page in pages.values():
+                seen.add(page.id)
+        counts["added"] += len(added)
+        counts["updated"] += len(updated)
+        queued_priority = sum(page.priority for page in added) + sum(
+                pages[page.id].priority for page in updated
+                if not page.brozzle_count)
+        page_counts = {
+            "queued": counts["added"], "rejected": counts["rejected"],
+            "blocked": counts["blocked"], "hops": {}}
+        for page in added:
+            hops = str(page.hops_from_seed)
+            page_counts["hops"][hops] = page_counts["hops"].get(hops, 0) + 1
+        if queued_priority or any(page_counts.values()):
+            self._increment_site_counters(site, {
+                "queued_priority": queued_priority,
+                "page_counts": page_counts})
+
+        outlinks = {k: list(decisions[k]) for k in decisions}
+        if self.separate_outlinks:
+            # keeps page documents, which are read and written much more
+            # often than outlinks, small
+            self._save_outlinks(parent_page, outlinks)
+            parent_page.outlink_counts = {
+                    k: len(outlinks[k]) for k in outlinks}
+        else:
+            parent_page.outlinks = outlinks
         parent_page.save()
 
         self.logger.info(
@@ -325,6 +868,136 @@ class RethinkDbFrontier:
                 "rejected, %s links blocked by robots from %s",
                 counts["added"], counts["updated"], counts["rejected"],
                 counts["blocked"], parent_page)
+        return added + updated
+
+    def page_outlinks(self, page):
+        '''
+        Returns the outlink decisions for `page`, a dict with "accepted",
+        "blocked" and "rejected" lists of urls, from the page itself or from
+        the "outlinks" table, or None if `page` has not been brozzled.
+        '''
+        if "outlinks" in page:
+            return page.outlinks
+        if "outlink_counts" in page:
+            return self._load_outlinks(page.id)
+        return None
+
+    def load_seen_pages(self, site):
+        '''
+        Returns the `SeenPages` saved for `site` by the last worker to brozzle
+        it, or an incomplete one if there isn't any.
+        '''
+        return SeenPages.from_dict(self._load_seen_pages(site.id))
+
+    def save_seen_pages(self, site, seen):
+        '''
+        Saves `seen` to the "seen_pages" table, for the next worker to brozzle
+        `site`. If the site is no longer active, or the filter is too big to
+        persist, forgets the saved filter instead.
+        '''
+        doc = seen.to_dict() if site.status == "ACTIVE" else None
+        if doc:
+            doc["id"] = site.id
+            self.write_docs("seen_pages", [doc])
+        else:
+            self._delete_seen_pages(site.id)
+
+    def _load_seen_pages(self, site_id):
+        '''
+        Returns the document in the "seen_pages" table for site `site_id`, or
+        None.
+        '''
+        raise NotImplementedError
+
+    def _delete_seen_pages(self, site_id):
+        '''Deletes the document in the "seen_pages" table for `site_id`.'''
+        raise NotImplementedError
+
+    def _save_outlinks(self, page, outlinks):
+        '''
+        Saves `outlinks` to the "outlinks" table, keyed by page id, replacing
+        any earlier outlinks of the page.
+        '''
+        raise NotImplementedError
+
+    def _load_outlinks(self, page_id):
+        '''Returns outlinks of page `page_id` from the "outlinks" table.'''
+        raise NotImplementedError
+
+    def _outlinks_docs(self, page_ids):
+        '''
+        Returns list of the documents in the "outlinks" table belonging to the
+        pages with ids `page_ids`, fetched in one query.
+        '''
+        raise NotImplementedError
+
+    def job_snapshot(self, job_id):
+        '''
+        Generates the full frontier state of job `job_id`, as (table, doc)
+        tuples: the job, its sites, their pages and any outlinks stored
+        separately. Pages are read and outlinks fetched `EXPORT_BATCH_SIZE` at
+        a time, so memory use does not depend on the size of the crawl. See
+        `brozzler.snapshot`.
+        '''
+        job = brozzler.Job.load(self.rr, job_id)
+        if not job:
+            return
+        yield "jobs", dict(job)
+        for site in self.job_sites(job_id):
+            yield "sites", dict(site)
+            batch = []
+            for page in self.site_pages(site.id):
+                batch.append(page)
+                if len(batch) >= self.EXPORT_BATCH_SIZE:
+                    yield from self._page_batch_snapshot(batch)
+                    batch = []
+            yield from self._page_batch_snapshot(batch)
+
+    def _page_batch_snapshot(self, pages):
+        for page in pages:
+            yield "pages", dict(page)
+        ids = [page.id for page in pages if "outlink_counts" in page]
+        if ids:
+            for doc in self._outlinks_docs(ids):
+                yield "outlinks", doc
+
+    def write_docs(self, table, docs):
+        '''
+        Writes `docs` to `table` in one bulk operation, replacing any
+        documents with the same ids, so that writing the same docs twice
+        is harmless. Used for restoring snapshots and for bulk ingestion of
+        new sites.
+
+        Returns:
+            int: number of documents written
+        '''
+        raise NotImplementedError
+
+    def _schedule_pages(self, pages):
+        '''
+        Inserts the new pages in `pages` and, for pages that already exist,
+        adds their priority to the existing priority and their hashtags to the
+        existing hashtags. Implementations should write the pages in chunks of
+        `SCHEDULE_CHUNK_SIZE`.
+
+        Returns:
+            tuple (added, updated) of lists of brozzler.Page, as stored after
+            scheduling
+        '''
+        raise NotImplementedError
+
+    def _insert_new_pages(self, pages):
+        '''
+        Like `_schedule_pages`, but for pages believed to be new, which are
+        inserted without looking for existing pages first. Pages that turn out
+        to exist anyway are updated as `_schedule_pages` would do.
+
+        Returns:
+            tuple (added, updated) of lists of brozzler.Page, as stored after
+            scheduling; when in doubt, pages are reported as updated rather
+            than added
+        '''
+        raise NotImplementedError
 
     def reached_limit(self, site, e):
         self.logger.info("reached_limit site=%s e=%s", site, e)
@@ -339,9 +1012,491 @@ class RethinkDbFrontier:
             self.finished(site, "FINISHED_REACHED_LIMIT")
 
     def job_sites(self, job_id):
-        results = self.rr.table('sites').get_all(job_id, index="job_id").run()
+        '''Returns iterator of brozzler.Site belonging to job `job_id`.'''
+        raise NotImplementedError
+
+    def seed_page(self, site_id):
+        '''Returns the seed brozzler.Page of site `site_id`, or None.'''
+        raise NotImplementedError
+
+    def site_pages(self, site_id, brozzled=None):
+        '''
+        Args:
+            site_id (str or int):
+            brozzled (bool): if true, results include only pages that have
+                been brozzled at least once; if false, only pages that have
+                not been brozzled; and if None (the default), all pages
+        Returns:
+            iterator of brozzler.Page
+        '''
+        raise NotImplementedError
+
+class Housekeeper:
+    '''
+    Runs `Frontier.housekeep()` every `interval` seconds in a background
+    thread. Only one is needed per crawl cluster, see
+    `brozzler-housekeeper`.
+    '''
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, frontier, interval=60.0):
+        self.frontier = frontier
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+                target=self.run, name="HousekeeperThread", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run(self):
+        self.logger.info(
+                "frontier housekeeping every %s seconds", self.interval)
+        while not self._stop.is_set():
+            try:
+                counts = self.frontier.housekeep()
+                if any(counts.values()):
+                    self.logger.info("housekeeping: %s", counts)
+            except:
+                self.logger.error(
+                        "unexpected exception doing housekeeping",
+                        exc_info=True)
+            self._stop.wait(self.interval)
+
+class RethinkDbFrontier(Frontier):
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(
+            self, rr, shards=None, replicas=None, separate_outlinks=False):
+        self.rr = rr
+        self.shards = shards or len(rr.servers)
+        self.replicas = replicas or min(len(rr.servers), 3)
+        self.separate_outlinks = separate_outlinks
+        self._ensure_db()
+
+    def _ensure_db(self):
+        dbs = self.rr.db_list().run()
+        if not self.rr.dbname in dbs:
+            self.logger.info(
+                    "creating rethinkdb database %s", repr(self.rr.dbname))
+            self.rr.db_create(self.rr.dbname).run()
+        tables = self.rr.table_list().run()
+        if not "sites" in tables:
+            self.logger.info(
+                    "creating rethinkdb table 'sites' in database %s",
+                    repr(self.rr.dbname))
+            self.rr.table_create(
+                    "sites", shards=self.shards, replicas=self.replicas).run()
+            self.rr.table("sites").index_create("sites_last_disclaimed", [
+                r.row["status"], r.row["last_disclaimed"]]).run()
+            self.rr.table("sites").index_create("job_id").run()
+        if not "sites_virtual_time" in self.rr.table("sites").index_list().run():
+            # added later, so also created on existing tables
+            self.logger.info("creating rethinkdb index 'sites_virtual_time'")
+            self.rr.table("sites").index_create("sites_virtual_time", [
+                r.row["status"], r.row["virtual_time"].default(0)]).run()
+            self.rr.table("sites").index_wait("sites_virtual_time").run()
+        if not "pages" in tables:
+            self.logger.info(
+                    "creating rethinkdb table 'pages' in database %s",
+                    repr(self.rr.dbname))
+            self.rr.table_create(
+                    "pages", shards=self.shards, replicas=self.replicas).run()
+            self.rr.table("pages").index_create("priority_by_site", [
+                r.row["site_id"], r.row["brozzle_count"],
+                r.row["claimed"], r.row["priority"]]).run()
+            # this index is for displaying pages in a sensible order in the web
+            # console
+            self.rr.table("pages").index_create("least_hops", [
+                r.row["site_id"], r.row["brozzle_count"],
+                r.row["hops_from_seed"]]).run()
+        if not "jobs" in tables:
+            self.logger.info(
+                    "creating rethinkdb table 'jobs' in database %s",
+                    repr(self.rr.dbname))
+            self.rr.table_create(
+                    "jobs", shards=self.shards, replicas=self.replicas).run()
+        if not "hosts" in tables:
+            self.logger.info(
+                    "creating rethinkdb table 'hosts' in database %s",
+                    repr(self.rr.dbname))
+            self.rr.table_create(
+                    "hosts", shards=self.shards, replicas=self.replicas).run()
+        if not "outlinks" in tables:
+            self.logger.info(
+                    "creating rethinkdb table 'outlinks' in database %s",
+                    repr(self.rr.dbname))
+            self.rr.table_create(
+                    "outlinks", shards=self.shards,
+                    replicas=self.replicas).run()
+        if not "seen_pages" in tables:
+            self.logger.info(
+                    "creating rethinkdb table 'seen_pages' in database %s",
+                    repr(self.rr.dbname))
+            self.rr.table_create(
+                    "seen_pages", shards=self.shards,
+                    replicas=self.replicas).run()
+
+    def _vet_result(self, result, **kwargs):
+        # self.logger.debug("vetting expected=%s result=%s", kwargs, result)
+        # {'replaced': 0, 'errors': 0, 'skipped': 0, 'inserted': 1, 'deleted': 0, 'generated_keys': ['292859c1-4926-4b27-9d87-b2c367667058'], 'unchanged': 0}
+        for k in [
+                "replaced", "errors", "skipped", "inserted", "deleted",
+                "unchanged"]:
+            if k in kwargs:
+                expected = kwargs[k]
+            else:
+                expected = 0
+            if isinstance(expected, list):
+                if result.get(k) not in kwargs[k]:
+                    raise UnexpectedDbResult("expected {} to be one of {} in {}".format(repr(k), expected, result))
+            else:
+                if result.get(k) != expected:
+                    raise UnexpectedDbResult("expected {} to be {} in {}".format(repr(k), expected, result))
+
+    def _claim_sites(self, worker_id, n):
+        now = doublethink.utcnow()
+        result = (
+                self.rr.table("sites", read_mode="majority")
+                .between(
+                    ["ACTIVE", r.minval], ["ACTIVE", r.maxval],
+                    index="sites_virtual_time")
+                .order_by(index="sites_virtual_time")
+                .filter(
+                    _reql_claim_expired(r.row, self.STALE_CLAIM_SECONDS) & (
+                        r.row["claim_after"].default(r.epoch_time(0))
+                        <= r.now()))
+                .limit(n)
+                .update(
+                    # try to avoid a race condition resulting in multiple
+                    # brozzler-workers claiming the same site
+                    # see https://github.com/rethinkdb/rethinkdb/issues/3235#issuecomment-60283038
+                    r.branch(
+                        _reql_claim_expired(r.row, self.STALE_CLAIM_SECONDS), {
+                            "claimed": True, "last_claimed_by": worker_id,
+                            "last_claimed": now,
+                            "claim_expires": now + datetime.timedelta(
+                                seconds=self.CLAIM_LEASE_SECONDS)}, {}),
+                        return_changes=True)).run()
+        self._vet_result(
+                result, replaced=list(range(n + 1)),
+                unchanged=list(range(n + 1)))
+        sites = []
+        for change in result["changes"]:
+            if change["old_val"]["claimed"]:
+                self.logger.warn(
+                        "re-claimed site that was still marked 'claimed' "
+                        "because its claim expired (last claimed by %s at "
+                        "%s), presumably the worker died or some error "
+                        "stopped it from being disclaimed",
+                        change["old_val"].get("last_claimed_by"),
+                        change["old_val"]["last_claimed"])
+            sites.append(brozzler.Site(self.rr, change["new_val"]))
+        return sites
+
+    def _release_stale_claims(self):
+        result = self.rr.table("sites").between(
+                ["ACTIVE", r.minval], ["ACTIVE", r.maxval],
+                index="sites_virtual_time").filter(
+                    (r.row["claimed"] == True) & _reql_claim_expired(
+                        r.row, self.STALE_CLAIM_SECONDS)).update(
+                            {"claimed": False}).run()
+        if result["errors"]:
+            raise UnexpectedDbResult(
+                    "unexpected result releasing stale claims: %s" % result)
+        return result["replaced"]
+
+    def renew_claims(self, worker_id, site_ids):
+        if not site_ids:
+            return 0
+        result = self.rr.table("sites").get_all(*site_ids).filter(
+                (r.row["claimed"] == True)
+                & (r.row["last_claimed_by"] == worker_id)).update({
+                    "claim_expires": doublethink.utcnow() + datetime.timedelta(
+                        seconds=self.CLAIM_LEASE_SECONDS)}).run()
+        if result["errors"]:
+            raise UnexpectedDbResult(
+                    "unexpected result renewing claims: %s" % result)
+        return result["replaced"] + result["unchanged"]
+
+    def _update_if_unclaimed(self, site_id, status):
+        now = doublethink.utcnow()
+        def finish(site):
+            periods = site["starts_and_stops"]
+            return r.branch(
+                    (site["status"] == "ACTIVE") & (site["claimed"] != True),
+                    {
+                        "status": status, "claimed": False,
+                        "last_disclaimed": now,
+                        "starts_and_stops": periods.change_at(
+                            periods.count() - 1,
+                            periods.nth(-1).merge({"stop": now})),
+                    }, {})
+        result = self.rr.table("sites").get(site_id).update(
+                finish, return_changes=True).run()
+        if result["errors"]:
+            raise UnexpectedDbResult(
+                    "unexpected result finishing site %s: %s" % (
+                        site_id, result))
+        if result["replaced"]:
+            return result["changes"][0]["new_val"]
+        return None
+
+    def _unclaimed_active_sites(self):
+        results = self.rr.table("sites").between(
+                ["ACTIVE", r.minval], ["ACTIVE", r.maxval],
+                index="sites_virtual_time").filter(
+                    r.row["claimed"] != True).run()
+        try:
+            for result in results:
+                yield brozzler.Site(self.rr, result)
+        finally:
+            results.close()
+
+    def virtual_time(self):
+        results = list(self.rr.table("sites").between(
+                ["ACTIVE", r.minval], ["ACTIVE", r.maxval],
+                index="sites_virtual_time").order_by(
+                    index="sites_virtual_time").limit(1).run())
+        if results:
+            return results[0].get("virtual_time") or 0
+        return 0
+
+    def _increment_site_counters(self, site, deltas):
+        # explicit variable, since r.row inside merge() arguments would be
+        # bound to the object being merged into, not to the site
+        def increment(row):
+            update = r.expr({})
+            for field, delta in deltas.items():
+                if isinstance(delta, dict):
+                    update = update.merge(r.branch(
+                        row.has_fields(field),
+                        {field: _reql_add_counters(row[field], delta)}, {}))
+                else:
+                    update = update.merge(
+                            {field: row[field].default(0) + delta})
+            return update
+        result = self.rr.table("sites").get(site.id).update(increment).run()
+        self._vet_result(result, replaced=[0, 1], unchanged=[0, 1])
+        self._mirror_site_counters(site, deltas)
+
+    def control_changes(self, site_ids, job_ids, wait=1.0):
+        # one changefeed for all the sites and jobs
+        fields = ("id",) + self.CONTROL_FIELDS
+        feeds = []
+        for table, ids in (("sites", site_ids), ("jobs", job_ids)):
+            if ids:
+                feeds.append(self.rr.table(table).get_all(*ids).pluck(
+                    *fields).changes(include_initial=True).merge(
+                        {"table": table}))
+        if not feeds:
+            while True:
+                time.sleep(wait)
+                yield None
+        query = feeds[0]
+        if len(feeds) > 1:
+            query = query.union(feeds[1])
+        cursor = query.run()
+        try:
+            while True:
+                try:
+                    change = cursor.next(wait=wait)
+                except r.ReqlTimeoutError:
+                    yield None
+                    continue
+                if change.get("new_val"):
+                    yield change["table"], change["new_val"]
+        finally:
+            cursor.close()
+
+    def _adjust_job_site_counts(self, job_id, deltas):
+        site_counts = {
+            status: r.row["site_counts"][status].default(0) + delta
+            for status, delta in deltas.items()}
+        result = self.rr.table("jobs").get(job_id).update(
+                r.branch(
+                    r.row.has_fields("site_counts"),
+                    {"site_counts": site_counts}, {})).run()
+        self._vet_result(
+                result, replaced=[0, 1], unchanged=[0, 1], skipped=[0, 1])
+
+    def _count_job_sites(self, job_id):
+        return self.rr.table("sites").get_all(
+                job_id, index="job_id").group("status").count().run()
+
+    def _replace_job_site_counts(self, job_id, old_counts, new_counts):
+        result = self.rr.table("jobs").get(job_id).update(
+                lambda job: r.branch(
+                    job["site_counts"] == old_counts,
+                    {"site_counts": r.literal(new_counts)}, {})).run()
+        self._vet_result(result, replaced=[0, 1], unchanged=[0, 1])
+        return result["replaced"] == 1
+
+    def claim_pages(self, site, worker_id, n):
+        # ignores the "claimed" field of the page, because only one
+        # brozzler-worker can be working on a site at a time, and that would
+        # have to be the worker calling this method, so if something is claimed
+        # already, it must have been left that way because of some error
+        result = self.rr.table("pages").between(
+                [site.id, 0, r.minval, r.minval],
+                [site.id, 0, r.maxval, r.maxval],
+                index="priority_by_site").order_by(
+                        index=r.desc("priority_by_site")).limit(
+                                n).update({
+                                    "claimed":True,
+                                    "last_claimed_by":worker_id},
+                                    return_changes="always").run()
+        self._vet_result(
+                result, unchanged=list(range(n + 1)),
+                replaced=list(range(n + 1)))
+        pages = [brozzler.Page(self.rr, change["new_val"])
+                 for change in result["changes"]]
+        pages.sort(key=lambda page: page.priority, reverse=True)
+        return pages
+
+    def unclaim_pages(self, pages):
+        if pages:
+            self.rr.table("pages").get_all(
+                    *[page.id for page in pages]).update(
+                            {"claimed": False}).run()
+
+    def _has_unbrozzled_pages(self, site):
+        results_iter = self.rr.table("pages").between(
+                [site.id, 0, r.minval, r.minval],
+                [site.id, 0, r.maxval, r.maxval],
+                index="priority_by_site").limit(1).run()
+        return len(list(results_iter)) > 0
+
+    def active_jobs(self):
+        results = self.rr.table("jobs").filter({"status":"ACTIVE"}).run()
         for result in results:
-            yield brozzler.Site(self.rr, result)
+            yield brozzler.Job(self.rr, result)
+
+    def _schedule_pages(self, pages):
+        '''
+        Inserts new pages and updates existing ones in bulk, in chunks of
+        `SCHEDULE_CHUNK_SIZE`, so that the number of round trips to rethinkdb
+        depends on the number of chunks rather than the number of pages.
+
+        Returns:
+            tuple (added, updated) of lists of brozzler.Page, as stored after
+            scheduling
+        '''
+        added = []
+        updated = []
+        for i in range(0, len(pages), self.SCHEDULE_CHUNK_SIZE):
+            chunk = pages[i:i+self.SCHEDULE_CHUNK_SIZE]
+            result = self.rr.table("pages").insert(
+                    chunk, conflict=_merge_page,
+                    return_changes="always").run()
+            if result["errors"] or (
+                    result["inserted"] + result["replaced"]
+                    + result["unchanged"] != len(chunk)):
+                raise UnexpectedDbResult(
+                        "unexpected result scheduling %s pages: %s" % (
+                            len(chunk), result))
+            for change in result["changes"]:
+                page = brozzler.Page(self.rr, change["new_val"])
+                if change["old_val"] is None:
+                    added.append(page)
+                else:
+                    updated.append(page)
+        return added, updated
+
+    def lease_host(self, host):
+        now = doublethink.utcnow()
+        lease = str(uuid.uuid4())
+        result = self.rr.table("hosts").insert({
+                "id": host, "lease": lease, "leased_at": now,
+                "lease_expires": now + datetime.timedelta(
+                    seconds=self.HOST_LEASE_SECONDS),
+                "available_at": now},
+                conflict=_lease_host, return_changes="always").run()
+        self._vet_result(
+                result, inserted=[0, 1], replaced=[0, 1], unchanged=[0, 1])
+        new_val = result["changes"][0]["new_val"]
+        if new_val["lease"] != lease:
+            raise self._host_busy(new_val, now)
+        return lease
+
+    def release_host(self, host, lease, delay=0):
+        self.rr.table("hosts").get(host).update(r.branch(
+            r.row["lease"] == lease, {
+                "lease": None, "available_at": doublethink.utcnow()
+                    + datetime.timedelta(seconds=delay)}, {})).run()
+
+    def _save_outlinks(self, page, outlinks):
+        doc = dict(outlinks)
+        doc.update({"id": page.id, "site_id": page.site_id})
+        if page.job_id:
+            doc["job_id"] = page.job_id
+        result = self.rr.table("outlinks").insert(
+                doc, conflict="replace").run()
+        self._vet_result(
+                result, inserted=[0, 1], replaced=[0, 1], unchanged=[0, 1])
+
+    def _load_outlinks(self, page_id):
+        doc = self.rr.table("outlinks").get(page_id).run()
+        if doc:
+            return {k: doc.get(k, []) for k in (
+                "accepted", "blocked", "rejected")}
+        return None
+
+    def _outlinks_docs(self, page_ids):
+        return list(self.rr.table("outlinks").get_all(*page_ids).run())
+
+    def _load_seen_pages(self, site_id):
+        return self.rr.table("seen_pages").get(site_id).run()
+
+    def _delete_seen_pages(self, site_id):
+        self.rr.table("seen_pages").get(site_id).delete().run()
+
+    def write_docs(self, table, docs):
+        result = self.rr.table(table).insert(docs, conflict="replace").run()
+        if result["errors"]:
+            raise UnexpectedDbResult(
+                    "unexpected result writing %s docs to %r: %s" % (
+                        len(docs), table, result))
+        return result["inserted"] + result["replaced"] + result["unchanged"]
+
+    def _insert_new_pages(self, pages):
+        added = []
+        updated = []
+        for i in range(0, len(pages), self.SCHEDULE_CHUNK_SIZE):
+            chunk = pages[i:i+self.SCHEDULE_CHUNK_SIZE]
+            result = self.rr.table("pages").insert(
+                    chunk, conflict=_merge_page).run()
+            if result["errors"] or (
+                    result["inserted"] + result["replaced"]
+                    + result["unchanged"] != len(chunk)):
+                raise UnexpectedDbResult(
+                        "unexpected result scheduling %s pages: %s" % (
+                            len(chunk), result))
+            if result["inserted"] == len(chunk):
+                added.extend(chunk)
+            else:
+                # can't tell which ones already existed
+                updated.extend(
+                        brozzler.Page(self.rr, page)
+                        for page in self.rr.table("pages").get_all(
+                            *[page.id for page in chunk]).run())
+        return added, updated
+
+    def job_sites(self, job_id):
+        results = self.rr.table('sites').get_all(job_id, index="job_id").run()
+        try:
+            for result in results:
+                yield brozzler.Site(self.rr, result)
+        finally:
+            results.close()
 
     def seed_page(self, site_id):
         results = self.rr.table("pages").between(
@@ -0,0 +1,22 @@
+// Tells brozzler as soon as the behavior has finished, instead of waiting for
+// brozzler to ask, by calling the binding added with Runtime.addBinding, or
+// with a tagged console message if the browser doesn't support bindings. See
+// brozzler.browser.Browser.run_behavior().
+var __brzl_notifyBehaviorFinished = setInterval(function() {
+    var finished;
+    try {
+        finished = umbraBehaviorFinished();
+    } catch (e) {
+        // no behavior, or a broken one, leave it to brozzler to find out
+        clearInterval(__brzl_notifyBehaviorFinished);
+        return;
+    }
+    if (finished) {
+        clearInterval(__brzl_notifyBehaviorFinished);
+        if (typeof __brzlBehaviorFinished === 'function') {
+            __brzlBehaviorFinished('');
+        } else {
+            console.log('__brzl_behavior_finished__');
+        }
+    }
+}, 250);
@@ -18,10 +18,13 @@ limitations under the License.
 '''
 
 import brozzler
+import brozzler.canon
 import cerberus
+import collections
 import datetime
 import doublethink
 import hashlib
+import itertools
 import json
 import logging
 import os
@@ -32,10 +35,19 @@ import urllib
 import uuid
 import yaml
 
+_schema = None
 def load_schema():
-    schema_file = os.path.join(os.path.dirname(__file__), 'job_schema.yaml')
-    with open(schema_file) as f:
-        return yaml.load(f)
+    '''
+    Returns the job configuration schema, loaded from job_schema.yaml the
+    first time it's needed. Callers should not modify it.
+    '''
+    global _schema
+    if _schema is None:
+        schema_file = os.path.join(
+                os.path.dirname(__file__), 'job_schema.yaml')
+        with open(schema_file) as f:
+            _schema = yaml.load(f)
+    return _schema
 
 class JobValidator(cerberus.Validator):
     def _validate_type_url(self, value):
@@ -46,8 +58,8 @@ class InvalidJobConf(Exception):
     def __init__(self, errors):
         self.errors = errors
 
-def validate_conf(job_conf, schema=load_schema()):
-    v = JobValidator(schema)
+def validate_conf(job_conf, schema=None):
+    v = JobValidator(schema or load_schema())
     if not v.validate(job_conf):
         raise InvalidJobConf(v.errors)
 
@@ -76,7 +88,7 @@ def new_job(frontier, job_conf):
     validate_conf(job_conf)
     job = Job(frontier.rr, {
                 "conf": job_conf, "status": "ACTIVE",
-                "started": doublethink.utcnow()})
+                "started": doublethink.utcnow(), "site_counts": {}})
     if "id" in job_conf:
         job.id = job_conf["id"]
     job.save()
@@ -85,37 +97,256 @@ def new_job(frontier, job_conf):
     for seed_conf in job_conf["seeds"]:
         merged_conf = merge(seed_conf, job_conf)
         merged_conf.pop("seeds")
+        merged_conf.pop("weight", None)
         merged_conf["job_id"] = job.id
         merged_conf["seed"] = merged_conf.pop("url")
+        # the job's weight is shared equally by its sites
+        merged_conf["share"] = job_conf.get("weight", 1.0) / len(
+                job_conf["seeds"])
         site = brozzler.Site(frontier.rr, merged_conf)
         sites.append(site)
 
     for site in sites:
         new_site(frontier, site)
 
+    # pick up site_counts
+    job.refresh()
     return job
 
 def new_site(frontier, site):
     site.id = str(uuid.uuid4())
+    site.virtual_time = frontier.virtual_time()
     logging.info("new site {}".format(site))
     # insert the Page into the database before the Site, to avoid situation
     # where a brozzler worker immediately claims the site, finds no pages
     # to crawl, and decides the site is finished
     try:
-        url = urlcanon.parse_url(site.seed)
-        hashtag = (url.hash_sign + url.fragment).decode("utf-8")
-        urlcanon.canon.remove_fragment(url)
-        page = brozzler.Page(frontier.rr, {
-            "url": str(url), "site_id": site.get("id"),
-            "job_id": site.get("job_id"), "hops_from_seed": 0,
-            "priority": 1000, "needs_robots_check": True})
-        if hashtag:
-            page.hashtags = [hashtag,]
+        page = _seed_page(frontier, site)
         page.save()
+        frontier.write_docs("seen_pages", [_note_seed_page(site, page)])
         logging.info("queued page %s", page)
     finally:
         # finally block because we want to insert the Site no matter what
         site.save()
+        if site.job_id:
+            frontier._adjust_job_site_counts(site.job_id, {site.status: 1})
+
+def _seed_page(frontier, site):
+    url = urlcanon.parse_url(site.seed)
+    hashtag = (url.hash_sign + url.fragment).decode("utf-8")
+    urlcanon.canon.remove_fragment(url)
+    page = brozzler.Page(frontier.rr, {
+        "url": str(url), "site_id": site.get("id"),
+        "job_id": site.get("job_id"), "hops_from_seed": 0,
+        "priority": 1000, "needs_robots_check": True})
+    if hashtag:
+        page.hashtags = [hashtag,]
+    return page
+
+def _note_seed_page(site, page):
+    '''
+    Initializes the fields of new `site` that keep track of its pages.
+    Returns the document to write to the "seen_pages" table for the site.
+    '''
+    site.queued_priority = page.priority
+    site.page_counts = {
+        "queued": 1, "brozzled": 0, "blocked": 0, "rejected": 0,
+        "hops": {"0": 1}}
+    seen = brozzler.frontier.SeenPages(complete=True)
+    seen.add(page.id)
+    doc = seen.to_dict()
+    doc["id"] = site.id
+    return doc
+
+# number of sites (and seed pages) written at a time by `new_sites`
+BULK_CHUNK_SIZE = 1000
+
+def new_sites(frontier, sites, chunk_size=BULK_CHUNK_SIZE, counted_as=None):
+    '''
+    Like `new_site`, for lots of sites. Sites are read from the iterable
+    `sites` and written in bulk, `chunk_size` at a time: first the seed pages,
+    then the sites, so that a site can't be claimed before its seed page
+    exists. Progress is logged after each chunk.
+
+    Args:
+        frontier (brozzler.Frontier): the frontier
+        sites: iterable of new brozzler.Site
+        chunk_size (int): number of sites to write at a time
+        counted_as (str): if the sites were already counted in their job's
+            `site_counts`, the status they were counted under
+    Returns:
+        int: number of sites added
+    '''
+    start = time.time()
+    count = 0
+    sites = iter(sites)
+    while True:
+        chunk = list(itertools.islice(sites, chunk_size))
+        if not chunk:
+            break
+        virtual_time = frontier.virtual_time()
+        pages = []
+        seen_docs = []
+        for site in chunk:
+            site.id = str(uuid.uuid4())
+            site.virtual_time = virtual_time
+            page = _seed_page(frontier, site)
+            seen_docs.append(_note_seed_page(site, page))
+            pages.append(page)
+        frontier.write_docs("pages", pages)
+        frontier.write_docs("seen_pages", seen_docs)
+        frontier.write_docs("sites", chunk)
+
+        deltas = collections.defaultdict(collections.Counter)
+        for site in chunk:
+            if site.job_id:
+                deltas[site.job_id][site.status] += 1
+                if counted_as:
+                    deltas[site.job_id][counted_as] -= 1
+        for job_id in deltas:
+            frontier._adjust_job_site_counts(job_id, {
+                status: n for status, n in deltas[job_id].items() if n})
+
+        count += len(chunk)
+        elapsed = time.time() - start
+        logging.info(
+                "added %s sites in %.1f seconds (%.1f sites/second)", count,
+                elapsed, count / max(elapsed, 0.001))
+    return count
+
+def validate_seed(seed_conf, schema=None):
+    '''
+    Validates the configuration of a single seed, as found in the `seeds` list
+    of a job configuration.
+
+    Raises:
+        InvalidJobConf
+    '''
+    schema = schema or load_schema()
+    v = JobValidator(schema["seeds"]["schema"]["schema"])
+    if not v.validate(seed_conf):
+        raise InvalidJobConf(v.errors)
+
+def read_seeds(path):
+    '''
+    Generates seed configurations (dicts with at least "url") from file
+    `path`, without reading the whole file into memory. A yaml file (named
+    \*.yaml or \*.yml) holds one seed or a list of seeds per yaml document.
+    Any other file has one seed per line, either a json object or a bare
+    url. Blank lines and lines starting with "#" are ignored.
+    '''
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            for doc in yaml.safe_load_all(f):
+                for seed in (doc if isinstance(doc, list) else [doc]):
+                    yield seed if isinstance(seed, dict) else {"url": seed}
+        else:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("{"):
+                    yield json.loads(line)
+                else:
+                    yield {"url": line}
+
+def new_job_bulk(
+        frontier, job_conf, seeds_file=None, chunk_size=BULK_CHUNK_SIZE):
+    '''
+    Like `new_job`, for jobs with lots of seeds: the seeds in
+    `job_conf["seeds"]` (if any) and in `seeds_file` (see `read_seeds`) are
+    validated one by one, then the sites are added in bulk by `new_sites`.
+    The seeds file is read twice, once to validate and count the seeds and
+    again to add them, instead of being loaded into memory. Until each site
+    is added, it is counted in the job's `site_counts` as "INGESTING", so the
+    job can't finish while seeds are still being added.
+
+    Returns:
+        Job
+    Raises:
+        InvalidJobConf: if the job configuration or any seed is invalid, in
+            which case nothing is saved
+    '''
+    def seeds():
+        yield from job_conf.get("seeds") or []
+        if seeds_file:
+            yield from read_seeds(seeds_file)
+
+    schema = load_schema()
+    top_level_conf = {k: v for k, v in job_conf.items() if k != "seeds"}
+    v = JobValidator({k: v for k, v in schema.items() if k != "seeds"})
+    if not v.validate(top_level_conf):
+        raise InvalidJobConf(v.errors)
+    n = 0
+    errors = {}
+    for seed_conf in seeds():
+        try:
+            validate_seed(seed_conf, schema)
+        except InvalidJobConf as e:
+            errors[n] = e.errors
+            if len(errors) >= 100:
+                break
+        n += 1
+    if errors:
+        raise InvalidJobConf({"seeds": [errors]})
+    if n == 0:
+        raise InvalidJobConf({"seeds": ["no seeds"]})
+    logging.info("validated %s seeds", n)
+
+    job = Job(frontier.rr, {
+                "conf": job_conf, "status": "ACTIVE",
+                "started": doublethink.utcnow(),
+                "site_counts": {"INGESTING": n}})
+    if "id" in job_conf:
+        job.id = job_conf["id"]
+    job.save()
+
+    def sites():
+        for seed_conf in seeds():
+            merged_conf = merge(seed_conf, top_level_conf)
+            merged_conf.pop("weight", None)
+            merged_conf["job_id"] = job.id
+            merged_conf["seed"] = merged_conf.pop("url")
+            merged_conf["share"] = job_conf.get("weight", 1.0) / n
+            yield brozzler.Site(frontier.rr, merged_conf)
+
+    new_sites(frontier, sites(), chunk_size, counted_as="INGESTING")
+    job.refresh()
+    return job
+
+class Document(doublethink.Document):
+    '''
+    Base class for brozzler.Job, brozzler.Site and brozzler.Page. Behaves
+    exactly like `doublethink.Document` when `rr` is a `doublethink.Rethinker`.
+    Otherwise `rr` is expected to be a document store (for example
+    `brozzler.sqlite.SqliteStore`) with these methods, and loading, saving and
+    refreshing go through it:
+
+        load_document(cls, pk): returns instance of `cls` or None
+        save_document(doc): persists `doc._updates` and `doc._deletes`, or
+            inserts `doc` if it is not in the store yet
+        refresh_document(doc): reloads `doc`, raises KeyError if it is gone
+    '''
+    @classmethod
+    def load(cls, rr, pk):
+        if hasattr(rr, 'load_document'):
+            if pk is None:
+                return None
+            return rr.load_document(cls, pk)
+        return super().load(rr, pk)
+
+    def save(self):
+        if hasattr(self.rr, 'save_document'):
+            self.rr.save_document(self)
+            self._clear_updates()
+        else:
+            super().save()
+
+    def refresh(self):
+        if hasattr(self.rr, 'refresh_document'):
+            self.rr.refresh_document(self)
+        else:
+            super().refresh()
 
 class ElapsedMixIn(object):
     def elapsed(self):
@@ -130,7 +361,7 @@ class ElapsedMixIn(object):
             dt += (doublethink.utcnow() - ss['start']).total_seconds()
         return dt
 
-class Job(doublethink.Document, ElapsedMixIn):
+class Job(Document, ElapsedMixIn):
     logger = logging.getLogger(__module__ + "." + __qualname__)
     table = "jobs"
 
@@ -158,7 +389,7 @@ class Job(doublethink.Document, ElapsedMixIn):
         self.status = "FINISHED"
         self.starts_and_stops[-1]["stop"] = doublethink.utcnow()
 
-class Site(doublethink.Document, ElapsedMixIn):
+class Site(Document, ElapsedMixIn):
     logger = logging.getLogger(__module__ + "." + __qualname__)
     table = 'sites'
 
@@ -171,11 +402,12 @@ class Site(doublethink.Document, ElapsedMixIn):
             self.last_disclaimed = brozzler.EPOCH_UTC
         if not "last_claimed" in self:
             self.last_claimed = brozzler.EPOCH_UTC
+        if not "virtual_time" in self:
+            self.virtual_time = 0
         if not "scope" in self:
             self.scope = {}
         if not "surt" in self.scope and self.seed:
-            self.scope["surt"] = brozzler.site_surt_canon(
-                    self.seed).surt().decode('ascii')
+            self.scope["surt"] = brozzler.canon.site_surt(self.seed)
 
         if not "starts_and_stops" in self:
             if self.get("start_time"):   # backward compatibility
@@ -191,12 +423,18 @@ class Site(doublethink.Document, ElapsedMixIn):
     def __str__(self):
         return 'Site({"id":"%s","seed":"%s",...})' % (self.id, self.seed)
 
+    def over_time_limit(self):
+        return bool(
+                self.time_limit and self.time_limit > 0
+                and self.elapsed() > self.time_limit)
+
     def note_seed_redirect(self, url):
-        new_scope_surt = brozzler.site_surt_canon(url).surt().decode("ascii")
+        new_scope_surt = brozzler.canon.site_surt(url)
         if not new_scope_surt.startswith(self.scope["surt"]):
             self.logger.info("changing site scope surt from {} to {}".format(
                 self.scope["surt"], new_scope_surt))
             self.scope["surt"] = new_scope_surt
+            self._compiled_scope = None
 
     def extra_headers(self):
         hdrs = {}
@@ -205,56 +443,147 @@ class Site(doublethink.Document, ElapsedMixIn):
                     self.warcprox_meta, separators=(',', ':'))
         return hdrs
 
+    def compiled_scope(self):
+        '''
+        Returns the `CompiledScope` for this site, compiling it first if this
+        is the first call or if `self.scope` has been replaced (e.g. by
+        `refresh()`) or changed by `note_seed_redirect()` since the last call.
+        '''
+        if (self._compiled_scope is None
+                or self._compiled_scope.scope is not self.scope):
+            self._compiled_scope = CompiledScope(self.scope)
+        return self._compiled_scope
+
     def is_in_scope(self, url, parent_page=None):
         if not isinstance(url, urlcanon.ParsedUrl):
-            url = urlcanon.semantic(url)
-        try_parent_urls = []
-        if parent_page:
-            try_parent_urls.append(urlcanon.semantic(parent_page.url))
-            if parent_page.redirect_url:
-                try_parent_urls.append(
-                        urlcanon.semantic(parent_page.redirect_url))
+            url = brozzler.canon.canonicalize(url).semantic
 
-        might_accept = False
         if not url.scheme in (b'http', b'https'):
             # XXX doesn't belong here maybe (where? worker ignores unknown
             # schemes?)
             return False
-        elif (parent_page and "max_hops" in self.scope
+
+        scope = self.compiled_scope()
+        try_parent_urls = []
+        if parent_page:
+            try_parent_urls = scope.parent_urls(parent_page)
+
+        might_accept = False
+        if (parent_page and "max_hops" in self.scope
                 and parent_page.hops_from_seed >= self.scope["max_hops"]):
             pass
-        elif url.surt().startswith(self.scope["surt"].encode("utf-8")):
+        elif url.surt().startswith(scope.surt):
             might_accept = True
         elif parent_page and parent_page.hops_off_surt < self.scope.get(
                 "max_hops_off_surt", 0):
             might_accept = True
-        elif "accepts" in self.scope:
-            for accept_rule in self.scope["accepts"]:
-                rule = urlcanon.MatchRule(**accept_rule)
-                if try_parent_urls:
-                    for parent_url in try_parent_urls:
-                        if rule.applies(url, parent_url):
-                           might_accept = True
-                else:
-                    if rule.applies(url):
-                        might_accept = True
+        else:
+            might_accept = scope.accepts.applies(url, try_parent_urls)
 
         if might_accept:
-            if "blocks" in self.scope:
-                for block_rule in self.scope["blocks"]:
-                    rule = urlcanon.MatchRule(**block_rule)
-                    if try_parent_urls:
-                        for parent_url in try_parent_urls:
-                            if rule.applies(url, parent_url):
-                               return False
-                    else:
-                        if rule.applies(url):
-                            return False
-            return True
+            return not scope.blocks.applies(url, try_parent_urls)
         else:
             return False
 
-class Page(doublethink.Document):
+class SurtTrie:
+    '''
+    Prefix tree of bytes keys (surts, ssurts or reversed hostnames), each of
+    which maps to a list of values. `matches(key)` yields the values of every
+    key in the tree that is a prefix of `key`, in time proportional to the
+    length of `key` rather than the number of keys in the tree.
+    '''
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix, value):
+        node = self._root
+        for b in prefix:
+            node = node.setdefault(b, {})
+        node.setdefault(None, []).append(value)
+
+    def matches(self, key):
+        node = self._root
+        if None in node:
+            yield from node[None]
+        for b in key:
+            node = node.get(b)
+            if node is None:
+                return
+            if None in node:
+                yield from node[None]
+
+class CompiledRules:
+    '''
+    A list of scope rules (as found in `site.scope["accepts"]` or
+    `site.scope["blocks"]`) compiled to `urlcanon.MatchRule`s. Rules with a
+    `surt`, `ssurt` or `domain` condition are indexed in a `SurtTrie` by that
+    condition, so that only rules that could possibly apply to a given url are
+    evaluated. The rest are evaluated for every url.
+    '''
+    def __init__(self, rules):
+        self.surt_rules = SurtTrie()
+        self.ssurt_rules = SurtTrie()
+        self.domain_rules = SurtTrie()
+        self.other_rules = []
+        for rule in rules or []:
+            match_rule = urlcanon.MatchRule(**rule)
+            if match_rule.surt:
+                self.surt_rules.add(match_rule.surt, match_rule)
+            elif match_rule.ssurt:
+                self.ssurt_rules.add(match_rule.ssurt, match_rule)
+            elif match_rule.domain:
+                self.domain_rules.add(
+                        urlcanon.reverse_host(match_rule.domain), match_rule)
+            else:
+                self.other_rules.append(match_rule)
+
+    def _candidates(self, url):
+        yield from self.surt_rules.matches(url.surt())
+        yield from self.ssurt_rules.matches(url.ssurt())
+        yield from self.domain_rules.matches(urlcanon.reverse_host(url.host))
+        yield from self.other_rules
+
+    def applies(self, url, parent_urls=None):
+        '''
+        Returns True if any of the rules applies to `url` (with any of
+        `parent_urls`, if supplied).
+        '''
+        for rule in self._candidates(url):
+            if parent_urls:
+                for parent_url in parent_urls:
+                    if rule.applies(url, parent_url):
+                        return True
+            elif rule.applies(url):
+                return True
+        return False
+
+class CompiledScope:
+    '''
+    Site scope compiled for fast repeated scoping of urls, see
+    `Site.compiled_scope()`. Also remembers the parsed urls of the last parent
+    page it was asked about, so that they are parsed once per batch of
+    outlinks instead of once per outlink.
+    '''
+    def __init__(self, scope):
+        self.scope = scope
+        self.surt = scope["surt"].encode("utf-8")
+        self.accepts = CompiledRules(scope.get("accepts"))
+        self.blocks = CompiledRules(scope.get("blocks"))
+        self._parent_key = None
+        self._parent_urls = None
+
+    def parent_urls(self, parent_page):
+        key = (parent_page.url, parent_page.redirect_url)
+        if key != self._parent_key:
+            parent_urls = [
+                    brozzler.canon.canonicalize(parent_page.url).semantic]
+            if parent_page.redirect_url:
+                parent_urls.append(brozzler.canon.canonicalize(
+                    parent_page.redirect_url).semantic)
+            self._parent_key, self._parent_urls = key, parent_urls
+        return self._parent_urls
+
+class Page(Document):
     logger = logging.getLogger(__module__ + "." + __qualname__)
     table = "pages"
 
@@ -296,7 +625,5 @@ class Page(doublethink.Document):
     def canon_url(self):
         if not self.url:
             return None
-        if self._canon_hurl is None:
-            self._canon_hurl = urlcanon.semantic(self.url)
-        return str(self._canon_hurl)
+        return str(brozzler.canon.canonicalize(self.url).semantic)
 
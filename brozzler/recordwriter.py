@@ -0,0 +1,196 @@
+'''
+brozzler/recordwriter.py - writes warc records (screenshots, thumbnails,
+youtube-dl metadata) through warcprox in the background
+
+Copyright (C) 2017 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import brozzler
+import collections
+import http.client
+import logging
+import queue
+import threading
+import time
+
+class RecordWriter:
+    '''
+    Sends WARCPROX_WRITE_RECORD requests to warcprox on background threads,
+    so that brozzling doesn't wait for them. Each thread keeps a keep-alive
+    connection open to each warcprox instance it writes to. At most
+    `queue_size` records wait to be written; `write()` blocks while that many
+    are waiting.
+
+    Failed requests are retried up to `retries` times, after waiting
+    `backoff` seconds, then twice as long, and so on. If a record still can't
+    be written, a `brozzler.ProxyError` is held for the owner of the record
+    (normally the site being brozzled) and raised by the next `check()` or
+    `write()` for that owner.
+    '''
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(
+            self, threads=2, queue_size=100, retries=3, backoff=1.0,
+            timeout=60):
+        self.threads = threads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._queue = queue.Queue(queue_size)
+        self._pending = collections.Counter()  # {owner: n_records, ...}
+        self._errors = {}                      # {owner: ProxyError, ...}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def write(
+            self, owner, warcprox_address, url, warc_type, content_type,
+            payload, extra_headers=None):
+        '''
+        Queues a record to be written by warcprox at `warcprox_address`
+        (host:port). Blocks if the queue is full.
+
+        Raises:
+            brozzler.ProxyError: if an earlier record of `owner` could not be
+                written
+        '''
+        self.check(owner)
+        headers = {
+            "Content-Type": content_type, "WARC-Type": warc_type,
+            "Host": "N/A"}
+        if extra_headers:
+            headers.update(extra_headers)
+        with self._cond:
+            if not self._threads:
+                self._start()
+            self._pending[owner] += 1
+        self._queue.put((owner, warcprox_address, url, headers, payload))
+
+    def check(self, owner):
+        '''
+        Raises:
+            brozzler.ProxyError: if a record of `owner` could not be written,
+                which is then forgotten
+        '''
+        with self._cond:
+            e = self._errors.pop(owner, None)
+        if e:
+            raise e
+
+    def flush(self, owner=None, timeout=None):
+        '''
+        Waits until the queued records of `owner`, or of everyone if `owner`
+        is None, have been written or given up on.
+
+        Returns:
+            bool: False if `timeout` elapsed first
+        '''
+        def done():
+            if owner is None:
+                return not self._pending
+            return not self._pending[owner]
+        with self._cond:
+            return self._cond.wait_for(done, timeout)
+
+    def close(self):
+        '''Writes the queued records and stops the background threads.'''
+        self.flush()
+        with self._cond:
+            threads, self._threads = self._threads, []
+        for th in threads:
+            self._queue.put(None)
+        for th in threads:
+            th.join()
+
+    def _start(self):
+        for i in range(self.threads):
+            th = threading.Thread(
+                    target=self._run, name="RecordWriter-%s" % i,
+                    daemon=True)
+            th.start()
+            self._threads.append(th)
+
+    def _run(self):
+        connections = {}  # {warcprox_address: HTTPConnection, ...}
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                owner = item[0]
+                try:
+                    self._write(connections, *item[1:])
+                except brozzler.ProxyError as e:
+                    self.logger.error("%s", e)
+                    with self._cond:
+                        self._errors[owner] = e
+                except:
+                    self.logger.critical(
+                            "unexpected exception writing record %s",
+                            item[2], exc_info=True)
+                finally:
+                    with self._cond:
+                        self._pending[owner] -= 1
+                        if not self._pending[owner]:
+                            del self._pending[owner]
+                        self._cond.notify_all()
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    def _write(self, connections, warcprox_address, url, headers, payload):
+        failures = 0
+        while True:
+            conn = connections.get(warcprox_address)
+            reused = conn is not None
+            if not reused:
+                conn = http.client.HTTPConnection(
+                        warcprox_address, timeout=self.timeout)
+                connections[warcprox_address] = conn
+            try:
+                # warcprox is addressed as a proxy, so the request target is
+                # the full url
+                conn.request(
+                        "WARCPROX_WRITE_RECORD", url, body=payload,
+                        headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                del connections[warcprox_address]
+                if reused:
+                    # probably warcprox closed the idle connection, try again
+                    # right away on a new one
+                    continue
+                failures += 1
+                if failures > self.retries:
+                    raise brozzler.ProxyError(
+                            "failed to write record %s to warcprox %s: %s" % (
+                                url, warcprox_address, e))
+                delay = self.backoff * 2 ** (failures - 1)
+                self.logger.warn(
+                        "problem writing record %s to warcprox %s, will "
+                        "retry in %s seconds: %s", url, warcprox_address,
+                        delay, e)
+                time.sleep(delay)
+                continue
+            if response.will_close:
+                conn.close()
+                del connections[warcprox_address]
+            if response.status != 204:
+                self.logger.warn(
+                        'got "%s %s" response on warcprox '
+                        'WARCPROX_WRITE_RECORD request (expected 204)',
+                        response.status, response.reason)
+            return
@@ -30,7 +30,7 @@ import reppy.cache
 import reppy.parser
 import requests
 
-__all__ = ["is_permitted_by_robots"]
+__all__ = ["is_permitted_by_robots", "crawl_delay"]
 
 # monkey-patch reppy to do substring user-agent matching, see top of file
 reppy.Utility.short_user_agent = lambda strng: strng
@@ -121,3 +121,20 @@ def is_permitted_by_robots(site, url, proxy=None):
                             "left) for %s: %s", url, repr(e), exc_info=True)
                     return False
 
+def crawl_delay(site, url, proxy=None):
+    '''
+    Returns the robots.txt `Crawl-delay` for the host of `url`, in seconds, or
+    None if there isn't one, if `site.ignore_robots` is set, or if robots.txt
+    can't be fetched. Usually robots.txt has already been fetched and cached
+    by `is_permitted_by_robots`.
+    '''
+    if site.ignore_robots:
+        return None
+    try:
+        return _robots_cache(site, proxy).delay(
+                url, site.user_agent or "brozzler")
+    except Exception as e:
+        logging.warn(
+                "problem getting crawl delay from robots.txt for %s: %s",
+                url, repr(e))
+        return None
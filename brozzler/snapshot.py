@@ -0,0 +1,153 @@
+'''
+brozzler/snapshot.py - export and import of frontier snapshots, for moving a
+crawl between frontiers or restoring one after an incident
+
+A snapshot is a directory of gzipped newline-delimited json files named
+frontier-00000.ndjson.gz, frontier-00001.ndjson.gz, etc. Each line holds one
+document and the table it belongs to, ``{"table": "pages", "doc": {...}}``.
+Times are represented the way rethinkdb represents them on the wire.
+
+Copyright (C) 2017 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import brozzler.sqlite
+import collections
+import concurrent.futures
+import glob
+import gzip
+import logging
+import os
+
+__all__ = ["export_frontier", "import_frontier"]
+
+# documents per snapshot file
+CHUNK_SIZE = 100000
+
+CHUNK_PATTERN = "frontier-*.ndjson.gz"
+
+def _chunk_paths(dirname):
+    return sorted(glob.glob(os.path.join(dirname, CHUNK_PATTERN)))
+
+def export_frontier(frontier, job_id, dirname, chunk_size=CHUNK_SIZE):
+    '''
+    Writes a snapshot of the frontier state of job `job_id` to directory
+    `dirname`, streaming documents from the frontier so that memory use is
+    constant. Each file is written under a temporary name and renamed when
+    complete.
+
+    Returns:
+        int: number of documents exported
+    Raises:
+        FileExistsError: if `dirname` already contains a snapshot
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    if _chunk_paths(dirname):
+        raise FileExistsError("%s already contains a snapshot" % dirname)
+
+    count = 0
+    out = None
+    try:
+        for table, doc in frontier.job_snapshot(job_id):
+            if count % chunk_size == 0:
+                if out:
+                    _finish_chunk(out, path)
+                path = os.path.join(
+                        dirname, "frontier-%05d.ndjson.gz" % (
+                            count // chunk_size))
+                out = gzip.open(path + ".tmp", "wt", encoding="utf-8")
+            out.write(brozzler.sqlite.dumps({"table": table, "doc": doc}))
+            out.write("\n")
+            count += 1
+        if out:
+            _finish_chunk(out, path)
+            out = None
+    finally:
+        if out:
+            out.close()
+    logging.info(
+            "exported %s documents of job %s to %s", count, job_id, dirname)
+    return count
+
+def _finish_chunk(out, path):
+    out.close()
+    os.rename(path + ".tmp", path)
+    logging.info("wrote %s", path)
+
+def _read_batches(path, batch_size):
+    '''
+    Generates (table, docs) tuples of up to `batch_size` consecutive documents
+    from the same table in snapshot file `path`.
+    '''
+    table = None
+    docs = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = brozzler.sqlite.loads(line)
+            doc = record["doc"]
+            if record["table"] in ("sites", "pages"):
+                # whoever held the claim is not around anymore
+                doc["claimed"] = False
+            if docs and (
+                    record["table"] != table or len(docs) >= batch_size):
+                yield table, docs
+                docs = []
+            table = record["table"]
+            docs.append(doc)
+    if docs:
+        yield table, docs
+
+def import_frontier(
+        frontier, dirname, batch_size=1000, threads=4, checkpoint=None):
+    '''
+    Restores the snapshot in directory `dirname` to `frontier`, writing each
+    file in bulk batches of `batch_size` documents on `threads` threads, with
+    only a few batches in memory at a time.
+
+    The names of fully imported files are appended to the file `checkpoint`
+    (by default, "imported" in the snapshot directory). Files listed there
+    are skipped, so an interrupted import can be resumed by running it
+    again. Since documents are restored by replacing any with the same id,
+    reimporting a partially imported file is harmless.
+
+    Returns:
+        int: number of documents imported (not counting skipped files)
+    '''
+    checkpoint = checkpoint or os.path.join(dirname, "imported")
+    done = set()
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            done = set(line.strip() for line in f)
+
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool, \
+            open(checkpoint, "a") as checkpoint_file:
+        for path in _chunk_paths(dirname):
+            name = os.path.basename(path)
+            if name in done:
+                logging.info("skipping %s, already imported", name)
+                continue
+            futures = collections.deque()
+            for table, docs in _read_batches(path, batch_size):
+                # bound the number of batches in memory
+                if len(futures) >= 2 * threads:
+                    count += futures.popleft().result()
+                futures.append(
+                        pool.submit(frontier.write_docs, table, docs))
+            while futures:
+                count += futures.popleft().result()
+            checkpoint_file.write(name + "\n")
+            checkpoint_file.flush()
+            logging.info("imported %s (%s documents so far)", name, count)
+    return count
@@ -0,0 +1,574 @@
+'''
+brozzler/sqlite.py - SqliteFrontier, an embedded frontier that keeps jobs,
+sites and pages in a local sqlite database instead of rethinkdb, for
+single-node crawls
+
+Copyright (C) 2017 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import base64
+import brozzler
+import brozzler.frontier
+import contextlib
+import datetime
+import doublethink
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+
+def _json_default(o):
+    # same representation rethinkdb uses on the wire
+    if isinstance(o, datetime.datetime):
+        if o.tzinfo is None:
+            o = o.replace(tzinfo=doublethink.UTC)
+        return {
+            '$reql_type$': 'TIME', 'epoch_time': o.timestamp(),
+            'timezone': '+00:00'}
+    elif isinstance(o, (bytes, bytearray, memoryview)):
+        return {
+            '$reql_type$': 'BINARY',
+            'data': base64.b64encode(bytes(o)).decode('ascii')}
+    raise TypeError('%r is not JSON serializable' % o)
+
+def _json_object_hook(d):
+    if d.get('$reql_type$') == 'TIME':
+        return datetime.datetime.fromtimestamp(
+                d['epoch_time'], doublethink.UTC)
+    elif d.get('$reql_type$') == 'BINARY':
+        return base64.b64decode(d['data'])
+    return d
+
+def dumps(doc):
+    return json.dumps(doc, default=_json_default, separators=(',', ':'))
+
+def loads(s):
+    return json.loads(s, object_hook=_json_object_hook)
+
+class SqliteStore:
+    '''
+    Document store backed by a sqlite database, for use as the `rr` of
+    brozzler.Job, brozzler.Site and brozzler.Page (see
+    `brozzler.model.Document`).
+
+    Each table keeps the whole document as json in the `doc` column, plus
+    copies of the fields the frontier queries by, in indexed columns. The
+    database is opened in WAL mode so that readers don't block the writer.
+    One connection is shared by all threads, serialized by a lock.
+    '''
+    logger = logging.getLogger(__module__ + '.' + __qualname__)
+
+    # fields copied into indexed columns, by table
+    COLUMNS = {
+        'jobs': ('status',),
+        'sites': (
+            'status', 'claimed', 'last_claimed', 'last_disclaimed',
+            'virtual_time', 'job_id'),
+        'pages': (
+            'site_id', 'brozzle_count', 'claimed', 'priority',
+            'hops_from_seed'),
+        'outlinks': ('site_id',),
+        'hosts': ('available_at',),
+        'seen_pages': (),
+    }
+
+    SCHEMA = '''
+create table if not exists jobs (
+    id primary key, status, doc text not null);
+create index if not exists jobs_status on jobs (status);
+
+create table if not exists sites (
+    id primary key, status, claimed, last_claimed, last_disclaimed,
+    virtual_time, job_id, doc text not null);
+create index if not exists sites_last_disclaimed on sites (
+    status, last_disclaimed);
+create index if not exists sites_virtual_time on sites (
+    status, virtual_time);
+create index if not exists sites_job_id on sites (job_id);
+
+create table if not exists pages (
+    id primary key, site_id, brozzle_count, claimed, priority, hops_from_seed,
+    doc text not null);
+create index if not exists priority_by_site on pages (
+    site_id, brozzle_count, claimed, priority);
+create index if not exists least_hops on pages (
+    site_id, brozzle_count, hops_from_seed);
+
+create table if not exists outlinks (
+    id primary key, site_id, doc text not null);
+
+create table if not exists hosts (
+    id primary key, available_at, doc text not null);
+
+create table if not exists seen_pages (
+    id primary key, doc text not null);
+'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+                path, timeout=60, isolation_level=None,
+                check_same_thread=False)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute('pragma synchronous=normal')
+        self._conn.executescript(self.SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Context manager that runs the enclosed statements in a write
+        transaction, yielding the connection to use.
+        '''
+        with self._lock:
+            self._conn.execute('begin immediate')
+            try:
+                yield self._conn
+            except:
+                self._conn.execute('rollback')
+                raise
+            else:
+                self._conn.execute('commit')
+
+    def query(self, sql, params=()):
+        '''Runs read-only query `sql`, returns list of result rows.'''
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _column_value(self, value):
+        if isinstance(value, datetime.datetime):
+            return _json_default(value)['epoch_time']
+        elif isinstance(value, bool):
+            return int(value)
+        return value
+
+    def write(self, conn, table, doc, insert=False):
+        '''
+        Inserts or replaces `doc` (any dict with an 'id') in `table`, using
+        connection `conn`, which should be in a transaction.
+        '''
+        columns = self.COLUMNS[table] + ('doc',)
+        values = [self._column_value(doc.get(c)) for c in columns[:-1]]
+        values.append(dumps(doc))
+        if insert:
+            conn.execute(
+                    'insert into %s (id, %s) values (?, %s)' % (
+                        table, ', '.join(columns),
+                        ', '.join('?' * len(columns))),
+                    [doc['id']] + values)
+        else:
+            conn.execute(
+                    'update %s set %s where id = ?' % (
+                        table, ', '.join('%s = ?' % c for c in columns)),
+                    values + [doc['id']])
+
+    def save(self, conn, doc):
+        '''
+        Persists `doc` using connection `conn`, which should be in a
+        transaction. Like `doublethink.Document.save()`, only the fields that
+        have changed are written, unless the document is new.
+        '''
+        row = None
+        if doc.get('id') is not None:
+            row = conn.execute(
+                    'select doc from %s where id = ?' % doc.table,
+                    (doc['id'],)).fetchone()
+        if row:
+            if doc._updates or doc._deletes:
+                stored = loads(row[0])
+                for field in doc._updates:
+                    if field in doc:
+                        stored[field] = doc[field]
+                for field in doc._deletes:
+                    stored.pop(field, None)
+                self.write(conn, doc.table, stored)
+        else:
+            if doc.get('id') is None:
+                dict.__setitem__(doc, 'id', str(uuid.uuid4()))
+            self.write(conn, doc.table, doc, insert=True)
+        doc._clear_updates()
+
+    def load_document(self, cls, pk):
+        rows = self.query('select doc from %s where id = ?' % cls.table, (pk,))
+        if not rows:
+            return None
+        return cls(self, loads(rows[0][0]))
+
+    def save_document(self, doc):
+        with self.transaction() as conn:
+            self.save(conn, doc)
+
+    def refresh_document(self, doc):
+        rows = self.query(
+                'select doc from %s where id = ?' % doc.table, (doc.id,))
+        if not rows:
+            raise KeyError
+        d = loads(rows[0][0])
+        for k in d:
+            dict.__setitem__(doc, k, doublethink.orm.watch(
+                d[k], callback=doc._updated, field=k))
+
+class SqliteFrontier(brozzler.frontier.Frontier):
+    '''
+    Frontier stored in an embedded sqlite database file, for single-node
+    crawls. Only processes on the same host, sharing the same database file,
+    can work on the same crawl.
+    '''
+    logger = logging.getLogger(__module__ + '.' + __qualname__)
+
+    # sql condition that is true if the claim on a site has expired, takes
+    # parameters STALE_CLAIM_SECONDS and the current time
+    _CLAIM_EXPIRED = (
+            "coalesce(json_extract(doc, '$.claim_expires.epoch_time'), "
+            'last_claimed + ?) < ?')
+
+    def __init__(self, path, separate_outlinks=False):
+        self.rr = SqliteStore(path)
+        self.separate_outlinks = separate_outlinks
+
+    def _claim_sites(self, worker_id, n):
+        now = doublethink.utcnow()
+        sites = []
+        with self.rr.transaction() as conn:
+            rows = conn.execute(
+                    'select doc from sites where status = ? and ('
+                    'not coalesce(claimed, 0) or %s) and '
+                    "coalesce(json_extract(doc, '$.claim_after.epoch_time'), "
+                    '0) <= ? order by virtual_time limit ?' % (
+                        self._CLAIM_EXPIRED), (
+                        'ACTIVE', self.STALE_CLAIM_SECONDS, now.timestamp(),
+                        now.timestamp(), n)).fetchall()
+            for row in rows:
+                site = brozzler.Site(self.rr, loads(row[0]))
+                if site.claimed:
+                    self.logger.warn(
+                            "re-claimed site that was still marked 'claimed' "
+                            "because its claim expired (last claimed by %s "
+                            "at %s), presumably the worker died or some "
+                            "error stopped it from being disclaimed",
+                            site.last_claimed_by, site.last_claimed)
+                site.claimed = True
+                site.last_claimed_by = worker_id
+                site.last_claimed = now
+                site.claim_expires = now + datetime.timedelta(
+                        seconds=self.CLAIM_LEASE_SECONDS)
+                self.rr.save(conn, site)
+                sites.append(site)
+        return sites
+
+    def _release_stale_claims(self):
+        with self.rr.transaction() as conn:
+            rows = conn.execute(
+                    'select doc from sites where status = ? and claimed and '
+                    + self._CLAIM_EXPIRED, (
+                        'ACTIVE', self.STALE_CLAIM_SECONDS,
+                        doublethink.utcnow().timestamp())).fetchall()
+            for row in rows:
+                doc = loads(row[0])
+                doc['claimed'] = False
+                self.rr.write(conn, 'sites', doc)
+        return len(rows)
+
+    def renew_claims(self, worker_id, site_ids):
+        expires = doublethink.utcnow() + datetime.timedelta(
+                seconds=self.CLAIM_LEASE_SECONDS)
+        renewed = 0
+        with self.rr.transaction() as conn:
+            for site_id in site_ids:
+                row = conn.execute(
+                        'select doc from sites where id = ?',
+                        (site_id,)).fetchone()
+                if not row:
+                    continue
+                doc = loads(row[0])
+                if doc.get('claimed') and doc.get(
+                        'last_claimed_by') == worker_id:
+                    doc['claim_expires'] = expires
+                    self.rr.write(conn, 'sites', doc)
+                    renewed += 1
+        return renewed
+
+    def _update_if_unclaimed(self, site_id, status):
+        now = doublethink.utcnow()
+        with self.rr.transaction() as conn:
+            row = conn.execute(
+                    'select doc from sites where id = ?',
+                    (site_id,)).fetchone()
+            if not row:
+                return None
+            doc = loads(row[0])
+            if doc.get('status') != 'ACTIVE' or doc.get('claimed'):
+                return None
+            doc['status'] = status
+            doc['claimed'] = False
+            doc['last_disclaimed'] = now
+            doc['starts_and_stops'][-1]['stop'] = now
+            self.rr.write(conn, 'sites', doc)
+        return doc
+
+    def _unclaimed_active_sites(self):
+        for row in self.rr.query(
+                'select doc from sites where status = ? and '
+                'not coalesce(claimed, 0)', ('ACTIVE',)):
+            yield brozzler.Site(self.rr, loads(row[0]))
+
+    def virtual_time(self):
+        rows = self.rr.query(
+                'select min(virtual_time) from sites where status = ?',
+                ('ACTIVE',))
+        return rows[0][0] or 0
+
+    def _increment_site_counters(self, site, deltas):
+        with self.rr.transaction() as conn:
+            row = conn.execute(
+                    'select doc from sites where id = ?', (site.id,)).fetchone()
+            if row:
+                doc = loads(row[0])
+                for field, delta in deltas.items():
+                    if isinstance(delta, dict):
+                        if field in doc:
+                            doc[field] = brozzler.frontier._add_counters(
+                                    doc[field], delta)
+                    else:
+                        doc[field] = (doc.get(field) or 0) + delta
+                self.rr.write(conn, 'sites', doc)
+        self._mirror_site_counters(site, deltas)
+
+    def _adjust_job_site_counts(self, job_id, deltas):
+        with self.rr.transaction() as conn:
+            row = conn.execute(
+                    'select doc from jobs where id = ?', (job_id,)).fetchone()
+            if row:
+                doc = loads(row[0])
+                if 'site_counts' in doc:
+                    for status, delta in deltas.items():
+                        doc['site_counts'][status] = (
+                                doc['site_counts'].get(status, 0) + delta)
+                    self.rr.write(conn, 'jobs', doc)
+
+    def _count_job_sites(self, job_id):
+        return dict(self.rr.query(
+                'select status, count(*) from sites where job_id = ? '
+                'group by status', (job_id,)))
+
+    def _replace_job_site_counts(self, job_id, old_counts, new_counts):
+        with self.rr.transaction() as conn:
+            row = conn.execute(
+                    'select doc from jobs where id = ?', (job_id,)).fetchone()
+            if not row:
+                return False
+            doc = loads(row[0])
+            if doc.get('site_counts') != old_counts:
+                return False
+            doc['site_counts'] = new_counts
+            self.rr.write(conn, 'jobs', doc)
+        return True
+
+    def claim_pages(self, site, worker_id, n):
+        # ignores the "claimed" field of the page, see
+        # RethinkDbFrontier.claim_pages()
+        pages = []
+        with self.rr.transaction() as conn:
+            rows = conn.execute(
+                    'select doc from pages where site_id = ? and '
+                    'brozzle_count = 0 order by claimed desc, priority desc '
+                    'limit ?', (site.id, n)).fetchall()
+            for row in rows:
+                page = brozzler.Page(self.rr, loads(row[0]))
+                page.claimed = True
+                page.last_claimed_by = worker_id
+                self.rr.save(conn, page)
+                pages.append(page)
+        pages.sort(key=lambda page: page.priority, reverse=True)
+        return pages
+
+    def unclaim_pages(self, pages):
+        with self.rr.transaction() as conn:
+            for page in pages:
+                row = conn.execute(
+                        'select doc from pages where id = ?',
+                        (page.id,)).fetchone()
+                if row:
+                    doc = loads(row[0])
+                    doc['claimed'] = False
+                    self.rr.write(conn, 'pages', doc)
+
+    def _has_unbrozzled_pages(self, site):
+        rows = self.rr.query(
+                'select 1 from pages where site_id = ? and brozzle_count = 0 '
+                'limit 1', (site.id,))
+        return len(rows) > 0
+
+    def active_jobs(self):
+        for row in self.rr.query(
+                'select doc from jobs where status = ?', ('ACTIVE',)):
+            yield brozzler.Job(self.rr, loads(row[0]))
+
+    def _schedule_pages(self, pages):
+        added = []
+        updated = []
+        for i in range(0, len(pages), self.SCHEDULE_CHUNK_SIZE):
+            chunk = pages[i:i+self.SCHEDULE_CHUNK_SIZE]
+            with self.rr.transaction() as conn:
+                rows = conn.execute(
+                        'select id, doc from pages where id in (%s)' % (
+                            ', '.join('?' * len(chunk))),
+                        [page.id for page in chunk]).fetchall()
+                existing = {row[0]: loads(row[1]) for row in rows}
+                for page in chunk:
+                    if page.id in existing:
+                        old_page = existing[page.id]
+                        old_page['priority'] += page.priority
+                        if page.hashtags:
+                            old_page['hashtags'] = list(
+                                    set(old_page.get('hashtags') or [])
+                                    | set(page.hashtags))
+                        self.rr.write(conn, 'pages', old_page)
+                        updated.append(brozzler.Page(self.rr, old_page))
+                    else:
+                        self.rr.write(conn, 'pages', page, insert=True)
+                        added.append(page)
+        return added, updated
+
+    def lease_host(self, host):
+        now = doublethink.utcnow()
+        with self.rr.transaction() as conn:
+            row = conn.execute(
+                    'select doc from hosts where id = ?', (host,)).fetchone()
+            doc = loads(row[0]) if row else {'id': host}
+            leased = (doc.get('lease') and doc.get('lease_expires')
+                    and doc['lease_expires'] > now)
+            if leased or (doc.get('available_at')
+                          and doc['available_at'] > now):
+                raise self._host_busy(doc, now)
+            doc['lease'] = str(uuid.uuid4())
+            doc['leased_at'] = now
+            doc['lease_expires'] = now + datetime.timedelta(
+                    seconds=self.HOST_LEASE_SECONDS)
+            doc['available_at'] = now
+            self.rr.write(conn, 'hosts', doc, insert=not row)
+        return doc['lease']
+
+    def release_host(self, host, lease, delay=0):
+        with self.rr.transaction() as conn:
+            row = conn.execute(
+                    'select doc from hosts where id = ?', (host,)).fetchone()
+            if row:
+                doc = loads(row[0])
+                if doc.get('lease') == lease:
+                    doc['lease'] = None
+                    doc['available_at'] = doublethink.utcnow() + (
+                            datetime.timedelta(seconds=delay))
+                    self.rr.write(conn, 'hosts', doc)
+
+    def _save_outlinks(self, page, outlinks):
+        doc = dict(outlinks)
+        doc.update({'id': page.id, 'site_id': page.site_id})
+        with self.rr.transaction() as conn:
+            conn.execute('delete from outlinks where id = ?', (page.id,))
+            self.rr.write(conn, 'outlinks', doc, insert=True)
+
+    def _load_outlinks(self, page_id):
+        rows = self.rr.query(
+                'select doc from outlinks where id = ?', (page_id,))
+        if rows:
+            doc = loads(rows[0][0])
+            return {k: doc.get(k, []) for k in (
+                'accepted', 'blocked', 'rejected')}
+        return None
+
+    def _outlinks_docs(self, page_ids):
+        rows = self.rr.query(
+                'select doc from outlinks where id in (%s)' % ', '.join(
+                    '?' * len(page_ids)), page_ids)
+        return [loads(row[0]) for row in rows]
+
+    def _load_seen_pages(self, site_id):
+        rows = self.rr.query(
+                'select doc from seen_pages where id = ?', (site_id,))
+        return loads(rows[0][0]) if rows else None
+
+    def _delete_seen_pages(self, site_id):
+        with self.rr.transaction() as conn:
+            conn.execute('delete from seen_pages where id = ?', (site_id,))
+
+    def write_docs(self, table, docs):
+        # table comes from snapshot files, among other places, and can't be
+        # passed to sqlite as a parameter
+        if table not in self.rr.COLUMNS:
+            raise ValueError('unknown table %r' % table)
+        with self.rr.transaction() as conn:
+            for doc in docs:
+                conn.execute(
+                        'delete from %s where id = ?' % table, (doc['id'],))
+                self.rr.write(conn, table, doc, insert=True)
+        return len(docs)
+
+    def _insert_new_pages(self, pages):
+        added = []
+        updated = []
+        for i in range(0, len(pages), self.SCHEDULE_CHUNK_SIZE):
+            chunk = pages[i:i+self.SCHEDULE_CHUNK_SIZE]
+            try:
+                with self.rr.transaction() as conn:
+                    for page in chunk:
+                        self.rr.write(conn, 'pages', page, insert=True)
+                added.extend(chunk)
+            except sqlite3.IntegrityError:
+                # rolled back, some of them exist after all
+                a, u = self._schedule_pages(chunk)
+                added.extend(a)
+                updated.extend(u)
+        return added, updated
+
+    def job_sites(self, job_id):
+        for row in self.rr.query(
+                'select doc from sites where job_id = ?', (job_id,)):
+            yield brozzler.Site(self.rr, loads(row[0]))
+
+    def seed_page(self, site_id):
+        rows = self.rr.query(
+                'select doc from pages where site_id = ? and '
+                'hops_from_seed = 0', (site_id,))
+        if len(rows) > 1:
+            self.logger.warn(
+                    "more than one seed page for site_id %s ?", site_id)
+        if len(rows) < 1:
+            return None
+        return brozzler.Page(self.rr, loads(rows[0][0]))
+
+    def site_pages(self, site_id, brozzled=None):
+        sql = 'select rowid, doc from pages where site_id = ? and rowid > ?'
+        if brozzled is True:
+            sql += ' and brozzle_count > 0'
+        elif brozzled is False:
+            sql += ' and brozzle_count = 0'
+        sql += ' order by rowid limit ?'
+        # read in batches, without holding the lock, since sites can be huge
+        rowid = 0
+        while True:
+            rows = self.rr.query(
+                    sql, (site_id, rowid, self.EXPORT_BATCH_SIZE))
+            for row in rows:
+                yield brozzler.Page(self.rr, loads(row[1]))
+            if len(rows) < self.EXPORT_BATCH_SIZE:
+                break
+            rowid = rows[-1][0]
+
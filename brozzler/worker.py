@@ -21,6 +21,10 @@ limitations under the License.
 import logging
 import brozzler
 import brozzler.browser
+import brozzler.canon
+import brozzler.frontier
+import brozzler.recordwriter
+import brozzler.robots
 import threading
 import time
 import youtube_dl
@@ -32,8 +36,12 @@ import socket
 import collections
 import requests
 import doublethink
+import datetime
 import tempfile
-import urlcanon
+import heapq
+import concurrent.futures
+import os
+import re
 from requests.structures import CaseInsensitiveDict
 import rethinkdb as r
 
@@ -95,17 +103,504 @@ class YoutubeDLSpy(urllib.request.BaseHandler):
 
         return final_bounces
 
+class YoutubeDLExtractorIndex:
+    '''
+    Tells whether any youtube-dl extractor other than the generic one might
+    handle a url, without asking each of the 1000+ extractors in turn. Their
+    `_VALID_URL` regexes are combined into a few big regexes. Extractors
+    whose regexes can't be combined (backreferences, inline flags) are
+    matched one by one, and extractors with their own `suitable()` are asked
+    directly.
+
+    Can answer yes when youtube-dl would end up using the generic extractor
+    after all, but never the other way around.
+    '''
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    # number of `_VALID_URL` regexes per combined regex
+    CHUNK_SIZE = 200
+
+    _UNCOMBINABLE = re.compile(r'\(\?P=|\\[1-9]|\(\?\(|\(\?[aiLmsux]+\)')
+    _NAMED_GROUP = re.compile(r'\(\?P<\w+>')
+
+    def __init__(self, extractor_classes=None):
+        if extractor_classes is None:
+            extractor_classes = youtube_dl.extractor.gen_extractor_classes()
+        default_suitable = youtube_dl.extractor.common.InfoExtractor.suitable
+        combinable = []
+        self._regexes = []
+        self._extractors = []
+        for ie in extractor_classes:
+            if ie.ie_key() == 'Generic':
+                continue
+            if (ie.suitable.__func__ is not default_suitable.__func__
+                    or not getattr(ie, '_VALID_URL', None)):
+                self._extractors.append(ie)
+            elif self._UNCOMBINABLE.search(ie._VALID_URL):
+                self._regexes.append(re.compile(ie._VALID_URL))
+            else:
+                # group names would collide in the combined regex
+                combinable.append(self._NAMED_GROUP.sub('(?:', ie._VALID_URL))
+        for i in range(0, len(combinable), self.CHUNK_SIZE):
+            self._regexes.append(re.compile('|'.join(
+                '(?:%s)' % regex
+                for regex in combinable[i:i+self.CHUNK_SIZE])))
+        self.logger.info(
+                'indexed %s youtube-dl extractors in %s regexes, %s '
+                'extractors to be asked individually', len(combinable),
+                len(self._regexes), len(self._extractors))
+
+    def suitable(self, url):
+        '''
+        Returns True if an extractor other than the generic one might be
+        suitable for `url`.
+        '''
+        for regex in self._regexes:
+            if regex.match(url):
+                return True
+        for ie in self._extractors:
+            if ie.suitable(url):
+                return True
+        return False
+
+_ydl_extractor_index = None
+_ydl_extractor_index_lock = threading.Lock()
+def ydl_extractor_index():
+    '''
+    Returns the process-wide `YoutubeDLExtractorIndex`, building it the first
+    time it is needed.
+    '''
+    global _ydl_extractor_index
+    with _ydl_extractor_index_lock:
+        if _ydl_extractor_index is None:
+            _ydl_extractor_index = YoutubeDLExtractorIndex()
+        return _ydl_extractor_index
+
+class YoutubeDLNegativeCache:
+    '''
+    Learns which kinds of urls youtube-dl's generic extractor finds no videos
+    on. Urls of the same kind share the host, first path segment, path depth,
+    file extension and whether there is a query string. After `threshold`
+    pages of one kind in a row on which the generic extractor found nothing,
+    `skip()` says to skip youtube-dl for that kind of url. Finding a video on
+    a page of that kind starts the count over.
+
+    At most `max_size` kinds of urls are tracked; the least recently seen are
+    forgotten first.
+    '''
+    def __init__(self, threshold=10, max_size=10000):
+        self.threshold = threshold
+        self.max_size = max_size
+        self._counts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def url_pattern(url):
+        canon = brozzler.canon.canonicalize(url).whatwg
+        segments = canon.path.split(b'/')[1:]
+        first = segments[0] if len(segments) > 1 else b''
+        ext = os.path.splitext(segments[-1])[1] if segments else b''
+        return (canon.host, first, len(segments), ext.lower(),
+                bool(canon.query))
+
+    def skip(self, url):
+        pattern = self.url_pattern(url)
+        with self._lock:
+            if pattern in self._counts:
+                self._counts.move_to_end(pattern)
+                return self._counts[pattern] >= self.threshold
+            return False
+
+    def note_no_video(self, url):
+        pattern = self.url_pattern(url)
+        with self._lock:
+            self._counts[pattern] = self._counts.get(pattern, 0) + 1
+            self._counts.move_to_end(pattern)
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+
+    def note_video(self, url):
+        pattern = self.url_pattern(url)
+        with self._lock:
+            self._counts.pop(pattern, None)
+
+class SitePageQueue:
+    '''
+    Worker-local priority queue of pages of `site` to brozzle. Pages are
+    claimed from the frontier `batch_size` at a time, which is safe because
+    only one worker brozzles a site at a time.
+    '''
+    def __init__(self, frontier, site, worker_id, batch_size):
+        self.frontier = frontier
+        self.site = site
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self._heap = []   # [(-priority, n, page), ...]
+        self._pages = {}  # {page_id: page, ...}
+        self._n = 0       # tie breaker, keeps heap order stable
+
+    def __len__(self):
+        return len(self._pages)
+
+    def _push(self, page):
+        self._n += 1
+        self._pages[page.id] = page
+        heapq.heappush(self._heap, (-page.priority, self._n, page))
+
+    def pop(self):
+        '''
+        Returns the highest priority page, claiming the next batch from the
+        frontier if the queue is empty.
+
+        Raises:
+            brozzler.NothingToClaim: if there are no pages left to brozzle
+        '''
+        if not self._heap:
+            for page in self.frontier.claim_pages(
+                    self.site, self.worker_id, self.batch_size):
+                self._push(page)
+        if not self._heap:
+            raise brozzler.NothingToClaim
+        page = heapq.heappop(self._heap)[2]
+        del self._pages[page.id]
+        return page
+
+    def merge(self, pages):
+        '''
+        Merges `pages`, as stored just after scheduling them (see
+        `brozzler.frontier.Frontier.scope_and_schedule_outlinks`), into the
+        queue. Pages already in the queue get their new priority and hashtags.
+        Unbrozzled pages with higher priority than the lowest priority page in
+        the queue are added, so that they are brozzled before the pages that
+        are already queued. Lower priority pages are left for a later batch.
+        '''
+        if not self._heap:
+            return
+        lowest = -max(self._heap)[0]
+        for page in pages or []:
+            if page.brozzle_count:
+                continue
+            queued = self._pages.get(page.id)
+            if queued:
+                queued.priority = page.priority
+                if page.hashtags:
+                    queued.hashtags = page.hashtags
+            elif page.priority > lowest:
+                self._pages[page.id] = page
+        self._heap = []
+        for page in self._pages.values():
+            self._n += 1
+            self._heap.append((-page.priority, self._n, page))
+        heapq.heapify(self._heap)
+
+    def push_back(self, page):
+        '''Puts back a page returned by `pop` that was not brozzled.'''
+        self._push(page)
+
+    def drain(self):
+        '''Empties the queue, returns the pages that were in it.'''
+        pages = list(self._pages.values())
+        self._heap = []
+        self._pages = {}
+        return pages
+
+class SitePipeline:
+    '''
+    Pipelined brozzling of the pages of a site, used by
+    `BrozzlerWorker.brozzle_site` if the worker has `pipeline_threads`. While
+    chrome browses a page, a small thread pool prepares the next page (robots
+    check and youtube-dl) and finishes the pages already browsed
+    (screenshots, marking the page brozzled, scheduling its outlinks).
+
+    Pages are finished one at a time, in the order they were browsed, and
+    seed pages are finished before moving on, since a seed redirect changes
+    the scope of the site. The next page is only prepared ahead of time if
+    it is on the same host as the page being browsed and there is no crawl
+    delay, since the host lease held for the current page covers it.
+    '''
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, worker, browser, site, queue, seen, threads):
+        self.worker = worker
+        self.browser = browser
+        self.site = site
+        self.queue = queue
+        self.seen = seen
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+        # one thread, so that pages are finished in order
+        self._finisher = concurrent.futures.ThreadPoolExecutor(1)
+        self._next = None  # (page, future) of the page prepared ahead
+        self._finishing = collections.deque()  # [(page, future), ...]
+        self._failed = []
+
+    def pop(self):
+        '''Returns the next page to brozzle, see `SitePageQueue.pop`.'''
+        if self._next:
+            return self._next[0]
+        if not self.queue and self._finishing:
+            # pages must be finished before claiming more, or they would be
+            # claimed again, and their outlinks may be all that's left
+            self.merge_finished(wait=True)
+        return self.queue.pop()
+
+    def push_back(self, page):
+        '''Puts back a page returned by `pop` that was not brozzled.'''
+        if self._next and self._next[0] is page:
+            concurrent.futures.wait([self._next[1]])
+            self._next = None
+        self.queue.push_back(page)
+
+    def _prepare(self, page):
+        '''
+        Returns:
+            tuple (blocked_by_robots, ydl_spy)
+        '''
+        if (page.needs_robots_check and not brozzler.is_permitted_by_robots(
+                self.site, page.url, self.worker._proxy_for(self.site))):
+            return True, None
+        return False, self.worker._youtube_dl_page(self.site, page)
+
+    def _prepare_next(self, page):
+        '''
+        Starts preparing the next page in the queue, if it is on the same
+        host as `page`.
+        '''
+        if not self.queue:
+            # claiming more pages now would claim `page` again, since the
+            # frontier ignores page claims
+            return
+        next_page = self.queue.pop()
+        if (brozzler.canon.canonicalize(next_page.url).whatwg.host
+                != brozzler.canon.canonicalize(page.url).whatwg.host):
+            self.queue.push_back(next_page)
+            return
+        self._next = (next_page, self._pool.submit(self._prepare, next_page))
+
+    def brozzle(self, page):
+        '''
+        Brozzles `page`, which has been returned by `pop()` and whose host
+        has been leased. Returns as soon as chrome is done with the page,
+        the rest happens in the background.
+        '''
+        if self._next and self._next[0] is page:
+            future = self._next[1]
+            self._next = None
+            with brozzler.thread_accept_exceptions():
+                blocked, ydl_spy = future.result()
+        else:
+            blocked, ydl_spy = self._prepare(page)
+
+        if blocked:
+            logging.warn("page %s is blocked by robots.txt", page.url)
+            page.blocked_by_robots = True
+            self._finish(page, None, [])
+            return
+
+        self.logger.info("brozzling %s", page)
+        if not self.worker._crawl_delay(self.site, page):
+            self._prepare_next(page)
+        screenshots = []
+        outlinks = self.worker._browse_or_fetch(
+                self.browser, self.site, page, ydl_spy,
+                screenshots=screenshots)
+        if self.browser.is_running():
+            self.site.cookie_db = \
+                    self.browser.chrome.persist_and_read_cookie_db()
+        self._finish(page, outlinks, screenshots)
+
+    def _finish(self, page, outlinks, screenshots):
+        future = self._finisher.submit(
+                self._finish_page, page, outlinks, screenshots)
+        self._finishing.append((page, future))
+        if page.hops_from_seed == 0:
+            self.merge_finished(wait=True)
+
+    def _finish_page(self, page, outlinks, screenshots):
+        for screenshot_jpeg, thumbnail_jpeg in screenshots:
+            self.worker._write_screenshot(
+                    self.site, page, screenshot_jpeg, thumbnail_jpeg)
+        self.worker._frontier.completed_page(self.site, page)
+        self.seen.add_brozzled(page.id)
+        if outlinks is None:
+            return []
+        return self.worker._frontier.scope_and_schedule_outlinks(
+                self.site, page, outlinks, self.seen)
+
+    def merge_finished(self, wait=False):
+        '''
+        Merges the outlinks of pages that are done finishing into the queue,
+        in order. If `wait` is True, waits for all pages to finish first.
+
+        Raises:
+            the exception raised finishing a page, if any
+        '''
+        while self._finishing:
+            page, future = self._finishing[0]
+            if not wait and not future.done():
+                break
+            try:
+                with brozzler.thread_accept_exceptions():
+                    outlinks = future.result()
+            except:
+                if future.done():
+                    self._finishing.popleft()
+                    self._failed.append(page)
+                raise
+            self._finishing.popleft()
+            self.queue.merge(outlinks)
+
+    def close(self):
+        '''
+        Waits for pages being prepared and finished, and shuts down the
+        thread pool. A page prepared ahead is pushed back into the queue.
+
+        Returns:
+            list of pages that failed to finish, which are still claimed
+        '''
+        if self._next:
+            self.push_back(self._next[0])
+        for page, future in self._finishing:
+            if future.exception():
+                self.logger.error(
+                        "failed to finish brozzling %s", page,
+                        exc_info=future.exception())
+                self._failed.append(page)
+        self._finishing.clear()
+        self._pool.shutdown()
+        self._finisher.shutdown()
+        return self._failed
+
+class HostLease:
+    '''
+    The host lease held by `BrozzlerWorker.brozzle_site` for a site. The lease
+    is kept while the site's pages come from the same host, and the crawl
+    delay between them is waited out here. Setting the site aside after each
+    page would be much slower, and so would writing a lease and a release to
+    the frontier for each page.
+
+    Without a crawl delay, up to `max_browsers` browsers across the cluster
+    may hold leases on the same host at the same time (one lease per "slot").
+    With a crawl delay, only one may.
+    '''
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, frontier, max_browsers=1, max_wait=30):
+        self.frontier = frontier
+        self.max_browsers = max_browsers
+        self.max_wait = max_wait
+        self.host = None
+        self._key = None    # id of the leased host document
+        self._lease = None
+        self._delay = 0
+        self._next_fetch = 0.0
+
+    def acquire(self, host, delay):
+        '''
+        Makes sure `host` is leased and its crawl delay `delay` has elapsed
+        since the last page fetched from it, waiting up to `max_wait`
+        seconds for that. Releases the lease on any other host.
+
+        Raises:
+            brozzler.HostBusy: if the host is leased by other browsers, or
+                the crawl delay would take too long to wait out
+        '''
+        if host != self.host:
+            self.release()
+            self._key, self._lease = self._lease_host(host, delay)
+            self.host = host
+        self._delay = delay
+        wait = self._next_fetch - time.time()
+        if wait > self.max_wait:
+            self.release()
+            raise brozzler.HostBusy(
+                    host, doublethink.utcnow()
+                    + datetime.timedelta(seconds=wait))
+        if wait > 0:
+            self.logger.info(
+                    "waiting %.1fs for the crawl delay of %s", wait, host)
+            with brozzler.thread_accept_exceptions():
+                while time.time() < self._next_fetch:
+                    time.sleep(min(0.5, self._next_fetch - time.time()))
+
+    def fetched(self):
+        '''Notes that a page has been fetched from the leased host.'''
+        if self._lease:
+            self._next_fetch = time.time() + self._delay
+
+    def release(self):
+        '''
+        Releases the lease, if any. The remainder of the crawl delay is
+        left for the next browser to lease the host.
+        '''
+        if self._lease:
+            self.frontier.release_host(
+                    self._key, self._lease,
+                    max(0, self._next_fetch - time.time()))
+        self.host = self._key = self._lease = None
+        self._next_fetch = 0.0
+
+    def _lease_host(self, host, delay):
+        busy = None
+        for slot in range(1 if delay else self.max_browsers):
+            key = host if slot == 0 else "%s#%s" % (host, slot)
+            try:
+                return key, self.frontier.lease_host(key)
+            except brozzler.HostBusy as e:
+                if not busy or e.available_at < busy.available_at:
+                    busy = brozzler.HostBusy(host, e.available_at)
+        raise busy
+
+def jpeg_width(jpeg_bytes):
+    '''Returns the width of a jpeg image, reading only its header.'''
+    return PIL.Image.open(io.BytesIO(jpeg_bytes)).size[0]
+
+def make_thumbnail(screenshot_jpeg):
+    '''
+    Returns a `brozzler.browser.Browser.THUMBNAIL_WIDTH` wide jpeg (bytes) of
+    `screenshot_jpeg`. PIL releases the GIL while decoding, scaling and
+    encoding, so this doesn't hold up the other threads of the worker much.
+    '''
+    img = PIL.Image.open(io.BytesIO(screenshot_jpeg))
+    thumb_width = brozzler.browser.Browser.THUMBNAIL_WIDTH
+    thumb_height = round((thumb_width / img.size[0]) * img.size[1])
+    # decodes the jpeg at reduced size, much faster than decoding it all
+    img.draft('RGB', (thumb_width, thumb_height))
+    img = img.resize((thumb_width, thumb_height), PIL.Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(
+            out, "jpeg", quality=brozzler.browser.Browser.SCREENSHOT_QUALITY)
+    return out.getvalue()
+
 class BrozzlerWorker:
     logger = logging.getLogger(__module__ + "." + __qualname__)
 
+    # also how often claims on the sites being brozzled are renewed, which
+    # should be well within `brozzler.frontier.Frontier.CLAIM_LEASE_SECONDS`
     HEARTBEAT_INTERVAL = 20.0
+    # max seconds the crawl control thread waits before noticing that the set
+    # of sites being brozzled has changed
+    CONTROL_WAIT = 1.0
+    # number of pages of a site to claim from the frontier at once
+    PAGE_CLAIM_BATCH_SIZE = 10
+    # youtube-dl is skipped on urls that only its generic extractor could
+    # handle, once it has found no videos on this many similar pages in a row
+    YOUTUBE_DL_SKIP_AFTER = 10
+    # a site whose next page has to wait longer than this for the crawl delay
+    # of its host is set aside until then, freeing the browser
+    MAX_CRAWL_DELAY_WAIT = 30
 
     def __init__(
             self, frontier, service_registry=None, max_browsers=1,
-            chrome_exe="chromium-browser", warcprox_auto=False, proxy=None):
+            chrome_exe="chromium-browser", warcprox_auto=False, proxy=None,
+            pipeline_threads=0, max_browsers_per_host=2):
         self._frontier = frontier
         self._service_registry = service_registry
         self._max_browsers = max_browsers
+        self._pipeline_threads = pipeline_threads
+        self._max_browsers_per_host = max_browsers_per_host
+        # claims sites and renews the claims, unique to this process so that
+        # another worker on the same host can't keep our claims alive
+        self._worker_id = "%s:%s" % (socket.gethostname(), os.getpid())
 
         self._warcprox_auto = warcprox_auto
         self._proxy = proxy
@@ -114,8 +609,16 @@ class BrozzlerWorker:
 
         self._browser_pool = brozzler.browser.BrowserPool(
                 max_browsers, chrome_exe=chrome_exe, ignore_cert_errors=True)
-        self._browsing_threads = set()
+        self._browsing_threads = {}  # {thread: site, ...}
+        self._time_limited_threads = set()
+        self._stopped_threads = set()
+        self._job_stop_requests = {}  # {job_id: stop_requested, ...}
         self._browsing_threads_lock = threading.Lock()
+        self._control_thread = None
+        self._last_heartbeat = None
+        self._ydl_negative_cache = YoutubeDLNegativeCache(
+                self.YOUTUBE_DL_SKIP_AFTER)
+        self._record_writer = brozzler.recordwriter.RecordWriter()
 
         self._thread = None
         self._start_stop_lock = threading.Lock()
@@ -181,34 +684,19 @@ class BrozzlerWorker:
         ydl._opener.add_handler(ydl.brozzler_spy)
         return ydl
 
-    def _warcprox_write_record(
-            self, warcprox_address, url, warc_type, content_type,
-            payload, extra_headers=None):
-        headers = {"Content-Type":content_type,"WARC-Type":warc_type,"Host":"N/A"}
-        if extra_headers:
-            headers.update(extra_headers)
-        request = urllib.request.Request(url, method="WARCPROX_WRITE_RECORD",
-                headers=headers, data=payload)
+    def _write_record(
+            self, site, url, warc_type, content_type, payload):
+        '''
+        Queues a record to be written by the warcprox of `site` in the
+        background, see `brozzler.recordwriter.RecordWriter`.
 
-        # XXX setting request.type="http" is a hack to stop urllib from trying
-        # to tunnel if url is https
-        request.type = "http"
-        request.set_proxy(warcprox_address, "http")
-
-        try:
-            with urllib.request.urlopen(request) as response:
-                if response.getcode() != 204:
-                    self.logger.warn(
-                            'got "%s %s" response on warcprox '
-                            'WARCPROX_WRITE_RECORD request (expected 204)',
-                            response.getcode(), response.reason)
-        except urllib.error.HTTPError as e:
-            self.logger.warn(
-                    'got "%s %s" response on warcprox '
-                    'WARCPROX_WRITE_RECORD request (expected 204)',
-                    e.getcode(), e.info())
-        except urllib.error.URLError as e:
-            raise brozzler.ProxyError('_warcprox_write_record: %s', e)
+        Raises:
+            brozzler.ProxyError: if an earlier record of `site` could not be
+                written
+        '''
+        self._record_writer.write(
+                site.id, self._proxy_for(site), url, warc_type, content_type,
+                payload, extra_headers=site.extra_headers())
 
     def _remember_videos(self, page, ydl_spy):
         if not 'videos' in page:
@@ -233,29 +721,42 @@ class BrozzlerWorker:
                 page.videos.append(video)
 
     def _try_youtube_dl(self, ydl, site, page):
+        generic_only = not ydl_extractor_index().suitable(page.url)
+        if generic_only and self._ydl_negative_cache.skip(page.url):
+            # skipping youtube-dl leaves the spy empty, so the page is browsed
+            self.logger.info(
+                    "skipping youtube-dl on %s, no videos found on similar "
+                    "pages", page)
+            return
         try:
             self.logger.info("trying youtube-dl on {}".format(page))
             with brozzler.thread_accept_exceptions():
                 info = ydl.extract_info(page.url)
+            if generic_only:
+                self._ydl_negative_cache.note_video(page.url)
             self._remember_videos(page, ydl.brozzler_spy)
             # logging.info('XXX %s', json.dumps(info))
             if self._using_warcprox(site):
                 info_json = json.dumps(info, sort_keys=True, indent=4)
                 self.logger.info(
-                        "sending WARCPROX_WRITE_RECORD request to warcprox "
+                        "queuing WARCPROX_WRITE_RECORD request to warcprox "
                         "with youtube-dl json for %s", page)
-                self._warcprox_write_record(
-                        warcprox_address=self._proxy_for(site),
-                        url="youtube-dl:%s" % str(urlcanon.semantic(page.url)),
+                self._write_record(
+                        site,
+                        url="youtube-dl:%s" % str(brozzler.canon.canonicalize(page.url).semantic),
                         warc_type="metadata",
                         content_type="application/vnd.youtube-dl_formats+json;charset=utf-8",
-                        payload=info_json.encode("utf-8"),
-                        extra_headers=site.extra_headers())
+                        payload=info_json.encode("utf-8"))
         except brozzler.ShutdownRequested as e:
             raise
         except BaseException as e:
             if hasattr(e, "exc_info") and e.exc_info[0] == youtube_dl.utils.UnsupportedError:
-                pass
+                # only learn from html pages, which is what the generic
+                # extractor spends its time looking for videos in
+                if (generic_only
+                        and ydl.brozzler_spy.final_bounces(page.url)
+                        and self._needs_browsing(page, ydl.brozzler_spy)):
+                    self._ydl_negative_cache.note_no_video(page.url)
             elif (hasattr(e, "exc_info")
                     and e.exc_info[0] == urllib.error.HTTPError
                     and hasattr(e.exc_info[1], "code")
@@ -270,24 +771,33 @@ class BrozzlerWorker:
             else:
                 raise
 
-    def full_and_thumb_jpegs(self, large_png):
-        img = PIL.Image.open(io.BytesIO(large_png))
+    def brozzle_page(self, browser, site, page, on_screenshot=None):
+        '''
+        Brozzles `page`, returning once its warc records have been written.
 
-        out = io.BytesIO()
-        img.save(out, "jpeg", quality=95)
-        full_jpeg = out.getbuffer()
+        Returns:
+            list of outlinks
+        '''
+        outlinks = self._brozzle_page(browser, site, page, on_screenshot)
+        self._record_writer.flush(site.id)
+        self._record_writer.check(site.id)
+        return outlinks
 
-        thumb_width = 300
-        thumb_height = (thumb_width / img.size[0]) * img.size[1]
-        img.thumbnail((thumb_width, thumb_height))
-        out = io.BytesIO()
-        img.save(out, "jpeg", quality=95)
-        thumb_jpeg = out.getbuffer()
+    def _brozzle_page(self, browser, site, page, on_screenshot=None):
+        self.logger.info("brozzling {}".format(page))
+        ydl_spy = self._youtube_dl_page(site, page)
+        return self._browse_or_fetch(
+                browser, site, page, ydl_spy, on_screenshot)
 
-        return full_jpeg, thumb_jpeg
+    def _youtube_dl_page(self, site, page):
+        '''
+        Runs youtube-dl on `page`, the first step of `brozzle_page`.
 
-    def brozzle_page(self, browser, site, page, on_screenshot=None):
-        self.logger.info("brozzling {}".format(page))
+        Returns:
+            YoutubeDLSpy: the http transactions youtube-dl made, for
+                `_browse_or_fetch`
+        '''
+        ydl_spy = None
         try:
             with tempfile.TemporaryDirectory(prefix='brzl-ydl-') as tempdir:
                 ydl = self._youtube_dl(tempdir, site)
@@ -297,6 +807,10 @@ class BrozzlerWorker:
             raise
         except brozzler.ShutdownRequested:
             raise
+        except brozzler.ReachedTimeLimit:
+            raise
+        except brozzler.CrawlStopped:
+            raise
         except brozzler.ProxyError:
             raise
         except Exception as e:
@@ -310,10 +824,32 @@ class BrozzlerWorker:
                 self.logger.error(
                         'youtube_dl raised exception on %s', page,
                         exc_info=True)
+        return ydl_spy
+
+    def _browse_or_fetch(
+            self, browser, site, page, ydl_spy, on_screenshot=None,
+            screenshots=None):
+        '''
+        Browses `page`, or if youtube-dl found it isn't html, makes sure it
+        has been fetched. The second step of `brozzle_page`.
+
+        Args:
+            screenshots (list): if supplied, (screenshot_jpeg,
+                thumbnail_jpeg) tuples are appended to it for the caller to
+                write with `_write_screenshot`, instead of being written
+                right away
 
+        Returns:
+            list of outlinks
+        '''
         if self._needs_browsing(page, ydl_spy):
             self.logger.info('needs browsing: %s', page)
-            outlinks = self._browse_page(browser, site, page, on_screenshot)
+            outlinks = self._browse_page(
+                    browser, site, page, on_screenshot, screenshots)
+            if any(v['blame'] == 'browser' for v in page.get('videos', [])):
+                # youtube-dl might have found this one, keep trying it on
+                # similar pages
+                self._ydl_negative_cache.note_video(page.url)
             return outlinks
         else:
             if not self._already_fetched(page, ydl_spy):
@@ -323,28 +859,41 @@ class BrozzlerWorker:
                 self.logger.info('already fetched: %s', page)
             return []
 
-    def _browse_page(self, browser, site, page, on_screenshot=None):
-        def _on_screenshot(screenshot_png):
+    def _write_screenshot(
+            self, site, page, screenshot_jpeg, thumbnail_jpeg=None):
+        '''
+        Writes screenshot and thumbnail records for `page` to warcprox, if
+        the site is crawled through warcprox. If chrome didn't make a
+        thumbnail of the right size, one is made here.
+        '''
+        if self._using_warcprox(site):
+            self.logger.info(
+                    "queuing WARCPROX_WRITE_RECORD request to %s with "
+                    "screenshot for %s", self._proxy_for(site), page)
+            if not thumbnail_jpeg or abs(jpeg_width(thumbnail_jpeg)
+                    - brozzler.browser.Browser.THUMBNAIL_WIDTH) > 1:
+                thumbnail_jpeg = make_thumbnail(screenshot_jpeg)
+            self._write_record(
+                    site,
+                    url="screenshot:%s" % str(brozzler.canon.canonicalize(page.url).semantic),
+                    warc_type="resource", content_type="image/jpeg",
+                    payload=screenshot_jpeg)
+            self._write_record(
+                    site,
+                    url="thumbnail:%s" % str(brozzler.canon.canonicalize(page.url).semantic),
+                    warc_type="resource", content_type="image/jpeg",
+                    payload=thumbnail_jpeg)
+
+    def _browse_page(
+            self, browser, site, page, on_screenshot=None, screenshots=None):
+        shots = []  # [[screenshot_jpeg, thumbnail_jpeg], ...]
+        def _on_screenshot(screenshot_jpeg):
             if on_screenshot:
-                on_screenshot(screenshot_png)
-            if self._using_warcprox(site):
-                self.logger.info(
-                        "sending WARCPROX_WRITE_RECORD request to %s with "
-                        "screenshot for %s", self._proxy_for(site), page)
-                screenshot_jpeg, thumbnail_jpeg = self.full_and_thumb_jpegs(
-                        screenshot_png)
-                self._warcprox_write_record(
-                        warcprox_address=self._proxy_for(site),
-                        url="screenshot:%s" % str(urlcanon.semantic(page.url)),
-                        warc_type="resource", content_type="image/jpeg",
-                        payload=screenshot_jpeg,
-                        extra_headers=site.extra_headers())
-                self._warcprox_write_record(
-                        warcprox_address=self._proxy_for(site),
-                        url="thumbnail:%s" % str(urlcanon.semantic(page.url)),
-                        warc_type="resource", content_type="image/jpeg",
-                        payload=thumbnail_jpeg,
-                        extra_headers=site.extra_headers())
+                on_screenshot(screenshot_jpeg)
+            shots.append([screenshot_jpeg, None])
+
+        def _on_thumbnail(thumbnail_jpeg):
+            shots[-1][1] = thumbnail_jpeg
 
         def _on_response(chrome_msg):
             if ('params' in chrome_msg
@@ -378,8 +927,19 @@ class BrozzlerWorker:
                 behavior_parameters=site.get('behavior_parameters'),
                 username=site.get('username'), password=site.get('password'),
                 user_agent=site.get('user_agent'),
-                on_screenshot=_on_screenshot, on_response=_on_response,
-                hashtags=page.hashtags)
+                on_screenshot=_on_screenshot,
+                # nowhere to write a thumbnail without warcprox
+                on_thumbnail=(
+                    _on_thumbnail if self._using_warcprox(site) else None),
+                on_response=_on_response, hashtags=page.hashtags)
+        if browser.behavior_stats:
+            page.behavior_stats = browser.behavior_stats
+        for screenshot_jpeg, thumbnail_jpeg in shots:
+            if screenshots is not None:
+                screenshots.append((screenshot_jpeg, thumbnail_jpeg))
+            else:
+                self._write_screenshot(
+                        site, page, screenshot_jpeg, thumbnail_jpeg)
         if final_page_url != page.url:
             page.note_redirect(final_page_url)
         return outlinks
@@ -418,60 +978,146 @@ class BrozzlerWorker:
         return False
 
     def brozzle_site(self, browser, site):
+        page = None
+        queue = SitePageQueue(
+                self._frontier, site, "%s:%s" % (
+                    self._worker_id, browser.chrome.port),
+                self.PAGE_CLAIM_BATCH_SIZE)
+        seen = self._frontier.load_seen_pages(site)
+        pipeline = None
+        if self._pipeline_threads:
+            pipeline = SitePipeline(
+                    self, browser, site, queue, seen, self._pipeline_threads)
+        host_lease = HostLease(
+                self._frontier, self._max_browsers_per_host,
+                self.MAX_CRAWL_DELAY_WAIT)
+        unfinished = []
         try:
-            page = None
-            self._frontier.honor_stop_request(site)
-            self.logger.info(
-                    "brozzling site (proxy=%s) %s",
-                    repr(self._proxy_for(site)), site)
-            start = time.time()
-            while time.time() - start < 7 * 60:
-                site.refresh()
-                self._frontier.honor_stop_request(site)
-                page = self._frontier.claim_page(site, "%s:%s" % (
-                    socket.gethostname(), browser.chrome.port))
-
-                if (page.needs_robots_check and
-                        not brozzler.is_permitted_by_robots(
-                            site, page.url, self._proxy_for(site))):
-                    logging.warn("page %s is blocked by robots.txt", page.url)
-                    page.blocked_by_robots = True
-                    self._frontier.completed_page(site, page)
-                else:
-                    outlinks = self.brozzle_page(browser, site, page)
-                    self._frontier.completed_page(site, page)
-                    self._frontier.scope_and_schedule_outlinks(
-                            site, page, outlinks)
-                    if browser.is_running():
-                        site.cookie_db = browser.chrome.persist_and_read_cookie_db()
-
-                page = None
+            try:
+                self.logger.info(
+                        "brozzling site (proxy=%s) %s",
+                        repr(self._proxy_for(site)), site)
+                start = time.time()
+                while time.time() - start < 7 * 60:
+                    if self._control_thread:
+                        # site is kept up to date by the crawl control thread
+                        if self._stop_requested(site):
+                            raise brozzler.CrawlStopped
+                    else:
+                        # refreshes site
+                        self._frontier.honor_stop_request(site)
+                    if site.over_time_limit():
+                        raise brozzler.ReachedTimeLimit
+                    # a record of an earlier page that couldn't be written
+                    self._record_writer.check(site.id)
+                    if pipeline:
+                        pipeline.merge_finished()
+                    page = pipeline.pop() if pipeline else queue.pop()
+                    host = brozzler.canon.canonicalize(
+                            page.url).whatwg.host.decode("utf-8")
+                    try:
+                        host_lease.acquire(
+                                host, self._crawl_delay(site, page))
+                    except brozzler.HostBusy:
+                        # the page gets unclaimed along with the rest of the
+                        # queue
+                        (pipeline or queue).push_back(page)
+                        page = None
+                        raise
+
+                    try:
+                        if pipeline:
+                            pipeline.brozzle(page)
+                        elif (page.needs_robots_check and
+                                not brozzler.is_permitted_by_robots(
+                                    site, page.url, self._proxy_for(site))):
+                            logging.warn(
+                                    "page %s is blocked by robots.txt",
+                                    page.url)
+                            page.blocked_by_robots = True
+                            self._frontier.completed_page(site, page)
+                            seen.add_brozzled(page.id)
+                        else:
+                            outlinks = self._brozzle_page(
+                                    browser, site, page)
+                            self._frontier.completed_page(site, page)
+                            seen.add_brozzled(page.id)
+                            queue.merge(
+                                    self._frontier.scope_and_schedule_outlinks(
+                                        site, page, outlinks, seen))
+                            if browser.is_running():
+                                site.cookie_db = browser.chrome.persist_and_read_cookie_db()
+                    finally:
+                        host_lease.fetched()
+
+                    page = None
+            finally:
+                if pipeline:
+                    # wait for the background work before acting on the site
+                    unfinished = pipeline.close()
+                self._record_writer.flush(site.id)
+                host_lease.release()
         except brozzler.ShutdownRequested:
             self.logger.info("shutdown requested")
         except brozzler.NothingToClaim:
             self.logger.info("no pages left for site %s", site)
+        except brozzler.HostBusy as e:
+            # move on to another site instead of waiting for the host
+            self.logger.info(
+                    "%s is busy until %s, setting aside %s", e.host,
+                    e.available_at, site)
+            site.claim_after = e.available_at
         except brozzler.ReachedLimit as e:
             self._frontier.reached_limit(site, e)
         except brozzler.CrawlStopped:
             self._frontier.finished(site, "FINISHED_STOP_REQUESTED")
+        except brozzler.ReachedTimeLimit:
+            self._frontier.finished(site, "FINISHED_TIME_LIMIT")
         # except brozzler.browser.BrowsingAborted:
         #     self.logger.info("{} shut down".format(browser))
         except brozzler.ProxyError as e:
-            if self._warcprox_auto:
-                logging.error(
-                        'proxy error (site.proxy=%s), will try to choose a '
-                        'healthy instance next time site is brozzled: %s',
-                        site.proxy, e)
-                site.proxy = None
-            else:
-                # using brozzler-worker --proxy, nothing to do but try the
-                # same proxy again next time
-                logging.error(
-                        'proxy error (site.proxy=%s): %s', repr(site.proxy), e)
+            self._handle_proxy_error(site, e)
         except:
             self.logger.critical("unexpected exception", exc_info=True)
         finally:
-            self._frontier.disclaim_site(site, page)
+            try:
+                # records that failed after brozzling stopped
+                self._record_writer.check(site.id)
+            except brozzler.ProxyError as e:
+                self._handle_proxy_error(site, e)
+            try:
+                # for the next worker to brozzle the site
+                self._frontier.save_seen_pages(site, seen)
+            except:
+                self.logger.error(
+                        "problem saving seen pages of %s", site,
+                        exc_info=True)
+            self._frontier.disclaim_site(
+                    site, page, queue.drain() + unfinished)
+
+    def _handle_proxy_error(self, site, e):
+        if self._warcprox_auto:
+            logging.error(
+                    'proxy error (site.proxy=%s), will try to choose a '
+                    'healthy instance next time site is brozzled: %s',
+                    site.proxy, e)
+            site.proxy = None
+        else:
+            # using brozzler-worker --proxy, nothing to do but try the
+            # same proxy again next time
+            logging.error(
+                    'proxy error (site.proxy=%s): %s', repr(site.proxy), e)
+
+    def _crawl_delay(self, site, page):
+        '''
+        Returns number of seconds to wait before brozzling another page from
+        the host of `page`: the bigger of the configured `crawl_delay` and
+        the robots.txt `Crawl-delay`.
+        '''
+        delay = site.crawl_delay or 0
+        robots_delay = brozzler.robots.crawl_delay(
+                site, page.url, self._proxy_for(site))
+        return max(delay, robots_delay or 0)
 
     def _brozzle_site_thread_target(self, browser, site):
         try:
@@ -480,9 +1126,37 @@ class BrozzlerWorker:
             browser.stop()
             self._browser_pool.release(browser)
             with self._browsing_threads_lock:
-                self._browsing_threads.remove(threading.current_thread())
+                self._browsing_threads.pop(threading.current_thread())
+                self._time_limited_threads.discard(threading.current_thread())
+                self._stopped_threads.discard(threading.current_thread())
+
+    def _renew_site_claims(self):
+        '''
+        Renews the claims on the sites being brozzled, so that other workers
+        don't take them over.
+        '''
+        with self._browsing_threads_lock:
+            site_ids = [site.id for site in self._browsing_threads.values()]
+        if not site_ids:
+            return
+        try:
+            renewed = self._frontier.renew_claims(
+                    self._worker_id, site_ids)
+            if renewed < len(site_ids):
+                # normal if a site was disclaimed in the meantime
+                self.logger.info(
+                        "renewed only %s of %s site claims", renewed,
+                        len(site_ids))
+        except Exception as e:
+            self.logger.error(
+                    "failed to renew claims on sites %s: %s", site_ids, e)
 
     def _service_heartbeat(self):
+        self._last_heartbeat = time.time()
+        self._renew_site_claims()
+        if not self._service_registry:
+            return
+
         if hasattr(self, "status_info"):
             status_info = self.status_info
         else:
@@ -498,46 +1172,166 @@ class BrozzlerWorker:
             self.status_info = self._service_registry.heartbeat(status_info)
             self.logger.trace(
                     "status in service registry: %s", self.status_info)
-        except rethinkdb.ReqlError as e:
+        except r.ReqlError as e:
             self.logger.error(
                     "failed to send heartbeat and update service registry "
                     "with info %s: %s", status_info, e)
 
     def _service_heartbeat_if_due(self):
-        '''Sends service registry heartbeat if due'''
-        due = False
-        if self._service_registry:
-            if not hasattr(self, "status_info"):
-                due = True
-            else:
-                d = doublethink.utcnow() - self.status_info["last_heartbeat"]
-                due = d.total_seconds() > self.HEARTBEAT_INTERVAL
-
-        if due:
+        '''
+        Renews site claims and sends service registry heartbeat, if due
+        '''
+        if (self._last_heartbeat is None or time.time() - self._last_heartbeat
+                > self.HEARTBEAT_INTERVAL):
             self._service_heartbeat()
 
+    def _enforce_time_limits(self):
+        '''
+        Tells brozzling threads whose site has reached its time limit to stop,
+        so that they don't keep a browser busy until the end of their time
+        slice.
+        '''
+        with self._browsing_threads_lock:
+            for th, site in self._browsing_threads.items():
+                if (th not in self._time_limited_threads
+                        and site.over_time_limit()):
+                    self.logger.info(
+                            "%s reached time limit, stopping %s", site, th)
+                    # thread_raise() fails if the thread is not accepting
+                    # exceptions at the moment, in that case try again later
+                    if brozzler.thread_raise(th, brozzler.ReachedTimeLimit):
+                        self._time_limited_threads.add(th)
+
+    def _stop_requested(self, site):
+        now = doublethink.utcnow()
+        if site.stop_requested and site.stop_requested <= now:
+            return True
+        job_stop_requested = self._job_stop_requests.get(site.job_id)
+        return bool(job_stop_requested and job_stop_requested <= now)
+
+    def _enforce_stop_requests(self):
+        '''
+        Tells brozzling threads whose site or job has a stop request to stop.
+        '''
+        with self._browsing_threads_lock:
+            for th, site in self._browsing_threads.items():
+                if (th not in self._stopped_threads
+                        and self._stop_requested(site)):
+                    self.logger.info(
+                            "stop requested for %s, stopping %s", site, th)
+                    # if this fails brozzle_site() notices the stop request
+                    # before brozzling the next page
+                    if brozzler.thread_raise(th, brozzler.CrawlStopped):
+                        self._stopped_threads.add(th)
+
+    def _held_ids(self):
+        with self._browsing_threads_lock:
+            sites = list(self._browsing_threads.values())
+        return (frozenset(site.id for site in sites),
+                frozenset(site.job_id for site in sites if site.job_id))
+
+    def _apply_control_change(self, table, doc):
+        '''
+        Copies `Frontier.CONTROL_FIELDS` from `doc` to the site being brozzled,
+        or notes the stop request of the job, without marking anything as
+        updated, since the values came from the frontier.
+        '''
+        if table == "jobs":
+            self._job_stop_requests[doc["id"]] = doc.get("stop_requested")
+            return
+        with self._browsing_threads_lock:
+            sites = [site for site in self._browsing_threads.values()
+                     if site.id == doc["id"]]
+        for site in sites:
+            for field in self._frontier.CONTROL_FIELDS:
+                if field not in doc:
+                    dict.pop(site, field, None)
+                elif site.get(field) != doc[field]:
+                    self.logger.info(
+                            "%s of %s changed to %r", field, site, doc[field])
+                    dict.__setitem__(site, field, doublethink.orm.watch(
+                        doc[field], callback=site._updated, field=field))
+
+    def _watch_crawl_control(self):
+        '''
+        Thread target that watches the sites being brozzled, and their jobs,
+        for changes to `Frontier.CONTROL_FIELDS`, using a rethinkdb changefeed
+        (or polling, depending on the frontier), so that brozzling threads
+        don't have to query the frontier for stop requests before every page.
+        The watch is restarted whenever the set of sites being brozzled
+        changes.
+        '''
+        while not self._shutdown.is_set():
+            site_ids, job_ids = self._held_ids()
+            for job_id in list(self._job_stop_requests):
+                if job_id not in job_ids:
+                    self._job_stop_requests.pop(job_id, None)
+            if not site_ids:
+                self._shutdown.wait(self.CONTROL_WAIT)
+                continue
+            try:
+                changes = self._frontier.control_changes(
+                        site_ids, job_ids, wait=self.CONTROL_WAIT)
+                try:
+                    for change in changes:
+                        if change:
+                            self._apply_control_change(*change)
+                        if (self._shutdown.is_set()
+                                or self._held_ids() != (site_ids, job_ids)):
+                            break
+                finally:
+                    changes.close()
+            except Exception as e:
+                self.logger.error(
+                        "problem watching sites and jobs for changes, will "
+                        "try again: %s", e, exc_info=True)
+                self._shutdown.wait(self.CONTROL_WAIT)
+
+    def _start_browsing_some_sites(self):
+        '''
+        Claims as many sites as there are available browsers, in one query,
+        and starts a brozzling thread for each one.
+
+        Raises:
+            brozzler.browser.NoBrowsersAvailable: if all browsers are busy
+            brozzler.NothingToClaim: if there is no site to claim
+        '''
+        browsers = self._browser_pool.acquire_multi(
+                self._browser_pool.num_available())
+        try:
+            sites = self._frontier.claim_sites(
+                    self._worker_id, len(browsers))
+            for site in sites:
+                browser = browsers[-1]
+                th = threading.Thread(
+                        target=self._brozzle_site_thread_target,
+                        args=(browser, site),
+                        name="BrozzlingThread:%s" % browser.chrome.port,
+                        daemon=True)
+                with self._browsing_threads_lock:
+                    self._browsing_threads[th] = site
+                th.start()
+                browsers.pop()
+        finally:
+            for browser in browsers:
+                self._browser_pool.release(browser)
+        if not sites:
+            raise brozzler.NothingToClaim
+
     def run(self):
         self.logger.info("brozzler worker starting")
+        self._control_thread = threading.Thread(
+                target=self._watch_crawl_control, name="CrawlControlThread",
+                daemon=True)
+        self._control_thread.start()
         try:
             latest_state = None
             while not self._shutdown.is_set():
                 self._service_heartbeat_if_due()
+                self._enforce_time_limits()
+                self._enforce_stop_requests()
                 try:
-                    browser = self._browser_pool.acquire()
-                    try:
-                        site = self._frontier.claim_site("%s:%s" % (
-                            socket.gethostname(), browser.chrome.port))
-                        th = threading.Thread(
-                                target=self._brozzle_site_thread_target,
-                                args=(browser, site),
-                                name="BrozzlingThread:%s" % browser.chrome.port,
-                                daemon=True)
-                        with self._browsing_threads_lock:
-                            self._browsing_threads.add(th)
-                        th.start()
-                    except:
-                        self._browser_pool.release(browser)
-                        raise
+                    self._start_browsing_some_sites()
                 except brozzler.browser.NoBrowsersAvailable:
                     if latest_state != "browsers-busy":
                         self.logger.info(
@@ -578,6 +1372,10 @@ class BrozzlerWorker:
             thredz = set(self._browsing_threads)
             for th in thredz:
                 th.join()
+            self._record_writer.close()
+            # the crawl control thread also stops when _shutdown is set
+            self._shutdown.set()
+            self._control_thread.join()
 
     def start(self):
         with self._start_stop_lock:
@@ -51,12 +51,15 @@ setuptools.setup(
                 'brozzler-new-job=brozzler.cli:brozzler_new_job',
                 'brozzler-new-site=brozzler.cli:brozzler_new_site',
                 'brozzler-worker=brozzler.cli:brozzler_worker',
+                'brozzler-housekeeper=brozzler.cli:brozzler_housekeeper',
                 'brozzler-ensure-tables=brozzler.cli:brozzler_ensure_tables',
                 'brozzler-list-captures=brozzler.cli:brozzler_list_captures',
                 'brozzler-list-jobs=brozzler.cli:brozzler_list_jobs',
                 'brozzler-list-sites=brozzler.cli:brozzler_list_sites',
                 'brozzler-list-pages=brozzler.cli:brozzler_list_pages',
                 'brozzler-stop-crawl=brozzler.cli:brozzler_stop_crawl',
+                'brozzler-export-frontier=brozzler.cli:brozzler_export_frontier',
+                'brozzler-import-frontier=brozzler.cli:brozzler_import_frontier',
                 'brozzler-dashboard=brozzler.dashboard:main',
                 'brozzler-easy=brozzler.easy:main',
                 'brozzler-wayback=brozzler.pywb:main',
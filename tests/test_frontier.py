@@ -55,6 +55,7 @@ def test_basics():
             ]
         },
         'status': 'ACTIVE',
+        'site_counts': {'ACTIVE': 2},
         'starts_and_stops': [
             {
                 'start': job.starts_and_stops[0]['start'],
@@ -73,17 +74,23 @@ def test_basics():
         'job_id': job.id,
         'last_claimed': brozzler.EPOCH_UTC,
         'last_disclaimed': brozzler.EPOCH_UTC,
+        'queued_priority': 1000,
+        'page_counts': {
+            'queued': 1, 'brozzled': 0, 'blocked': 0, 'rejected': 0,
+            'hops': {'0': 1}},
         'scope': {
             'surt': 'http://(com,example,)/'
         },
         'seed': 'http://example.com',
+        'share': 0.5,
         'starts_and_stops': [
             {
                 'start': sites[0].starts_and_stops[0]['start'],
                 'stop': None
            }
         ],
-        'status': 'ACTIVE'
+        'status': 'ACTIVE',
+        'virtual_time': sites[0].virtual_time,
     }
     assert sites[1] == {
         'claimed': False,
@@ -91,10 +98,15 @@ def test_basics():
         'job_id': job.id,
         'last_claimed': brozzler.EPOCH_UTC,
         'last_disclaimed': brozzler.EPOCH_UTC,
+        'queued_priority': 1000,
+        'page_counts': {
+            'queued': 1, 'brozzled': 0, 'blocked': 0, 'rejected': 0,
+            'hops': {'0': 1}},
         'scope': {
             'surt': 'https://(org,example,)/',
         },
         'seed': 'https://example.org/',
+        'share': 0.5,
         'starts_and_stops': [
             {
                 'start': sites[1].starts_and_stops[0]['start'],
@@ -102,6 +114,7 @@ def test_basics():
            },
         ],
         'status': 'ACTIVE',
+        'virtual_time': sites[1].virtual_time,
     }
 
     pages = list(frontier.site_pages(sites[0].id))
@@ -184,10 +197,13 @@ def test_resume_job():
     assert site.starts_and_stops[0]['stop']
     assert site.starts_and_stops[0]['stop'] > site.starts_and_stops[0]['start']
 
+    assert job.site_counts == {'ACTIVE': 0, 'FINISHED': 1}
+
     frontier.resume_site(site)
     job.refresh()
 
     assert job.status == 'ACTIVE'
+    assert job.site_counts == {'ACTIVE': 1, 'FINISHED': 0}
     assert len(job.starts_and_stops) == 2
     assert job.starts_and_stops[1]['start']
     assert job.starts_and_stops[1]['stop'] is None
@@ -215,6 +231,8 @@ def test_resume_job():
     site = list(frontier.job_sites(job.id))[0]
 
     assert job.status == 'ACTIVE'
+    assert brozzler.Job.load(rr, job.id).site_counts == {
+            'ACTIVE': 1, 'FINISHED': 0}
     assert len(job.starts_and_stops) == 3
     assert job.starts_and_stops[2]['start']
     assert job.starts_and_stops[2]['stop'] is None
@@ -657,6 +675,165 @@ def test_hashtag_links():
     assert pages[2].hashtags == ['#buh']
     assert pages[2].priority == 12
 
+def test_schedule_outlinks_in_chunks():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+    frontier.SCHEDULE_CHUNK_SIZE = 3
+
+    site = brozzler.Site(rr, {'seed': 'http://example.org/'})
+    brozzler.new_site(frontier, site)
+    parent_page = frontier.seed_page(site.id)
+    outlinks = ['http://example.org/%s' % i for i in range(10)]
+    frontier.scope_and_schedule_outlinks(site, parent_page, outlinks)
+
+    pages = list(frontier.site_pages(site.id))
+    assert len(pages) == 11
+    assert sorted(parent_page.outlinks['accepted']) == sorted(outlinks)
+
+    # scheduling the same links again bumps priority of the existing pages
+    outlinks.append('http://example.org/0#hash')
+    frontier.scope_and_schedule_outlinks(site, parent_page, outlinks)
+    pages = {p.url: p for p in frontier.site_pages(site.id)}
+    assert len(pages) == 11
+    assert pages['http://example.org/0'].priority == 36
+    assert pages['http://example.org/0'].hashtags == ['#hash']
+    assert pages['http://example.org/1'].priority == 24
+    assert not pages['http://example.org/1'].hashtags
+    assert pages['http://example.org/'].priority == 1000
+
+def test_claim_pages():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    site = brozzler.Site(rr, {'seed': 'http://example.org/'})
+    brozzler.new_site(frontier, site)
+    parent_page = frontier.seed_page(site.id)
+    scheduled = frontier.scope_and_schedule_outlinks(
+            site, parent_page, [
+                'http://example.org/a/b/c/d', 'http://example.org/a',
+                'http://example.org/a/b'])
+    assert len(scheduled) == 3
+    assert all(page.brozzle_count == 0 for page in scheduled)
+
+    pages = frontier.claim_pages(site, 'test_claim_pages', 3)
+    assert [page.url for page in pages] == [
+            'http://example.org/', 'http://example.org/a',
+            'http://example.org/a/b']
+    assert all(page.claimed for page in pages)
+    assert all(page.last_claimed_by == 'test_claim_pages' for page in pages)
+
+    frontier.unclaim_pages(pages[1:])
+    pages = {page.url: page for page in frontier.site_pages(site.id)}
+    assert pages['http://example.org/'].claimed
+    assert not pages['http://example.org/a'].claimed
+    assert not pages['http://example.org/a/b/c/d'].claimed
+
+    assert len(frontier.claim_pages(site, 'test_claim_pages', 10)) == 4
+
+def test_weighted_site_scheduling():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    rr.table('sites').delete().run() # clean slate
+
+    big_job = brozzler.new_job(frontier, {'seeds': [
+        {'url': 'http://example.com/%s' % i} for i in range(10)]})
+    small_job = brozzler.new_job(frontier, {
+        'weight': 2, 'seeds': [{'url': 'http://example.org/'}]})
+    big_sites = list(frontier.job_sites(big_job.id))
+    small_site = list(frontier.job_sites(small_job.id))[0]
+    assert all(site.share == 0.1 for site in big_sites)
+    assert small_site.share == 2
+    assert small_site.queued_priority == 1000
+
+    # each site charged for the same amount of brozzling
+    for site in frontier.claim_sites('test_weighted', 11):
+        site.last_claimed = doublethink.utcnow() - datetime.timedelta(
+                minutes=1)
+        frontier.disclaim_site(site, frontier.seed_page(site.id))
+    big_sites = list(frontier.job_sites(big_job.id))
+    small_site.refresh()
+    assert all(
+            site.virtual_time > 10 * small_site.virtual_time
+            for site in big_sites)
+    assert frontier.claim_site('test_weighted').id == small_site.id
+    assert frontier.virtual_time() == small_site.virtual_time
+
+    # queued priority goes up as pages are scheduled, down as they are
+    # brozzled
+    page = frontier.seed_page(small_site.id)
+    frontier.scope_and_schedule_outlinks(
+            small_site, page, ['http://example.org/a'])
+    frontier.completed_page(small_site, page)
+    small_site.refresh()
+    assert small_site.queued_priority == 12
+
+    rr.table('sites').delete().run()
+
+def test_site_page_counts():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    site = brozzler.Site(rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    page = frontier.seed_page(site.id)
+    frontier.scope_and_schedule_outlinks(site, page, [
+        'http://example.com/a', 'http://example.com/b',
+        'http://example.org/out'])
+    frontier.completed_page(site, page)
+    expected = {
+        'queued': 2, 'brozzled': 1, 'blocked': 0, 'rejected': 1,
+        'hops': {'0': 1, '1': 2}}
+    assert site.page_counts == expected
+    site = brozzler.Site.load(rr, site.id)
+    assert site.page_counts == expected
+    assert site.queued_priority == 24
+
+    # sites from before page_counts were tracked don't get partial counts
+    site = brozzler.Site(rr, {'seed': 'http://example.net/'})
+    site.save()
+    frontier._increment_site_counters(site, {
+        'queued_priority': 10, 'page_counts': {'queued': 1}})
+    site.refresh()
+    assert site.queued_priority == 10
+    assert 'page_counts' not in site
+
+def test_housekeep():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    rr.table('sites').delete().run() # clean slate
+
+    job = brozzler.new_job(frontier, {'seeds': [
+        {'url': 'http://example.com/', 'time_limit': 10},
+        {'url': 'http://example.org/'}]})
+    sites = {site.seed: site for site in frontier.job_sites(job.id)}
+    over_time_limit = sites['http://example.com/']
+    over_time_limit.starts_and_stops[0]['start'] = (
+            doublethink.utcnow() - datetime.timedelta(minutes=1))
+    over_time_limit.save()
+    stale = sites['http://example.org/']
+    stale.claimed = True
+    stale.last_claimed = doublethink.utcnow() - datetime.timedelta(hours=2)
+    stale.save()
+
+    assert frontier.housekeep() == {
+        'stale_claims': 1, 'time_limit': 1, 'no_pages': 0,
+        'site_counts': 0, 'jobs': 0}
+    over_time_limit.refresh()
+    assert over_time_limit.status == 'FINISHED_TIME_LIMIT'
+    stale.refresh()
+    assert stale.status == 'ACTIVE'
+    assert not stale.claimed
+
+    frontier.completed_page(stale, frontier.seed_page(stale.id))
+    assert frontier.housekeep()['no_pages'] == 1
+    job.refresh()
+    assert job.status == 'FINISHED'
+
+    rr.table('sites').delete().run()
+
 def test_honor_stop_request():
     rr = doublethink.Rethinker('localhost', db='ignoreme')
     frontier = brozzler.RethinkDbFrontier(rr)
@@ -698,6 +875,37 @@ def test_honor_stop_request():
     with pytest.raises(brozzler.CrawlStopped):
         frontier.honor_stop_request(site)
 
+def test_control_changes():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+    job = brozzler.new_job(frontier, {'seeds': [{'url': 'http://example.com'}]})
+    site = list(frontier.job_sites(job.id))[0]
+
+    changes = frontier.control_changes([site.id], [job.id], wait=0.5)
+    try:
+        # current values first
+        initial = [next(changes), next(changes)]
+        assert sorted(table for table, doc in initial) == ['jobs', 'sites']
+        assert next(changes) is None
+
+        site.time_limit = 60
+        site.stop_requested = doublethink.utcnow()
+        site.claimed = True
+        site.save()
+        table, doc = next(changes)
+        assert table == 'sites'
+        assert sorted(doc) == ['id', 'stop_requested', 'time_limit']
+        assert doc['time_limit'] == 60
+
+        job.stop_requested = doublethink.utcnow()
+        job.save()
+        table, doc = next(changes)
+        assert table == 'jobs'
+        assert doc['id'] == job.id
+        assert doc['stop_requested']
+    finally:
+        changes.close()
+
 def test_claim_site():
     rr = doublethink.Rethinker('localhost', db='ignoreme')
     frontier = brozzler.RethinkDbFrontier(rr)
@@ -717,20 +925,67 @@ def test_claim_site():
     with pytest.raises(brozzler.NothingToClaim):
         claimed_site = frontier.claim_site(worker_id='test_claim_site')
 
-    # site last_claimed less than 1 hour ago still not to be reclaimed
-    claimed_site.last_claimed = doublethink.utcnow() - datetime.timedelta(minutes=55)
+    # site whose claim has been renewed not to be reclaimed
+    claimed_site.claim_expires = doublethink.utcnow() - datetime.timedelta(seconds=1)
     claimed_site.save()
+    assert frontier.renew_claims('test_claim_site', [claimed_site.id]) == 1
+    assert frontier.renew_claims('someone_else', [claimed_site.id]) == 0
     with pytest.raises(brozzler.NothingToClaim):
         claimed_site = frontier.claim_site(worker_id='test_claim_site')
 
-    # site last_claimed more than 1 hour ago can be reclaimed
+    # site whose claim has expired can be reclaimed
     site = claimed_site
     claimed_site = None
-    site.last_claimed = doublethink.utcnow() - datetime.timedelta(minutes=65)
+    site.claim_expires = doublethink.utcnow() - datetime.timedelta(seconds=1)
     site.save()
     claimed_site = frontier.claim_site(worker_id='test_claim_site')
     assert claimed_site.id == site.id
 
+    # claim without a lease (older brozzler) last_claimed less than 1 hour
+    # ago still not to be reclaimed
+    del claimed_site['claim_expires']
+    claimed_site.last_claimed = doublethink.utcnow() - datetime.timedelta(minutes=55)
+    claimed_site.save()
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_site(worker_id='test_claim_site')
+
+    # claim without a lease last_claimed more than 1 hour ago can be reclaimed
+    claimed_site.last_claimed = doublethink.utcnow() - datetime.timedelta(minutes=65)
+    claimed_site.save()
+    claimed_site = frontier.claim_site(worker_id='test_claim_site')
+    assert claimed_site.id == site.id
+
     # clean up
     rr.table('sites').get(claimed_site.id).delete().run()
 
+
+def test_claim_sites():
+    rr = doublethink.Rethinker('localhost', db='ignoreme')
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    rr.table('sites').delete().run() # clean slate
+
+    assert frontier.claim_sites(worker_id='test_claim_sites', n=3) == []
+
+    for i in range(4):
+        site = brozzler.Site(rr, {'seed': 'http://example.org/%s' % i})
+        brozzler.new_site(frontier, site)
+    expired = brozzler.Site(rr, {
+        'seed': 'http://example.org/expired', 'time_limit': 10,
+        'starts_and_stops': [{
+            'start': doublethink.utcnow() - datetime.timedelta(hours=1),
+            'stop': None}]})
+    brozzler.new_site(frontier, expired)
+
+    # over time limit site is finished rather than returned
+    sites = frontier.claim_sites(worker_id='test_claim_sites', n=10)
+    assert len(sites) == 4
+    assert all(site.claimed for site in sites)
+    assert all(
+            site.last_claimed_by == 'test_claim_sites' for site in sites)
+    expired.refresh()
+    assert expired.status == 'FINISHED_TIME_LIMIT'
+    assert frontier.claim_sites(worker_id='test_claim_sites', n=3) == []
+
+    # clean up
+    rr.table('sites').delete().run()
@@ -0,0 +1,838 @@
+#!/usr/bin/env python
+'''
+test_sqlite_frontier.py - tests of the embedded sqlite frontier backend, no
+rethinkdb required
+
+Copyright (C) 2017 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+import brozzler
+import brozzler.cli
+import brozzler.snapshot
+import brozzler.sqlite
+import brozzler.worker
+import logging
+import argparse
+import doublethink
+import datetime
+import os
+import pytest
+import socket
+import threading
+import time
+
+args = argparse.Namespace()
+args.log_level = logging.INFO
+brozzler.cli.configure_logging(args)
+
+@pytest.fixture
+def frontier(tmpdir):
+    return brozzler.SqliteFrontier(str(tmpdir.join('frontier.db')))
+
+def test_document_round_trip(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'warcprox_meta': {'a': [1, 2]}})
+    site.save()
+    assert site.id
+
+    site2 = brozzler.Site.load(frontier.rr, site.id)
+    assert site2 == site
+    assert site2.last_claimed == brozzler.EPOCH_UTC
+    assert site2.last_claimed.tzinfo
+
+    # only changed fields are written
+    site2.status = 'FINISHED'
+    site2.save()
+    site.warcprox_meta['a'].append(3)
+    site.save()
+    site.refresh()
+    assert site.status == 'FINISHED'
+    assert site.warcprox_meta == {'a': [1, 2, 3]}
+
+    assert brozzler.Site.load(frontier.rr, 'nonexistent') is None
+
+def test_basics(frontier):
+    job_conf = {'seeds': [
+        {'url': 'http://example.com'}, {'url': 'https://example.org/'}]}
+    job = brozzler.new_job(frontier, job_conf)
+    assert job.status == 'ACTIVE'
+    assert [j.id for j in frontier.active_jobs()] == [job.id]
+
+    sites = sorted(list(frontier.job_sites(job.id)), key=lambda x: x.seed)
+    assert len(sites) == 2
+    assert sites[0].scope == {'surt': 'http://(com,example,)/'}
+    for site in sites:
+        pages = list(frontier.site_pages(site.id))
+        assert len(pages) == 1
+        assert pages[0] == frontier.seed_page(site.id)
+        assert pages[0].url == site.seed
+        assert pages[0].priority == 1000
+        assert list(frontier.site_pages(site.id, brozzled=True)) == []
+
+def test_claim_and_finish(frontier):
+    job = brozzler.new_job(frontier, {
+        'ignore_robots': True, 'seeds': [{'url': 'http://example.com/'}]})
+    site = frontier.claim_site('test_worker')
+    assert site.claimed
+    assert site.last_claimed_by == 'test_worker'
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_site('test_worker')
+
+    page = frontier.claim_page(site, 'test_worker')
+    assert page.url == 'http://example.com/'
+    frontier.scope_and_schedule_outlinks(site, page, [
+        'http://example.com/a', 'http://example.com/b',
+        'http://example.com/a#frag', 'http://example.org/out'])
+    assert page.outlinks['rejected'] == ['http://example.org/out']
+    frontier.scope_and_schedule_outlinks(
+            site, page, ['http://example.com/a'])
+    assert len(list(frontier.site_pages(site.id, brozzled=False))) == 3
+
+    frontier.completed_page(site, page)
+    assert frontier.has_outstanding_pages(site)
+    assert list(frontier.site_pages(site.id, brozzled=True)) == [page]
+
+    page = frontier.claim_page(site, 'test_worker')
+    assert page.url == 'http://example.com/a'
+    assert page.priority == 36
+    assert page.hashtags == ['#frag']
+
+    frontier.completed_page(site, page)
+    frontier.completed_page(
+            site, frontier.claim_page(site, 'test_worker'))
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_page(site, 'test_worker')
+    assert not frontier.has_outstanding_pages(site)
+
+    frontier.finished(site, 'FINISHED')
+    assert not brozzler.Site.load(frontier.rr, site.id).claimed
+    job.refresh()
+    assert job.status == 'FINISHED'
+    assert job.starts_and_stops[-1]['stop']
+    assert list(frontier.active_jobs()) == []
+
+def test_job_site_counts(frontier):
+    job = brozzler.new_job(frontier, {'seeds': [
+        {'url': 'http://example.com/'}, {'url': 'http://example.org/'}]})
+    assert job.site_counts == {'ACTIVE': 2}
+    sites = list(frontier.job_sites(job.id))
+
+    frontier.finished(sites[0], 'FINISHED_STOP_REQUESTED')
+    job.refresh()
+    assert job.site_counts == {'ACTIVE': 1, 'FINISHED_STOP_REQUESTED': 1}
+    assert job.status == 'ACTIVE'
+
+    frontier.resume_site(sites[0])
+    frontier.finished(sites[0], 'FINISHED')
+    frontier.finished(sites[1], 'FINISHED_TIME_LIMIT')
+    job.refresh()
+    assert job.site_counts == {
+        'ACTIVE': 0, 'FINISHED': 1, 'FINISHED_STOP_REQUESTED': 0,
+        'FINISHED_TIME_LIMIT': 1}
+    assert job.status == 'FINISHED'
+
+    frontier.resume_job(job)
+    job.refresh()
+    assert job.site_counts == {
+        'ACTIVE': 2, 'FINISHED': 0, 'FINISHED_STOP_REQUESTED': 0,
+        'FINISHED_TIME_LIMIT': 0}
+
+    # jobs from before site_counts were tracked fall back to looking at
+    # every site
+    del job['site_counts']
+    job.save()
+    for site in frontier.job_sites(job.id):
+        frontier.finished(site, 'FINISHED')
+    job.refresh()
+    assert 'site_counts' not in job
+    assert job.status == 'FINISHED'
+
+def test_new_job_bulk(frontier, tmpdir):
+    seeds_file = tmpdir.join('seeds.txt')
+    seeds_file.write(
+            '# comment\n\nhttp://example.com/1\n'
+            '{"url": "http://example.com/2", "time_limit": 60}\n'
+            + ''.join('http://example.org/%s\n' % i for i in range(5)))
+    job = brozzler.new_job_bulk(frontier, {
+        'id': 'bulk', 'weight': 2, 'ignore_robots': True,
+        'seeds': [{'url': 'http://example.net/'}]},
+        str(seeds_file), chunk_size=3)
+    assert job.site_counts == {'INGESTING': 0, 'ACTIVE': 8}
+    sites = {site.seed: site for site in frontier.job_sites('bulk')}
+    assert len(sites) == 8
+    assert sites['http://example.com/2'].time_limit == 60
+    assert sites['http://example.com/1'].time_limit is None
+    for site in sites.values():
+        assert site.ignore_robots
+        assert site.share == 0.25
+        assert site.page_counts['queued'] == 1
+        assert frontier.seed_page(site.id).url == site.seed
+    assert frontier.claim_site('test_worker').job_id == 'bulk'
+
+    yaml_file = tmpdir.join('seeds.yaml')
+    yaml_file.write(
+            '- http://example.com/a\n'
+            '- url: http://example.com/b\n'
+            '---\n'
+            'url: ftp://example.com/c\n'
+            'time_limit: -1\n')
+    assert [s['url'] for s in brozzler.model.read_seeds(str(yaml_file))] == [
+            'http://example.com/a', 'http://example.com/b',
+            'ftp://example.com/c']
+    with pytest.raises(brozzler.InvalidJobConf) as excinfo:
+        brozzler.new_job_bulk(
+                frontier, {'id': 'invalid'}, str(yaml_file))
+    assert list(excinfo.value.errors['seeds'][0]) == [2]
+    assert brozzler.Job.load(frontier.rr, 'invalid') is None
+
+def test_site_page_counts(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    assert site.page_counts == {
+        'queued': 1, 'brozzled': 0, 'blocked': 0, 'rejected': 0,
+        'hops': {'0': 1}}
+
+    page = frontier.seed_page(site.id)
+    frontier.scope_and_schedule_outlinks(site, page, [
+        'http://example.com/a', 'http://example.com/b',
+        'http://example.com/a#frag', 'http://example.org/out'])
+    frontier.completed_page(site, page)
+    page = frontier.claim_page(site, 'test_worker')
+    page.blocked_by_robots = True
+    frontier.completed_page(site, page)
+    frontier.scope_and_schedule_outlinks(
+            site, page, ['http://example.com/a/c', 'http://example.com/b'])
+    expected = {
+        'queued': 2, 'brozzled': 2, 'blocked': 1, 'rejected': 1,
+        'hops': {'0': 1, '1': 2, '2': 1}}
+    assert site.page_counts == expected
+    assert not site._updates
+    assert brozzler.Site.load(frontier.rr, site.id).page_counts == expected
+    assert frontier.has_outstanding_pages(site)
+
+    # counters are only trusted when positive
+    site.page_counts['queued'] = 0
+    assert frontier.has_outstanding_pages(site)
+
+    # sites from before page_counts were tracked don't get partial counts
+    site = brozzler.Site(frontier.rr, {'seed': 'http://example.net/'})
+    site.save()
+    frontier._increment_site_counters(site, {
+        'queued_priority': 10, 'page_counts': {'queued': 1}})
+    site.refresh()
+    assert site.queued_priority == 10
+    assert 'page_counts' not in site
+
+def test_schedule_with_seen_pages(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    assert 'seen_pages' not in site
+    seen = frontier.load_seen_pages(site)
+    assert seen.complete
+    page = frontier.claim_page(site, 'test_worker')
+    frontier.completed_page(site, page)
+    seen.add_brozzled(page.id)
+
+    scheduled = frontier.scope_and_schedule_outlinks(site, page, [
+        'http://example.com/', 'http://example.com/a',
+        'http://example.com/b'], seen)
+    # the brozzled seed page is skipped
+    assert sorted(p.url for p in scheduled) == [
+        'http://example.com/a', 'http://example.com/b']
+    assert site.page_counts['queued'] == 2
+    assert frontier.seed_page(site.id).priority == 1000
+    assert seen.complete
+
+    scheduled = frontier.scope_and_schedule_outlinks(
+            site, page, ['http://example.com/a'], seen)
+    assert scheduled[0].priority == 24
+    assert site.page_counts['queued'] == 2
+
+    # pages scheduled without the filter make it inaccurate, which is noticed
+    frontier.scope_and_schedule_outlinks(site, page, ['http://example.com/c'])
+    frontier.scope_and_schedule_outlinks(
+            site, page, ['http://example.com/c', 'http://example.com/d'], seen)
+    assert not seen.complete
+    assert brozzler.Page.load(
+            frontier.rr, brozzler.Page.compute_id(
+                site.id, 'http://example.com/c')).priority == 24
+    assert site.page_counts['queued'] == 4
+    assert len(list(frontier.site_pages(site.id, brozzled=False))) == 4
+
+    # saved for the next worker in its own table, forgotten once finished
+    seen = brozzler.frontier.SeenPages(complete=True)
+    seen.add(page.id)
+    frontier.save_seen_pages(site, seen)
+    site.refresh()
+    assert 'seen_pages' not in site
+    restored = frontier.load_seen_pages(site)
+    assert restored.complete
+    assert page.id in restored
+    frontier.finished(site, 'FINISHED')
+    assert not frontier.load_seen_pages(site).complete
+
+def test_separate_outlinks(tmpdir):
+    frontier = brozzler.SqliteFrontier(
+            str(tmpdir.join('frontier.db')), separate_outlinks=True)
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    page = frontier.claim_page(site, 'test_worker')
+    assert frontier.page_outlinks(page) is None
+
+    frontier.scope_and_schedule_outlinks(site, page, [
+        'http://example.com/a', 'http://example.org/out'])
+    page = brozzler.Page.load(frontier.rr, page.id)
+    assert 'outlinks' not in page
+    assert page.outlink_counts == {'accepted': 1, 'blocked': 0, 'rejected': 1}
+    assert frontier.page_outlinks(page) == {
+        'accepted': ['http://example.com/a'], 'blocked': [],
+        'rejected': ['http://example.org/out']}
+
+    # brozzling the page again replaces its outlinks
+    frontier.scope_and_schedule_outlinks(site, page, ['http://example.com/b'])
+    assert frontier.page_outlinks(page)['accepted'] == [
+            'http://example.com/b']
+
+    # pages with outlinks stored the old way still work
+    frontier.separate_outlinks = False
+    frontier.scope_and_schedule_outlinks(site, page, ['http://example.com/c'])
+    page = brozzler.Page.load(frontier.rr, page.id)
+    assert frontier.page_outlinks(page)['accepted'] == [
+            'http://example.com/c']
+
+def test_snapshot(tmpdir):
+    frontier = brozzler.SqliteFrontier(
+            str(tmpdir.join('frontier.db')), separate_outlinks=True)
+    job = brozzler.new_job(frontier, {'ignore_robots': True, 'seeds': [
+        {'url': 'http://example.com/'}, {'url': 'http://example.org/'}]})
+    site = next(frontier.job_sites(job.id))
+    page = frontier.claim_page(site, 'test_worker')
+    frontier.scope_and_schedule_outlinks(site, page, [
+        'http://%s/%s' % (page.url.split('/')[2], i) for i in range(10)])
+    frontier.claim_page(site, 'test_worker')
+    # not part of the job, not exported
+    brozzler.new_site(frontier, brozzler.Site(frontier.rr, {
+        'seed': 'http://example.net/', 'ignore_robots': True}))
+
+    frontier.EXPORT_BATCH_SIZE = 3  # exercise batching
+
+    snapshot = str(tmpdir.join('snapshot'))
+    assert brozzler.snapshot.export_frontier(
+            frontier, job.id, snapshot, chunk_size=5) == 16
+    assert len(tmpdir.join('snapshot').listdir()) == 4
+    with pytest.raises(FileExistsError):
+        brozzler.snapshot.export_frontier(frontier, job.id, snapshot)
+
+    frontier2 = brozzler.SqliteFrontier(str(tmpdir.join('frontier2.db')))
+    # pretend an earlier import got through the first file
+    checkpoint = tmpdir.join('snapshot', 'imported')
+    checkpoint.write('frontier-00000.ndjson.gz\n')
+    assert brozzler.snapshot.import_frontier(
+            frontier2, snapshot, batch_size=2, threads=2) == 11
+    assert brozzler.snapshot.import_frontier(frontier2, snapshot) == 0
+    checkpoint.remove()
+    assert brozzler.snapshot.import_frontier(frontier2, snapshot) == 16
+
+    job2 = brozzler.Job.load(frontier2.rr, job.id)
+    assert job2 == brozzler.Job.load(frontier.rr, job.id)
+    sites = {s.id: s for s in frontier.job_sites(job.id)}
+    for site2 in frontier2.job_sites(job.id):
+        assert not site2.claimed
+        site2.claimed = sites[site2.id].claimed
+        assert site2 == sites[site2.id]
+        pages = {p.id: p for p in frontier.site_pages(site2.id)}
+        pages2 = list(frontier2.site_pages(site2.id))
+        assert len(pages2) == len(pages)
+        for page2 in pages2:
+            assert not page2.claimed
+            page2.claimed = pages[page2.id].claimed
+            assert page2 == pages[page2.id]
+            assert frontier2.page_outlinks(page2) == frontier.page_outlinks(
+                    pages[page2.id])
+    assert len(list(frontier2.rr.query('select id from sites'))) == 2
+
+    # table names from snapshot files end up in sql, only known ones pass
+    with pytest.raises(ValueError):
+        frontier2.write_docs('sites; drop table pages; --', [{'id': 'x'}])
+    assert frontier2.rr.query('select count(*) from pages')[0][0] > 0
+
+def test_stale_claim(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    site = frontier.claim_site('worker1')
+    assert site.claim_expires > doublethink.utcnow()
+
+    # renewed claims don't expire
+    site.claim_expires = doublethink.utcnow() - datetime.timedelta(seconds=1)
+    site.save()
+    assert frontier.renew_claims('worker1', [site.id]) == 1
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_site('worker2')
+
+    site.claim_expires = doublethink.utcnow() - datetime.timedelta(seconds=1)
+    site.save()
+    site = frontier.claim_site('worker2')
+    assert site.last_claimed_by == 'worker2'
+    # worker1 lost the claim
+    assert frontier.renew_claims('worker1', [site.id]) == 0
+    assert frontier.renew_claims('worker2', [site.id, 'nonexistent']) == 1
+
+    # a worker renews only its own claims, not those of another worker
+    # process on the same host
+    site.claim_expires = doublethink.utcnow() - datetime.timedelta(seconds=1)
+    site.last_claimed_by = '%s:%s' % (socket.gethostname(), os.getpid() + 1)
+    site.save()
+    worker = brozzler.BrozzlerWorker(frontier)
+    assert worker._worker_id == '%s:%s' % (socket.gethostname(), os.getpid())
+    worker._browsing_threads[threading.current_thread()] = site
+    worker._renew_site_claims()
+    site.refresh()
+    assert site.claim_expires < doublethink.utcnow()
+    site.last_claimed_by = worker._worker_id
+    site.save()
+    worker._renew_site_claims()
+    site.refresh()
+    assert site.claim_expires > doublethink.utcnow()
+
+    # claims without a lease, from older versions of brozzler
+    del site['claim_expires']
+    site.save()
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_site('worker3')
+    site.last_claimed = doublethink.utcnow() - datetime.timedelta(hours=2)
+    site.save()
+    assert frontier.claim_site('worker3').last_claimed_by == 'worker3'
+
+def test_site_page_queue(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    seed_page = frontier.seed_page(site.id)
+    frontier.scope_and_schedule_outlinks(site, seed_page, [
+        'http://example.com/a/b/c/d/e', 'http://example.com/a/b/c/d',
+        'http://example.com/a/b/c'])
+
+    queue = brozzler.worker.SitePageQueue(frontier, site, 'test_worker', 2)
+    page = queue.pop()
+    assert page.url == 'http://example.com/'
+    assert len(queue) == 1
+
+    frontier.completed_page(site, page)
+    scheduled = frontier.scope_and_schedule_outlinks(site, page, [
+        'http://example.com/x', 'http://example.com/a/b/c/d#frag',
+        'http://example.com/a/b/c/d/e/f'])
+    queue.merge(scheduled)
+    # pages with higher priority than those queued jump the queue, lower
+    # priority ones are left for the next batch
+    assert len(queue) == 3
+    page = queue.pop()
+    assert page.url == 'http://example.com/a/b/c/d'
+    assert page.hashtags == ['#frag']
+    assert page.priority == 18
+    for url in ('http://example.com/x', 'http://example.com/a/b/c'):
+        frontier.completed_page(site, page)
+        page = queue.pop()
+        assert page.url == url
+    frontier.completed_page(site, page)
+    assert len(queue) == 0
+
+    # next batch comes from the frontier
+    assert queue.pop().url.startswith('http://example.com/a/b/c/d/e')
+    assert len(queue) == 1
+    held_pages = queue.drain()
+    assert held_pages[0].url.startswith('http://example.com/a/b/c/d/e')
+    assert held_pages[0].claimed
+
+    frontier.disclaim_site(site, None, held_pages)
+    assert not brozzler.Page.load(frontier.rr, held_pages[0].id).claimed
+    assert brozzler.Site.load(frontier.rr, site.id).status == 'ACTIVE'
+
+def test_claim_sites(frontier):
+    assert frontier.claim_sites('test_worker', 3) == []
+    for i in range(4):
+        site = brozzler.Site(frontier.rr, {
+            'seed': 'http://example.com/%s' % i, 'ignore_robots': True})
+        brozzler.new_site(frontier, site)
+
+    sites = frontier.claim_sites('test_worker', 3)
+    assert len(sites) == 3
+    assert all(site.claimed for site in sites)
+    assert len(frontier.claim_sites('test_worker', 3)) == 1
+    assert frontier.claim_sites('test_worker', 3) == []
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_site('test_worker')
+
+def test_host_leases(frontier):
+    lease = frontier.lease_host('example.com')
+    with pytest.raises(brozzler.HostBusy):
+        frontier.lease_host('example.com')
+    # other hosts are independent
+    other = frontier.lease_host('example.org')
+    frontier.release_host('example.org', other)
+
+    # releasing with a stale lease does nothing
+    frontier.release_host('example.com', 'bogus')
+    with pytest.raises(brozzler.HostBusy):
+        frontier.lease_host('example.com')
+
+    # a site held up by a lease is retried soon, not when the lease expires
+    with pytest.raises(brozzler.HostBusy) as excinfo:
+        frontier.lease_host('example.com')
+    assert excinfo.value.available_at < doublethink.utcnow() + (
+            datetime.timedelta(seconds=60))
+
+    frontier.release_host('example.com', lease, delay=600)
+    with pytest.raises(brozzler.HostBusy) as excinfo:
+        frontier.lease_host('example.com')
+    assert excinfo.value.host == 'example.com'
+    assert excinfo.value.available_at > doublethink.utcnow() + (
+            datetime.timedelta(seconds=590))
+
+    frontier.release_host('example.org', frontier.lease_host('example.org'))
+    assert frontier.lease_host('example.org')
+
+def test_claim_after(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    site.claim_after = doublethink.utcnow() + datetime.timedelta(seconds=60)
+    site.save()
+    assert frontier.claim_sites('test_worker', 3) == []
+
+    site.claim_after = doublethink.utcnow() - datetime.timedelta(seconds=1)
+    site.save()
+    assert [s.id for s in frontier.claim_sites('test_worker', 3)] == [site.id]
+
+def test_weighted_site_scheduling(frontier):
+    big_job = brozzler.new_job(frontier, {
+        'ignore_robots': True, 'seeds': [
+            {'url': 'http://example.com/%s' % i} for i in range(10)]})
+    small_job = brozzler.new_job(frontier, {
+        'ignore_robots': True, 'weight': 2,
+        'seeds': [{'url': 'http://example.org/'}]})
+    small_site = list(frontier.job_sites(small_job.id))[0]
+    assert small_site.share == 2
+    assert small_site.queued_priority == 1000
+    assert 'weight' not in small_site
+
+    for site in frontier.claim_sites('test_worker', 11):
+        site.last_claimed = doublethink.utcnow() - datetime.timedelta(
+                minutes=1)
+        frontier.disclaim_site(site, frontier.seed_page(site.id))
+    big_sites = list(frontier.job_sites(big_job.id))
+    assert all(site.share == 0.1 for site in big_sites)
+    small_site.refresh()
+    assert all(
+            site.virtual_time > 10 * small_site.virtual_time
+            for site in big_sites)
+    assert frontier.claim_site('test_worker').id == small_site.id
+    assert frontier.virtual_time() == small_site.virtual_time
+
+    page = frontier.seed_page(small_site.id)
+    frontier.scope_and_schedule_outlinks(
+            small_site, page, ['http://example.org/a'])
+    frontier.completed_page(small_site, page)
+    small_site.refresh()
+    assert small_site.queued_priority == 12
+
+    # a new site starts at the current virtual time
+    site = brozzler.Site(frontier.rr, {'seed': 'http://example.net/'})
+    brozzler.new_site(frontier, site)
+    assert site.virtual_time == frontier.virtual_time()
+
+def test_housekeep(frontier):
+    job = brozzler.new_job(frontier, {
+        'ignore_robots': True, 'seeds': [
+            {'url': 'http://example.com/', 'time_limit': 10},
+            {'url': 'http://example.org/'},
+            {'url': 'http://example.net/'}]})
+    sites = {site.seed: site for site in frontier.job_sites(job.id)}
+
+    over_time_limit = sites['http://example.com/']
+    over_time_limit.starts_and_stops[0]['start'] = (
+            doublethink.utcnow() - datetime.timedelta(minutes=1))
+    over_time_limit.save()
+
+    no_pages = sites['http://example.org/']
+    page = frontier.seed_page(no_pages.id)
+    frontier.completed_page(no_pages, page)
+
+    stale = sites['http://example.net/']
+    stale.claimed = True
+    stale.last_claimed = doublethink.utcnow() - datetime.timedelta(hours=2)
+    stale.save()
+
+    assert frontier.housekeep() == {
+        'stale_claims': 1, 'time_limit': 1, 'no_pages': 1,
+        'site_counts': 0, 'jobs': 0}
+    for site in sites.values():
+        site.refresh()
+    assert over_time_limit.status == 'FINISHED_TIME_LIMIT'
+    assert no_pages.status == 'FINISHED'
+    assert stale.status == 'ACTIVE'
+    assert not stale.claimed
+
+    # a site claimed after housekeeping read it is left to the worker
+    frontier.completed_page(stale, frontier.seed_page(stale.id))
+    unclaimed_active_sites = frontier._unclaimed_active_sites
+    def claimed_meanwhile():
+        found = list(unclaimed_active_sites())
+        assert frontier.claim_site('test_worker').id == stale.id
+        return found
+    frontier._unclaimed_active_sites = claimed_meanwhile
+    assert frontier.housekeep()['no_pages'] == 0
+    stale.refresh()
+    assert stale.status == 'ACTIVE'
+    assert stale.claimed
+    del frontier._unclaimed_active_sites
+
+    stale.claimed = False
+    stale.save()
+    counts = frontier.housekeep()
+    assert counts['no_pages'] == 1
+    job.refresh()
+    assert job.status == 'FINISHED'
+
+def test_housekeep_site_counts(frontier):
+    job = brozzler.new_job(frontier, {'seeds': [
+        {'url': 'http://example.com/'}, {'url': 'http://example.org/'}]})
+    for site in frontier.job_sites(job.id):
+        frontier.completed_page(site, frontier.seed_page(site.id))
+        # as if the worker crashed before adjusting the job's site_counts
+        site.status = 'FINISHED'
+        site.save()
+    job.refresh()
+    assert job.site_counts == {'ACTIVE': 2}
+    counts = frontier.housekeep()
+    assert counts['site_counts'] == 1
+    assert counts['jobs'] == 1
+    job.refresh()
+    assert job.status == 'FINISHED'
+    assert job.site_counts == {'FINISHED': 2}
+
+    # not while seeds are still being added
+    job = brozzler.new_job(
+            frontier, {'seeds': [{'url': 'http://example.net/'}]})
+    job.site_counts['INGESTING'] = 5
+    job.save()
+    assert frontier.housekeep()['site_counts'] == 0
+    job.refresh()
+    assert job.site_counts == {'ACTIVE': 1, 'INGESTING': 5}
+
+    # jobs from before site_counts were tracked still finish
+    job = brozzler.new_job(
+            frontier, {'seeds': [{'url': 'http://example.io/'}]})
+    del job['site_counts']
+    job.save()
+    site = list(frontier.job_sites(job.id))[0]
+    frontier.completed_page(site, frontier.seed_page(site.id))
+    counts = frontier.housekeep()
+    assert counts['no_pages'] == 1
+    assert counts['site_counts'] == 0
+    job.refresh()
+    assert job.status == 'FINISHED'
+    assert 'site_counts' not in job
+
+def test_worker_crawl_control(frontier):
+    job = brozzler.new_job(frontier, {'seeds': [
+        {'url': 'http://example.com/'}, {'url': 'http://example.org/'}]})
+    site1, site2 = frontier.claim_sites('test_worker', 2)
+    worker = brozzler.BrozzlerWorker(frontier)
+    worker.CONTROL_WAIT = 0.1
+    stop = threading.Event()
+    caught = []
+
+    def thread_target():
+        try:
+            with brozzler.thread_accept_exceptions():
+                while not stop.is_set():
+                    time.sleep(0.1)
+        except brozzler.CrawlStopped:
+            caught.append(threading.current_thread())
+
+    th1 = threading.Thread(target=thread_target)
+    th2 = threading.Thread(target=thread_target)
+    worker._browsing_threads = {th1: site1, th2: site2}
+    th1.start()
+    th2.start()
+    control_thread = threading.Thread(target=worker._watch_crawl_control)
+    control_thread.start()
+    try:
+        # changes made elsewhere show up on the sites being brozzled
+        site = brozzler.Site.load(frontier.rr, site1.id)
+        site.time_limit = 60
+        site.stop_requested = doublethink.utcnow()
+        site.save()
+        time.sleep(1)
+        assert site1.time_limit == 60
+        assert not site1._updates
+        worker._enforce_stop_requests()
+        th1.join(timeout=5)
+        assert caught == [th1]
+        assert th2.is_alive()
+
+        job.stop_requested = doublethink.utcnow()
+        job.save()
+        time.sleep(1)
+        worker._enforce_stop_requests()
+        th2.join(timeout=5)
+        assert caught == [th1, th2]
+        assert worker._stopped_threads == {th1, th2}
+    finally:
+        stop.set()
+        worker._shutdown.set()
+        control_thread.join()
+
+def test_pipelined_brozzling(frontier):
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    site = frontier.claim_sites('test_worker', 1)[0]
+    worker = brozzler.BrozzlerWorker(frontier, pipeline_threads=2)
+
+    class FakeBrowser:
+        chrome = argparse.Namespace(port=9999)
+        def is_running(self):
+            return False
+
+    links = {
+        'http://example.com/': [
+            'http://example.com/a', 'http://example.com/b'],
+        'http://example.com/a': ['http://example.com/c'],
+    }
+    ydl_threads = []
+    browsed = []
+    def youtube_dl_page(site, page):
+        ydl_threads.append(threading.current_thread())
+    def browse_or_fetch(browser, site, page, ydl_spy, **kwargs):
+        browsed.append(page.url)
+        return links.get(page.url, [])
+    worker._youtube_dl_page = youtube_dl_page
+    worker._browse_or_fetch = browse_or_fetch
+
+    worker.brozzle_site(FakeBrowser(), site)
+
+    assert browsed[0] == 'http://example.com/'
+    assert sorted(browsed) == [
+            'http://example.com/', 'http://example.com/a',
+            'http://example.com/b', 'http://example.com/c']
+    # pages after the first were prepared while the previous one browsed
+    assert threading.current_thread() in ydl_threads
+    assert len(set(ydl_threads)) > 1
+    for page in frontier.site_pages(site.id):
+        assert page.brozzle_count == 1
+        assert not page.claimed
+    site.refresh()
+    assert site.status == 'FINISHED'
+    assert not site.claimed
+
+def test_worker_host_leases(frontier):
+    class FakeBrowser:
+        chrome = argparse.Namespace(port=9999)
+        def is_running(self):
+            return False
+
+    worker = brozzler.BrozzlerWorker(frontier, max_browsers_per_host=2)
+    links = {
+        'http://example.com/': ['http://example.com/a'],
+        'http://example.org/': ['http://example.org/a'],
+    }
+    browsed = []
+    def brozzle_page(browser, site, page):
+        browsed.append((page.url, time.time()))
+        return links.get(page.url, [])
+    worker._brozzle_page = brozzle_page
+
+    # short crawl delays between pages of the site are waited out, holding
+    # on to the host lease
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.com/', 'ignore_robots': True,
+        'crawl_delay': 1})
+    brozzler.new_site(frontier, site)
+    site = frontier.claim_sites('test_worker', 1)[0]
+    worker.brozzle_site(FakeBrowser(), site)
+    assert [url for url, t in browsed] == [
+            'http://example.com/', 'http://example.com/a']
+    assert browsed[1][1] - browsed[0][1] >= 1
+    site.refresh()
+    assert site.status == 'FINISHED'
+    # lease released, with the rest of the crawl delay left on the host
+    host = brozzler.sqlite.loads(frontier.rr.query(
+        'select doc from hosts where id = ?', ('example.com',))[0][0])
+    assert not host['lease']
+    assert host['available_at'] > doublethink.utcnow()
+
+    # without a crawl delay, a site is set aside for a little while if its
+    # host is busy with the maximum number of other browsers
+    browsed.clear()
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.org/', 'ignore_robots': True})
+    brozzler.new_site(frontier, site)
+    leases = [frontier.lease_host('example.org'),
+              frontier.lease_host('example.org#1')]
+    site = frontier.claim_sites('test_worker', 1)[0]
+    worker.brozzle_site(FakeBrowser(), site)
+    assert browsed == []
+    site.refresh()
+    assert site.claim_after < doublethink.utcnow() + datetime.timedelta(
+            seconds=20)
+    frontier.release_host('example.org#1', leases[1])
+    site.claim_after = None
+    site.save()
+    site = frontier.claim_sites('test_worker', 1)[0]
+    worker.brozzle_site(FakeBrowser(), site)
+    assert [url for url, t in browsed] == [
+            'http://example.org/', 'http://example.org/a']
+
+    # a crawl delay too long to wait out sets the site aside until then
+    browsed.clear()
+    site = brozzler.Site(frontier.rr, {
+        'seed': 'http://example.net/', 'ignore_robots': True,
+        'crawl_delay': 300})
+    brozzler.new_site(frontier, site)
+    links['http://example.net/'] = ['http://example.net/a']
+    site = frontier.claim_sites('test_worker', 1)[0]
+    worker.brozzle_site(FakeBrowser(), site)
+    assert [url for url, t in browsed] == ['http://example.net/']
+    site.refresh()
+    assert site.status == 'ACTIVE'
+    assert site.claim_after > doublethink.utcnow() + datetime.timedelta(
+            seconds=290)
+    with pytest.raises(brozzler.HostBusy):
+        frontier.lease_host('example.net')
+
+def test_stop_crawl(tmpdir):
+    db = str(tmpdir.join('frontier.db'))
+    frontier = brozzler.SqliteFrontier(db)
+    job = brozzler.new_job(frontier, {'seeds': [
+        {'url': 'http://example.com/'}, {'url': 'http://example.org/'}]})
+    site = list(frontier.job_sites(job.id))[0]
+
+    brozzler.cli.brozzler_stop_crawl([
+        'brozzler-stop-crawl', '--sqlite-db', db, '--site', site.id])
+    site.refresh()
+    assert site.stop_requested
+    brozzler.cli.brozzler_stop_crawl([
+        'brozzler-stop-crawl', '--sqlite-db', db, '--job', job.id])
+    job.refresh()
+    assert job.stop_requested
+
+    with pytest.raises(SystemExit):
+        brozzler.cli.brozzler_stop_crawl([
+            'brozzler-stop-crawl', '--sqlite-db', db, '--site', 'nope'])
@@ -23,6 +23,9 @@ import threading
 import os
 import brozzler
 import brozzler.chrome
+import brozzler.canon
+import brozzler.recordwriter
+import doublethink
 import logging
 import yaml
 import datetime
@@ -30,8 +33,13 @@ import requests
 import tempfile
 import uuid
 import socket
+import subprocess
 import time
 import sys
+import urlcanon
+import io
+import json
+import PIL.Image
 
 logging.basicConfig(
         stream=sys.stderr, level=logging.INFO, format=(
@@ -117,6 +125,163 @@ blocks:
     assert site.is_in_scope(
             'https://www.youtube.com/watch?v=dUIn5OAPS5s', yt_user_page)
 
+def test_compiled_scope():
+    site = brozzler.Site(None, {
+        'id': 1, 'seed': 'http://example.com/a/', 'scope': {
+            'accepts': [
+                {'surt': 'http://(org,example,)/%s/' % i} for i in range(300)
+            ] + [
+                {'domain': 'example.net'},
+                {'ssurt': 'org,example,sub,'},
+                {'substring': 'acceptme'}],
+            'blocks': [
+                {'domain': 'bad.example.net'},
+                {'url_match': 'SURT_MATCH',
+                 'value': 'http://(org,example,)/1/block'}]}})
+    page = brozzler.Page(None, {
+        'url': 'http://example.com/a/', 'site_id': site.id})
+
+    scope = site.compiled_scope()
+    assert site.compiled_scope() is scope
+    assert scope.parent_urls(page) is scope.parent_urls(page)
+
+    assert site.is_in_scope('http://example.com/a/b', page)
+    assert not site.is_in_scope('http://example.com/b/', page)
+    assert site.is_in_scope('http://example.org/299/x', page)
+    assert not site.is_in_scope('http://example.org/300/x', page)
+    assert site.is_in_scope('http://example.org/1/x', page)
+    assert not site.is_in_scope('http://example.org/1/blocked', page)
+    assert site.is_in_scope('http://www.example.net/', page)
+    assert site.is_in_scope('http://example.net/', page)
+    assert not site.is_in_scope('http://notexample.net/', page)
+    assert not site.is_in_scope('http://bad.example.net/', page)
+    assert site.is_in_scope('https://foo.sub.example.org/', page)
+    assert site.is_in_scope('http://whatever.com/acceptme', page)
+
+    # scope is recompiled when it changes
+    site.note_seed_redirect('http://example.com/b/')
+    assert site.compiled_scope() is not scope
+    assert site.is_in_scope('http://example.com/b/', page)
+    scope = site.compiled_scope()
+    site.scope = {'surt': 'http://(com,example,)/'}
+    assert site.compiled_scope() is not scope
+    assert not site.is_in_scope('http://example.org/1/x', page)
+
+def test_seen_pages():
+    seen = brozzler.frontier.SeenPages(complete=True)
+    seen.INITIAL_CAPACITY = 100
+    ids = [brozzler.Page.compute_id('site', 'http://example.com/%s' % i)
+           for i in range(1000)]
+    for page_id in ids[:600]:
+        seen.add(page_id)
+    assert all(page_id in seen for page_id in ids[:600])
+    # filter grew new layers instead of filling up
+    assert len(seen._layers) == 3
+    false_positives = sum(1 for page_id in ids[600:] if page_id in seen)
+    assert false_positives < 10
+
+    seen.add_brozzled(ids[0])
+    assert seen.is_brozzled(ids[0])
+    assert not seen.is_brozzled(ids[1])
+
+    restored = brozzler.frontier.SeenPages.from_dict(seen.to_dict())
+    assert restored.complete
+    assert all(page_id in restored for page_id in ids[:600])
+    # brozzled pages are not persisted
+    assert not restored.is_brozzled(ids[0])
+
+    assert not brozzler.frontier.SeenPages.from_dict(None).complete
+
+def test_canonicalize():
+    canon = brozzler.canon.canonicalize(
+            'HTTP://Example.com:80/a/../b?y=1&x=2#frag')
+    assert str(canon.semantic) == 'http://example.com/b?x=2&y=1'
+    assert str(canon.whatwg) == 'http://example.com/b?y=1&x=2'
+    assert canon.hashtag == '#frag'
+    assert canon.surt == b'http://(com,example,)/b?x=2&y=1'
+    assert canon.semantic.ssurt() == urlcanon.semantic(
+            'http://example.com/b?x=2&y=1').ssurt()
+    assert brozzler.canon.canonicalize('http://example.com/').hashtag == ''
+
+    # memoized, and shared safely
+    assert brozzler.canon.canonicalize(
+            'HTTP://Example.com:80/a/../b?y=1&x=2#frag') is canon
+    with pytest.raises(AttributeError):
+        canon.whatwg.fragment = b'other'
+    url = canon.whatwg.thaw()
+    url.fragment = b'other'
+    assert str(url) == 'http://example.com/b?y=1&x=2other'
+    assert str(canon.whatwg) == 'http://example.com/b?y=1&x=2'
+
+def test_ydl_extractor_index():
+    index = brozzler.worker.ydl_extractor_index()
+    assert index is brozzler.worker.ydl_extractor_index()
+    assert index.suitable('https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+    assert index.suitable('https://vimeo.com/123456')
+    assert not index.suitable('http://example.com/some/page.html')
+
+def test_ydl_negative_cache():
+    cache = brozzler.worker.YoutubeDLNegativeCache(threshold=3, max_size=2)
+    for i in range(2):
+        cache.note_no_video('http://example.com/blog/post%s.html' % i)
+    assert not cache.skip('http://example.com/blog/post9.html')
+    cache.note_no_video('http://example.com/blog/post2.html')
+    assert cache.skip('http://example.com/blog/post9.html')
+    # different kinds of urls are tracked separately
+    assert not cache.skip('http://example.com/blog/2017/post9.html')
+    assert not cache.skip('http://example.com/videos/post9.html')
+    assert not cache.skip('http://example.com/blog/post9.html?page=2')
+    assert not cache.skip('http://other.example.com/blog/post9.html')
+
+    # a video starts the count over
+    cache.note_video('http://example.com/blog/post3.html')
+    assert not cache.skip('http://example.com/blog/post9.html')
+
+    # least recently used kinds of urls are forgotten
+    for i in range(3):
+        cache.note_no_video('http://a.example.com/x/%s' % i)
+        cache.note_no_video('http://b.example.com/x/%s' % i)
+    cache.note_no_video('http://c.example.com/x/1')
+    assert not cache.skip('http://a.example.com/x/4')
+    assert cache.skip('http://b.example.com/x/4')
+
+def test_lazy_imports():
+    '''
+    Importing brozzler shouldn't pay for importing the browser, the worker,
+    youtube-dl or the rethinkdb driver, and commands like brozzler-list-jobs
+    shouldn't pay for the browser, the worker and youtube-dl.
+    '''
+    script = (
+        'import sys, time\n'
+        'start = time.time()\n'
+        'import %s\n'
+        'elapsed = time.time() - start\n'
+        'heavy = %r\n'
+        'print(elapsed)\n'
+        'print(",".join(m for m in heavy if m in sys.modules))\n')
+    heavy = [
+        'brozzler.worker', 'brozzler.browser', 'brozzler.model',
+        'youtube_dl', 'PIL', 'websocket', 'cerberus']
+    for module, unwanted in (
+            ('brozzler', heavy + [
+                'brozzler.frontier', 'doublethink', 'rethinkdb']),
+            ('brozzler.cli', heavy)):
+        out = subprocess.check_output(
+                [sys.executable, '-c', script % (module, unwanted)])
+        elapsed, loaded = out.decode('ascii').splitlines()
+        logging.info('import %s took %s seconds', module, elapsed)
+        assert loaded == ''
+        # loose bound, only meant to catch gross regressions
+        assert float(elapsed) < 10
+
+    # everything is still there when needed
+    assert brozzler.BrozzlerWorker is brozzler.worker.BrozzlerWorker
+    assert brozzler.new_job is brozzler.model.new_job
+    assert brozzler.EPOCH_UTC == datetime.datetime(
+            1970, 1, 1, tzinfo=doublethink.UTC)
+    with pytest.raises(AttributeError):
+        brozzler.no_such_thing
+
 def test_proxy_down():
     '''
     Test all fetching scenarios raise `brozzler.ProxyError` when proxy is down.
@@ -153,14 +318,219 @@ def test_proxy_down():
         with pytest.raises(brozzler.ProxyError):
             worker._fetch_url(site, page)
 
-        # WARCPROX_WRITE_RECORD
+        # WARCPROX_WRITE_RECORD, retried in the background, then the error
+        # is raised for the site
+        worker._record_writer.retries = 1
+        worker._record_writer.backoff = 0.01
+        worker._write_record(
+                site, url='test://proxy_down/warcprox_write_record',
+                warc_type='metadata', content_type='text/plain',
+                payload=b'''payload doesn't matter here''')
+        assert worker._record_writer.flush(site.id, timeout=30)
         with pytest.raises(brozzler.ProxyError):
-            worker._warcprox_write_record(
-                    warcprox_address=not_listening_proxy,
-                    url='test://proxy_down/warcprox_write_record',
-                    warc_type='metadata',
-                    content_type='text/plain',
-                    payload=b'''payload doesn't matter here''')
+            worker._record_writer.check(site.id)
+        worker._record_writer.close()
+
+def test_record_writer():
+    records = []
+    connections = set()
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_WARCPROX_WRITE_RECORD(self):
+            connections.add(self.client_address)
+            payload = self.rfile.read(int(self.headers['content-length']))
+            records.append((
+                self.path, self.headers['warc-type'],
+                self.headers['x-extra'], payload))
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.HTTPServer(('localhost', 0), Handler)
+    httpd_thread = threading.Thread(name='httpd', target=httpd.serve_forever)
+    httpd_thread.start()
+    writer = brozzler.recordwriter.RecordWriter(
+            threads=1, queue_size=2, retries=1, backoff=0.01)
+    try:
+        address = 'localhost:%s' % httpd.server_port
+        for i in range(5):
+            writer.write(
+                    'site1', address, 'screenshot:http://example.com/%s' % i,
+                    'resource', 'image/jpeg', ('jpeg%s' % i).encode('ascii'),
+                    extra_headers={'X-Extra': 'yes'})
+        assert writer.flush('site1', timeout=10)
+        assert records == [
+                ('screenshot:http://example.com/%s' % i, 'resource', 'yes',
+                 ('jpeg%s' % i).encode('ascii')) for i in range(5)]
+        # one keep-alive connection
+        assert len(connections) == 1
+        writer.check('site1')
+
+        # warcprox down: the error is held for the owner of the record
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        writer.write(
+                'site2', '127.0.0.1:%s' % sock.getsockname()[1],
+                'screenshot:http://example.org/', 'resource', 'image/jpeg',
+                b'jpeg')
+        assert writer.flush(timeout=10)
+        writer.check('site1')
+        with pytest.raises(brozzler.ProxyError):
+            writer.check('site2')
+        writer.check('site2')
+    finally:
+        writer.close()
+        httpd.shutdown()
+        httpd.server_close()
+        httpd_thread.join()
+
+def test_thumbnails():
+    def jpeg(width, height):
+        out = io.BytesIO()
+        PIL.Image.new('RGB', (width, height), 'red').save(out, 'jpeg')
+        return out.getvalue()
+    screenshot = jpeg(1100, 900)
+    assert brozzler.worker.jpeg_width(screenshot) == 1100
+    thumbnail = brozzler.worker.make_thumbnail(screenshot)
+    assert PIL.Image.open(io.BytesIO(thumbnail)).size == (300, 245)
+
+    worker = brozzler.BrozzlerWorker(None)
+    worker._using_warcprox = lambda site: True
+    records = []
+    worker._write_record = lambda site, url, warc_type, content_type, \
+            payload: records.append((url, payload))
+    site = brozzler.Site(None, {'seed': 'http://example.com/'})
+    page = brozzler.Page(None, {'url': 'http://example.com/'})
+
+    # thumbnail from chrome is used as is
+    worker._write_screenshot(site, page, screenshot, thumbnail)
+    assert records == [
+            ('screenshot:http://example.com/', screenshot),
+            ('thumbnail:http://example.com/', thumbnail)]
+
+    # made here if chrome didn't scale the screenshot
+    for chrome_thumbnail in (None, screenshot):
+        records.clear()
+        worker._write_screenshot(site, page, screenshot, chrome_thumbnail)
+        assert records[0] == ('screenshot:http://example.com/', screenshot)
+        assert brozzler.worker.jpeg_width(records[1][1]) == 300
+
+def test_browser_waits_for_results():
+    class FakeWebsock:
+        '''Answers commands after 0.1s, like chrome would.'''
+        def send(self, msg):
+            msg = json.loads(msg)
+            if msg['method'] == 'Runtime.evaluate':
+                response = {'id': msg['id'], 'result': {
+                    'result': {'value': 'http://example.com/'}}}
+            else:
+                response = {'id': msg['id'], 'error': {'code': -32000}}
+            threading.Timer(0.1, browser.websock_thread._handle_message, (
+                self, json.dumps(response))).start()
+
+    browser = brozzler.Browser(chrome_exe='chromium-browser')
+    browser.websock = FakeWebsock()
+    browser.websock_thread = brozzler.browser.WebsockReceiverThread(
+            browser.websock)
+
+    # wakes up as soon as the result arrives, instead of polling
+    start = time.time()
+    assert browser.url() == 'http://example.com/'
+    assert time.time() - start < 0.4
+    with pytest.raises(brozzler.browser.ChromeError):
+        browser._call('Page.bogus')
+    assert time.time() - start < 0.8
+
+    # results nobody is waiting for anymore don't pile up
+    thread = browser.websock_thread
+    for msg_id in range(thread.MAX_PENDING_RESULTS + 10):
+        thread.expect_result(1000 + msg_id)
+    assert len(thread._result_messages) == thread.MAX_PENDING_RESULTS
+    assert not 1000 in thread._result_messages
+
+def test_behavior_finished_notification():
+    class FakeWebsock:
+        def __init__(self, notification):
+            self.notification = notification
+            self.expressions = []
+        def send(self, msg):
+            msg = json.loads(msg)
+            self.expressions.append(msg['params']['expression'])
+            if 'umbraBehaviorFinished()' in msg['params']['expression']:
+                threading.Timer(
+                        0.2, browser.websock_thread._handle_message,
+                        (self, json.dumps(self.notification))).start()
+
+    for notification in (
+            {'method': 'Runtime.bindingCalled', 'params': {
+                'name': '__brzlBehaviorFinished', 'payload': ''}},
+            {'method': 'Console.messageAdded', 'params': {'message': {
+                'level': 'log', 'text': '__brzl_behavior_finished__'}}}):
+        browser = brozzler.Browser(chrome_exe='chromium-browser')
+        browser.websock = FakeWebsock(notification)
+        browser.websock_thread = brozzler.browser.WebsockReceiverThread(
+                browser.websock)
+        start = time.time()
+        browser.run_behavior('var umbraBehaviorFinished = ...', timeout=30)
+        assert time.time() - start < 2
+        # the page was not asked whether the behavior had finished
+        assert browser.websock.expressions[1:] == [
+                brozzler.jinja2_environment().get_template(
+                    'notify-behavior-finished.js').render()]
+
+def test_behavior_ends_when_network_idle():
+    class FakeWebsock:
+        def __init__(self):
+            self.sent = 0
+        def send(self, msg):
+            # network activity while the behavior script starts up
+            self.sent += 1
+            if self.sent > 1:
+                return
+            for delay, method, request_id in (
+                    (0.2, 'Network.requestWillBeSent', '1'),
+                    (0.3, 'Network.requestWillBeSent', '2'),
+                    (0.4, 'Network.loadingFinished', '1'),
+                    (0.5, 'Network.loadingFailed', '2')):
+                message = {'method': method, 'params': {
+                    'requestId': request_id}}
+                if method == 'Network.loadingFailed':
+                    message['params']['errorText'] = 'net::ERR_ABORTED'
+                threading.Timer(
+                        delay, browser.websock_thread._handle_message,
+                        (self, json.dumps(message))).start()
+
+    browser = brozzler.Browser(chrome_exe='chromium-browser')
+    browser.websock = FakeWebsock()
+    browser.websock_thread = brozzler.browser.WebsockReceiverThread(
+            browser.websock)
+    start = time.time()
+    # behavior never says it has finished
+    stats = browser.run_behavior(
+            'var umbraBehaviorFinished = ...', timeout=30,
+            request_idle_timeout=1)
+    assert time.time() - start < 3
+    assert stats['outcome'] == 'network_idle'
+    assert stats['requests'] == 2
+    assert stats['max_inflight'] == 2
+    assert stats['inflight'] == 0
+    assert stats['idle_seconds'] >= 1
+
+    # requests of an earlier page that never finished don't count when
+    # browsing the next one
+    browser.websock_thread._handle_message(None, json.dumps({
+        'method': 'Network.requestWillBeSent', 'params': {'requestId': '3'}}))
+    assert browser.websock_thread.inflight_requests == {'3'}
+    browser.websock_thread.reset_network_activity()
+    assert browser.websock_thread.inflight_requests == set()
+    assert browser.websock_thread.max_inflight == 0
+
+    assert brozzler.behavior_request_idle_timeout(
+            'https://www.facebook.com/example') == 30
+    assert brozzler.behavior_request_idle_timeout(
+            'http://example.com/') == 10
 
 def test_start_stop_backwards_compat():
     site = brozzler.Site(None, {'seed': 'http://example.com/'})
@@ -245,3 +615,38 @@ def test_thread_raise():
     with pytest.raises(threading.ThreadError): # thread is not running
         brozzler.thread_raise(th, Exception)
 
+
+def test_worker_enforces_time_limits():
+    worker = brozzler.BrozzlerWorker(None)
+    site = brozzler.Site(None, {
+        'seed': 'http://example.com/', 'time_limit': 10,
+        'starts_and_stops': [{
+            'start': doublethink.utcnow() - datetime.timedelta(minutes=1),
+            'stop': None}]})
+    other_site = brozzler.Site(None, {
+        'seed': 'http://example.org/', 'time_limit': 600})
+    stop = threading.Event()
+    caught = []
+
+    def thread_target():
+        try:
+            with brozzler.thread_accept_exceptions():
+                while not stop.is_set():
+                    time.sleep(0.1)
+        except brozzler.ReachedTimeLimit as e:
+            caught.append(threading.current_thread())
+
+    th1 = threading.Thread(target=thread_target)
+    th2 = threading.Thread(target=thread_target)
+    worker._browsing_threads = {th1: site, th2: other_site}
+    th1.start()
+    th2.start()
+    try:
+        worker._enforce_time_limits()
+        th1.join(timeout=5)
+        assert caught == [th1]
+        assert worker._time_limited_threads == {th1}
+        assert th2.is_alive()
+    finally:
+        stop.set()
+        th2.join()